@@ -8,6 +8,10 @@ from .routing import URLMap, WebSite, WebSiteLocale, URLRule, URLRuleDefaults, \
     WebsiteCountry, WebsiteCurrency, WebsiteWebsiteLocale
 from .static_file import NereidStaticFolder, NereidStaticFile
 from .currency import Currency
+from .country import Country, Subdivision
+from .company import Company
+from .outbox import EmailOutbox
+from .user_token import NereidUserToken
 from .template import ContextProcessors
 
 
@@ -17,6 +21,7 @@ def register():
         Party,
         ContactMechanism,
         NereidUser,
+        NereidUserToken,
         Permission,
         UserPermission,
         URLMap,
@@ -30,6 +35,10 @@ def register():
         NereidStaticFolder,
         NereidStaticFile,
         Currency,
+        Country,
+        Subdivision,
+        Company,
+        EmailOutbox,
         ContextProcessors,
         module='nereid', type_='model'
     )
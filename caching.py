@@ -0,0 +1,295 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from functools import wraps
+from threading import Lock
+
+from nereid import cache
+from nereid.globals import request, session, current_app
+from nereid.helpers import key_from_list, url_for
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.cache import LRUDict
+from trytond.config import CONFIG
+
+__all__ = [
+    'cache_response', 'url_for_cached', 'url_for_many', 'RequestRecords',
+    'request_records', 'request_user', 'WebsiteCacheMixin',
+]
+
+#: URLs built by :func:`url_for_cached` in this process
+_url_cache = LRUDict(int(CONFIG.options.get('nereid_url_cache_size', 4096)))
+_url_cache_lock = Lock()
+
+#: The version of the URL rules of each database when its URLs were cached
+_url_cache_versions = {}
+
+
+def get_response_cache_key(settings):
+    """
+    Returns the key of the current request in the response cache
+
+    :param settings: The cache settings of the rule, as returned by
+                     :meth:`URLRule.get_response_cache_settings`
+    """
+    URLMap = Pool().get('nereid.url_map')
+
+    key = [
+        Transaction().cursor.database_name,
+        'nereid.response_cache',
+        # Responses cached with former rules or settings are not served
+        URLMap.get_rules_version(),
+        request.endpoint,
+        request.path,
+        request.query_string,
+    ]
+    if settings['vary_website']:
+        key.append(request.nereid_website.id)
+    if settings['vary_locale']:
+        key.append(Transaction().language)
+    if settings['vary_currency']:
+        key.append(request.nereid_currency.id)
+    if settings['vary_user']:
+        # Guests share the responses, logged in users get their own
+        key.append(None if request.is_guest_user else request.nereid_user.id)
+    return key_from_list(key)
+
+
+def cache_response(function):
+    """
+    Serve GET requests of the decorated handler from the shared cache when
+    caching is configured on the URL rule of the request. The handler is
+    only called when the response is not in the cache.
+
+    Only successful responses are stored, without their cookies.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET':
+            return function(*args, **kwargs)
+
+        URLRule = Pool().get('nereid.url_rule')
+        settings = URLRule.get_response_cache_settings(
+            request.nereid_website.get_snapshot().url_map, request.endpoint
+        )
+        if not settings:
+            return function(*args, **kwargs)
+
+        key = get_response_cache_key(settings)
+        cached = cache.get(key)
+        if cached is not None:
+            status, headers, data = cached
+            # Cached responses with an ETag still answer conditional
+            # requests with a 304
+            return current_app.response_class(
+                data, status=status, headers=headers
+            ).make_conditional(request)
+
+        response = current_app.make_response(function(*args, **kwargs))
+        if response.status_code == 200 and not response.direct_passthrough:
+            headers = [
+                (name, value) for name, value in response.headers
+                if name.lower() != 'set-cookie'
+            ]
+            cache.set(
+                key, (response.status_code, headers, response.data),
+                settings['timeout']
+            )
+        return response
+    return wrapper
+
+
+def _get_url_key_prefix():
+    """
+    Returns the part of the URL cache key which is common to all URLs built
+    in the current request and empties the cache when the rules changed
+    since it was filled.
+    """
+    URLMap = Pool().get('nereid.url_map')
+
+    database_name = Transaction().cursor.database_name
+    version = URLMap.get_rules_version()
+    if _url_cache_versions.get(database_name) != version:
+        with _url_cache_lock:
+            _url_cache.clear()
+            _url_cache_versions[database_name] = version
+    return (
+        database_name,
+        request.nereid_website.id,
+        version,
+        request.host_url,
+        Transaction().language,
+    )
+
+
+def _build_url(prefix, endpoint, values):
+    """
+    Returns the URL from the cache or builds it with url_for
+    """
+    try:
+        key = prefix + (endpoint, tuple(sorted(values.items())))
+        hash(key)
+    except TypeError:
+        # Unhashable arguments like _params lists are not cached
+        return url_for(endpoint, **values)
+
+    with _url_cache_lock:
+        rv = _url_cache.pop(key, None)
+        if rv is not None:
+            # Move it to the end, so that the least recently used go first
+            _url_cache[key] = rv
+            return rv
+    rv = url_for(endpoint, **values)
+    with _url_cache_lock:
+        _url_cache[key] = rv
+    return rv
+
+
+def url_for_cached(endpoint, **values):
+    """
+    A memoized :func:`nereid.helpers.url_for` for URLs which are built many
+    times, like the URLs of static files in templates.
+
+    URLs are kept in a bounded LRU cache (`nereid_url_cache_size` in the
+    tryton configuration, 4096 by default) keyed by the database, website,
+    version of the URL rules, host, language, endpoint and arguments. The
+    cache is emptied when the URL rules change.
+    """
+    return _build_url(_get_url_key_prefix(), endpoint, values)
+
+
+def url_for_many(urls):
+    """
+    Build many URLs at once with :func:`url_for_cached`.
+
+    :param urls: An iterable of (endpoint, values) pairs
+    :return: The list of URLs, in the same order
+    """
+    prefix = _get_url_key_prefix()
+    return [
+        _build_url(prefix, endpoint, dict(values))
+        for endpoint, values in urls
+    ]
+
+
+class WebsiteCacheMixin(object):
+    """
+    A mixin for the models whose records are cached by the websites. Their
+    cache is invalidated whenever records are created, written or deleted.
+
+    The classmethod of `nereid.website` called to invalidate the cache is
+    named by `_website_cache_invalidator`.
+    """
+    _website_cache_invalidator = 'clear_website_cache'
+
+    @classmethod
+    def invalidate_website_cache(cls):
+        WebSite = Pool().get('nereid.website')
+        getattr(WebSite, cls._website_cache_invalidator)()
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(WebsiteCacheMixin, cls).create(vlist)
+        cls.invalidate_website_cache()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        rv = super(WebsiteCacheMixin, cls).write(records, values)
+        cls.invalidate_website_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        rv = super(WebsiteCacheMixin, cls).delete(records)
+        cls.invalidate_website_cache()
+        return rv
+
+
+class RequestRecords(object):
+    """
+    An identity map of the records loaded while handling a request and of
+    the values read from them, so that the handlers, context processors
+    and templates of a request share them instead of loading them again.
+
+    The website, its company and its countries are not in the map: they
+    are read from the snapshot of :meth:`WebSite.get_snapshot`, shared by
+    the requests of the process. The number of values served from the map
+    and loaded are counted in `hits` and `misses`.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """
+        Returns the value of the key, calling loader to get it the first
+        time
+        """
+        try:
+            value = self.values[key]
+        except KeyError:
+            self.misses += 1
+            value = self.values[key] = loader()
+        else:
+            self.hits += 1
+        return value
+
+    def record(self, model_name, record_id, loader=None):
+        """
+        Returns the instance of the record shared by the request
+
+        :param loader: Returns the instance the first time. Defaults to a
+                       new instance of the model.
+        """
+        return self.get(
+            (model_name, record_id),
+            loader or (lambda: Pool().get(model_name)(record_id))
+        )
+
+    def related(self, record, name):
+        "Returns the value of a field of the record, read once per request"
+        return self.get(
+            (record.__name__, record.id, name),
+            lambda: getattr(record, name)
+        )
+
+    def forget(self, record, name=None):
+        """
+        Drop the record, or only one of its fields, from the map once it
+        was written
+        """
+        if name is not None:
+            self.values.pop((record.__name__, record.id, name), None)
+            return
+        for key in self.values.keys():
+            if key[:2] == (record.__name__, record.id):
+                del self.values[key]
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def request_records():
+    "Returns the :class:`RequestRecords` of the current request"
+    records = getattr(request, 'nereid_records', None)
+    if records is None:
+        records = request.nereid_records = RequestRecords()
+    return records
+
+
+def request_user():
+    """
+    Returns the user of the current request without the lookups of
+    `request.nereid_user`: guests get the read only snapshot of the guest
+    user of the website (see :meth:`WebSite.get_guest_user`) and logged in
+    users `request.nereid_user`, shared through the :func:`request_records`
+    of the request.
+    """
+    if 'user' not in session:
+        return request.nereid_website.get_guest_user()
+    return request_records().record(
+        'nereid.user', session['user'], lambda: request.nereid_user
+    )
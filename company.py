@@ -0,0 +1,13 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .caching import WebsiteCacheMixin
+
+__all__ = ['Company']
+
+
+class Company(WebsiteCacheMixin):
+    "Websites keep the currency of their company in their snapshot"
+    __name__ = 'company.company'
+    __metaclass__ = PoolMeta
@@ -0,0 +1,19 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .caching import WebsiteCacheMixin
+
+__all__ = ['Country', 'Subdivision']
+
+
+class Country(WebsiteCacheMixin):
+    "Websites keep the countries they serve, serialised, in their cache"
+    __name__ = 'country.country'
+    __metaclass__ = PoolMeta
+
+
+class Subdivision(WebsiteCacheMixin):
+    "Websites keep the subdivisions they serve, serialised, in their cache"
+    __name__ = 'country.subdivision'
+    __metaclass__ = PoolMeta
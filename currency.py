@@ -3,12 +3,16 @@
 from trytond.model import ModelView, ModelSQL
 from nereid import request
 
+from .caching import WebsiteCacheMixin
+
 __all__ = ['Currency']
 
 
-class Currency(ModelSQL, ModelView):
+class Currency(WebsiteCacheMixin, ModelSQL, ModelView):
     '''Currency Manipulation for core.'''
     __name__ = 'currency.currency'
+    # Websites keep the display values of their currencies
+    _website_cache_invalidator = 'bump_currencies_version'
 
     @classmethod
     def convert(cls, amount):
@@ -17,7 +21,7 @@ class Currency(ModelSQL, ModelView):
         session.
         """
         return cls.compute(
-            request.nereid_website.company.currency,
+            cls(request.nereid_website.get_snapshot().company_currency.id),
             amount,
             request.nereid_currency
         )
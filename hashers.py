@@ -0,0 +1,259 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+    Password hashers
+
+    Passwords are stored as `<algorithm>$<cost>$<salt>$<hash>`, so that
+    the hasher and its cost can change without invalidating the stored
+    passwords. Passwords stored before, as a bare SHA-1 of the password
+    and the salt of the user, are still verified by :class:`SHA1Hasher`.
+
+    The hasher is chosen with `nereid_password_hasher` in the tryton
+    configuration (`pbkdf2_sha256` by default) and its cost with
+    `nereid_password_cost`.
+"""
+import base64
+import hashlib
+import hmac
+import random
+import string
+from multiprocessing import Pool
+from threading import Lock, BoundedSemaphore
+
+from trytond.config import CONFIG
+
+__all__ = [
+    'SHA1Hasher', 'PBKDF2Hasher', 'HASHERS', 'get_hasher', 'identify_hasher',
+    'make_password', 'check_password', 'needs_rehash',
+]
+
+_random = random.SystemRandom()
+
+_semaphore = None
+_semaphore_lock = Lock()
+
+_process_pool = None
+_process_pool_lock = Lock()
+
+
+def make_salt(length=12):
+    "Returns a random salt"
+    chars = string.ascii_letters + string.digits
+    return ''.join(_random.choice(chars) for i in xrange(length))
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _constant_time_compare(val1, val2):
+    "Compare two strings in a time which does not depend on their match"
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(val1, val2)
+    if len(val1) != len(val2):
+        return False
+    result = 0
+    for x, y in zip(val1, val2):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def _pbkdf2(digest, password, salt, iterations):
+    """
+    PBKDF2 by hashlib, which releases the GIL while it computes. Pythons
+    before 2.7.8 have no pbkdf2_hmac: it is computed in python then, in
+    the processes of :func:`get_process_pool` so that it does not hold the
+    GIL of the threads serving requests.
+    """
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        return hashlib.pbkdf2_hmac(digest, password, salt, iterations)
+    return get_process_pool().apply(
+        _python_pbkdf2, (digest, password, salt, iterations)
+    )
+
+
+def _python_pbkdf2(digest, password, salt, iterations):
+    "PBKDF2 computed in python"
+    # A single block is enough as the length of the key is the length of
+    # the digest
+    mac = hmac.new(password, digestmod=getattr(hashlib, digest))
+
+    def prf(data):
+        h = mac.copy()
+        h.update(data)
+        return h.digest()
+
+    u = prf(salt + '\x00\x00\x00\x01')
+    result = [ord(c) for c in u]
+    for i in xrange(iterations - 1):
+        u = prf(u)
+        for j, c in enumerate(u):
+            result[j] ^= ord(c)
+    return ''.join(chr(c) for c in result)
+
+
+class SHA1Hasher(object):
+    """
+    A salted SHA-1 of the password. This is the hasher with which nereid
+    always stored passwords, it should only be used to verify them.
+    """
+    algorithm = 'sha1'
+    default_cost = 1
+
+    def __init__(self, cost=None):
+        self.cost = cost or self.default_cost
+
+    def digest(self, password, salt):
+        return hashlib.sha1(_to_bytes(password) + salt).hexdigest()
+
+    def hash(self, password):
+        salt = make_salt()
+        return '%s$%d$%s$%s' % (
+            self.algorithm, self.cost, salt, self.digest(password, salt)
+        )
+
+    def verify(self, password, encoded, salt=None):
+        """
+        :param salt: The salt of the user, for the passwords stored without
+                     an algorithm
+        """
+        if '$' in encoded:
+            algorithm, cost, salt, digest = encoded.split('$', 3)
+        else:
+            digest = encoded
+        return _constant_time_compare(
+            self.digest(password, _to_bytes(salt or '')), digest
+        )
+
+    def needs_rehash(self, encoded):
+        return not encoded.startswith(self.algorithm + '$')
+
+
+class PBKDF2Hasher(SHA1Hasher):
+    """
+    PBKDF2 with HMAC-SHA256, whose cost is the number of iterations
+    """
+    algorithm = 'pbkdf2_sha256'
+    default_cost = 12000
+
+    def digest(self, password, salt, cost=None):
+        return base64.b64encode(_pbkdf2(
+            'sha256', _to_bytes(password), salt, cost or self.cost
+        ))
+
+    def verify(self, password, encoded, salt=None):
+        algorithm, cost, salt, digest = encoded.split('$', 3)
+        return _constant_time_compare(
+            self.digest(password, salt, int(cost)), digest
+        )
+
+    def needs_rehash(self, encoded):
+        return not encoded.startswith(
+            '%s$%d$' % (self.algorithm, self.cost)
+        )
+
+
+#: The hashers by algorithm
+HASHERS = dict(
+    (hasher.algorithm, hasher) for hasher in (SHA1Hasher, PBKDF2Hasher)
+)
+
+
+def get_hasher(algorithm=None, cost=None):
+    """
+    Returns the hasher with which passwords are stored
+
+    :param algorithm: The algorithm of the hasher. Defaults to the hasher
+                      of the configuration.
+    :param cost: The cost of the hasher. Defaults to the cost of the
+                 configuration or of the hasher.
+    """
+    if algorithm is None:
+        algorithm = CONFIG.options.get(
+            'nereid_password_hasher', PBKDF2Hasher.algorithm
+        )
+        cost = cost or int(CONFIG.options.get('nereid_password_cost', 0))
+    return HASHERS[algorithm](cost)
+
+
+def identify_hasher(encoded):
+    "Returns the hasher which made the stored password"
+    if '$' not in encoded:
+        return SHA1Hasher()
+    algorithm, cost, rest = encoded.split('$', 2)
+    return HASHERS[algorithm](int(cost))
+
+
+def get_concurrency():
+    """
+    Returns the number of passwords hashed at the same time in the process,
+    which is `nereid_password_threads` in the configuration (4 by default)
+    """
+    return int(CONFIG.options.get('nereid_password_threads', 4))
+
+
+def get_process_pool():
+    """
+    Returns the pool of :func:`get_concurrency` processes computing PBKDF2
+    when hashlib cannot (see :func:`_pbkdf2`)
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                _process_pool = Pool(get_concurrency())
+    return _process_pool
+
+
+def run_throttled(function, *args):
+    """
+    Run the function in the calling thread once fewer than
+    :func:`get_concurrency` hashes are being computed, and return its
+    result.
+
+    This bounds the CPU spent on hashing when many logins arrive at once:
+    the caller waits for its hash either way. The other threads keep
+    serving requests meanwhile, as PBKDF2 is computed without the GIL by
+    hashlib or else in a process of :func:`get_process_pool`.
+    """
+    global _semaphore
+    if _semaphore is None:
+        with _semaphore_lock:
+            if _semaphore is None:
+                _semaphore = BoundedSemaphore(get_concurrency())
+    with _semaphore:
+        return function(*args)
+
+
+def make_password(password, hasher=None):
+    """
+    Returns the password hashed by the hasher of the configuration to be
+    stored
+    """
+    return run_throttled((hasher or get_hasher()).hash, password)
+
+
+def check_password(password, encoded, salt=None):
+    """
+    Checks a password against its stored hash
+
+    :param salt: The salt of the user, for the passwords stored without an
+                 algorithm
+    """
+    if not encoded:
+        return False
+    try:
+        hasher = identify_hasher(encoded)
+    except (KeyError, ValueError):
+        return False
+    return run_throttled(hasher.verify, password, encoded, salt)
+
+
+def needs_rehash(encoded, hasher=None):
+    """
+    Returns True if the stored password was not made by the hasher of the
+    configuration with its current cost
+    """
+    return (hasher or get_hasher()).needs_rehash(encoded)
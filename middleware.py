@@ -0,0 +1,187 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import time
+from collections import Counter
+from threading import Lock
+
+from werkzeug.exceptions import NotFound
+from werkzeug.urls import url_join
+from werkzeug.utils import redirect
+from werkzeug.wsgi import get_current_url
+
+from trytond.pool import Pool
+
+from .routing import use_compiled_url_maps, get_app_url_map, \
+    get_environ_website_name, WEBSITE_ENVIRON_KEY
+
+__all__ = ['RedirectMiddleware', 'SiteDispatcher']
+
+
+class RedirectMiddleware(object):
+    """
+    A WSGI middleware which answers the requests to the exact paths of the
+    redirect rules of a website from a precompiled table, before they reach
+    the routing of the application. Only the HTTP methods of the rule are
+    redirected::
+
+        app.wsgi_app = RedirectMiddleware(app)
+
+    The tables are the ones cached by :meth:`WebSite.get_redirect_table`,
+    which follow the changes of the rules. Hosts which are not the name of
+    a website of the application have no redirects. The number of hits of
+    every redirect is counted so that the ones never used can be pruned.
+
+    :param app: The nereid application
+    :param wsgi_app: The WSGI application to call for the other requests.
+                     Defaults to the `wsgi_app` of the application.
+    """
+
+    def __init__(self, app, wsgi_app=None):
+        self.app = app
+        self.wsgi_app = wsgi_app or app.wsgi_app
+
+        #: (Website name, path): number of redirects served
+        self.hits = Counter()
+        self.lock = Lock()
+
+    def get_table(self, website_name):
+        """
+        Returns the redirect table of the website, or an empty table if
+        there is no such website
+        """
+        if not self.app.initialised:
+            self.app.initialise()
+
+        website = self.app.websites.get(website_name)
+        if website is None:
+            return {}
+        with self.app.root_transaction:
+            Website = Pool().get('nereid.website')
+            return Website(website['id']).get_redirect_table()
+
+    def get_unused_redirects(self, website_name):
+        """
+        Returns the paths of the redirect table of a website which were
+        never requested since the middleware started
+        """
+        return sorted(
+            path for path in self.get_table(website_name)
+            if not self.hits[(website_name, path)]
+        )
+
+    def __call__(self, environ, start_response):
+        website_name = get_environ_website_name(environ)
+        path = environ.get('PATH_INFO') or '/'
+        if isinstance(path, str):
+            path = path.decode('utf-8', 'replace')
+
+        entry = self.get_table(website_name).get(path)
+        method = environ.get('REQUEST_METHOD', 'GET').upper()
+        if entry is None or method not in entry[1]:
+            # Requests with another method are left to the rules which
+            # answer it, or to the 405 response of the routing
+            return self.wsgi_app(environ, start_response)
+
+        target = entry[0]
+        with self.lock:
+            self.hits[(website_name, path)] += 1
+        location = url_join(get_current_url(environ, root_only=True), target)
+        return redirect(location, 301)(environ, start_response)
+
+
+class SiteDispatcher(object):
+    """
+    A WSGI middleware which lets a single nereid application serve all the
+    websites of the database, instead of running one application per
+    website::
+
+        app.wsgi_app = SiteDispatcher(app)
+
+    The website is selected by the Host header from the table returned by
+    :meth:`WebSite.get_host_table`, which has the names of the websites and
+    their default subdomains. With `match_subdomains`, hosts which are not
+    in the table are looked up again without their leftmost label, so that
+    any subdomain of a website is served by it. The name of the website is
+    set in the `nereid.website` environ key, read by the request and the
+    URL adapter, and the Host header is left alone so that the absolute
+    URLs of the responses keep the host of the request. The transaction of
+    a request is opened by nereid from its Host alone, so the application
+    resolves it through the table of the dispatcher as well.
+
+    The application is set up to match the requests with the compiled URL
+    maps of the websites (see :func:`routing.use_compiled_url_maps`), and
+    the maps of all websites are compiled along with the table, so that
+    they are warm before the first request to each site.
+
+    :param app: The nereid application
+    :param wsgi_app: The WSGI application to dispatch to. Defaults to the
+                     `wsgi_app` of the application.
+    :param refresh_interval: Seconds after which the table is reloaded
+    :param match_subdomains: True to serve any subdomain of a website by it
+    """
+
+    def __init__(self, app, wsgi_app=None, refresh_interval=300,
+                 match_subdomains=False):
+        self.app = use_compiled_url_maps(app)
+        self.wsgi_app = wsgi_app or app.wsgi_app
+        self.refresh_interval = refresh_interval
+        self.match_subdomains = match_subdomains
+
+        self.app_transaction = app.transaction
+        app.transaction = self.transaction
+
+        #: (time of loading, host table)
+        self.hosts = None
+
+    def load_hosts(self):
+        """
+        Load the host table and warm the URL maps of all websites
+        """
+        if not self.app.initialised:
+            self.app.initialise()
+
+        with self.app.root_transaction:
+            Website = Pool().get('nereid.website')
+            for website in Website.search([]):
+                get_app_url_map(self.app, website)
+            return Website.get_host_table()
+
+    def get_hosts(self):
+        """
+        Returns the host table, loading it if it is not loaded yet or is
+        older than the refresh interval
+        """
+        loaded = self.hosts
+        if loaded is None or \
+                time.time() - loaded[0] > self.refresh_interval:
+            loaded = self.hosts = (time.time(), self.load_hosts())
+        return loaded[1]
+
+    def get_website_name(self, host):
+        """
+        Returns the name of the website serving the host or None
+        """
+        hosts = self.get_hosts()
+        host = host.split(':')[0].lower()
+        if not self.match_subdomains:
+            return hosts.get(host)
+        while host:
+            if host in hosts:
+                return hosts[host]
+            host = host.partition('.')[2]
+        return None
+
+    def transaction(self, http_host):
+        """
+        The `transaction` of the application, which opens the transaction of
+        the website of the host
+        """
+        return self.app_transaction(self.get_website_name(http_host) or '')
+
+    def __call__(self, environ, start_response):
+        website_name = self.get_website_name(environ.get('HTTP_HOST', ''))
+        if website_name is None:
+            return NotFound()(environ, start_response)
+
+        environ[WEBSITE_ENVIRON_KEY] = website_name
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,250 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import time
+import logging
+import smtplib
+from datetime import datetime, timedelta
+from threading import Lock
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from trytond.tools import get_smtp_server
+
+__all__ = ['EmailOutbox']
+
+logger = logging.getLogger('nereid.email.outbox')
+
+#: Counters of the deliveries of this process, see
+#: :meth:`EmailOutbox.get_metrics`
+_metrics = {
+    'sent': 0,
+    'retried': 0,
+    'failed': 0,
+    'connections': 0,
+    'seconds': 0.0,
+}
+_metrics_lock = Lock()
+
+
+class EmailOutbox(ModelSQL, ModelView):
+    """
+    Emails waiting to be sent
+
+    The emails of the users (activation, password reset, ...) are queued
+    here during the request and sent by a cron job in batches over a single
+    SMTP connection. Failed deliveries are tried again later, waiting twice
+    as long after every attempt.
+
+    The delivery is tuned in the tryton configuration with
+    `nereid_email_batch_size` (100 emails per batch by default),
+    `nereid_email_max_attempts` (5) and `nereid_email_retry_delay`
+    (60 seconds before the first retry).
+    """
+    __name__ = 'nereid.email.outbox'
+
+    from_addr = fields.Char('From', required=True, readonly=True)
+    to_addrs = fields.Char('To', required=True, readonly=True)
+    message = fields.Text('Message', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True, select=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(EmailOutbox, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': ~Eval('state').in_(['failed']),
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def enqueue(cls, from_addr, to_addrs, message):
+        """
+        Queue an email to be sent by the cron job
+
+        :param from_addr: The sender of the email
+        :param to_addrs: The list of recipients
+        :param message: The email message (an email.message.Message or its
+                        string)
+        """
+        if not isinstance(message, basestring):
+            message = message.as_string()
+        email, = cls.create([{
+            'from_addr': from_addr,
+            'to_addrs': ','.join(to_addrs),
+            'message': message,
+        }])
+        return email
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, emails):
+        "Send the failed emails again"
+        cls.write(emails, {
+            'state': 'pending',
+            'attempts': 0,
+            'next_attempt': None,
+        })
+
+    @classmethod
+    def get_batch(cls, size):
+        "Returns the pending emails which are due"
+        return cls.search([
+            ('state', '=', 'pending'),
+            ['OR',
+                ('next_attempt', '=', None),
+                ('next_attempt', '<=', datetime.utcnow()),
+            ],
+        ], limit=size)
+
+    @classmethod
+    def send_pending(cls, max_batches=None, commit=True):
+        """
+        Send the pending emails in batches over one SMTP connection, which
+        is opened again only if the server drops it. This is the method
+        called by the cron job.
+
+        The transaction is committed after each batch, so that the emails
+        delivered are recorded as sent even if a later batch fails.
+
+        :param max_batches: The number of batches to send at most. All the
+                            pending emails are sent by default.
+        :param commit: False to leave the transaction to the caller
+        """
+        batch_size = int(CONFIG.options.get('nereid_email_batch_size', 100))
+        start = time.time()
+        server = None
+        batches = 0
+        try:
+            while max_batches is None or batches < max_batches:
+                emails = cls.get_batch(batch_size)
+                if not emails:
+                    break
+                if server is None:
+                    server = cls._connect()
+                server = cls.send_batch(server, emails)
+                if commit:
+                    Transaction().cursor.commit()
+                batches += 1
+        finally:
+            if server is not None:
+                try:
+                    server.quit()
+                except smtplib.SMTPException:
+                    pass
+            with _metrics_lock:
+                _metrics['seconds'] += time.time() - start
+
+    @staticmethod
+    def _connect():
+        with _metrics_lock:
+            _metrics['connections'] += 1
+        return get_smtp_server()
+
+    @classmethod
+    def send_batch(cls, server, emails):
+        """
+        Send the emails over the server and record the outcome of each of
+        them
+
+        :return: The server to use for the next batch, which is a new
+                 connection if the server disconnected
+        """
+        sent = []
+        retried = failed = 0
+        for email in emails:
+            try:
+                try:
+                    cls._send(server, email)
+                except smtplib.SMTPServerDisconnected:
+                    server = cls._connect()
+                    cls._send(server, email)
+            except (smtplib.SMTPException, IOError), exception:
+                logger.warning(
+                    'Sending email %s failed: %s', email.id, exception
+                )
+                values = cls._get_failure_values(email, unicode(exception))
+                if values.get('state') == 'failed':
+                    failed += 1
+                else:
+                    retried += 1
+                cls.write([email], values)
+            else:
+                sent.append(email)
+
+        if sent:
+            cls.write(sent, {
+                'state': 'sent',
+                'sent_date': datetime.utcnow(),
+                'next_attempt': None,
+            })
+        with _metrics_lock:
+            _metrics['sent'] += len(sent)
+            _metrics['retried'] += retried
+            _metrics['failed'] += failed
+        return server
+
+    @staticmethod
+    def _send(server, email):
+        message = email.message
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        server.sendmail(email.from_addr, email.to_addrs.split(','), message)
+
+    @staticmethod
+    def _get_max_attempts():
+        return int(CONFIG.options.get('nereid_email_max_attempts', 5))
+
+    @classmethod
+    def _get_failure_values(cls, email, error):
+        """
+        Returns the values to write on an email which could not be sent:
+        it is tried again later with an exponential backoff, until it
+        failed too many times.
+        """
+        attempts = email.attempts + 1
+        if attempts >= cls._get_max_attempts():
+            return {
+                'state': 'failed',
+                'attempts': attempts,
+                'last_error': error,
+                'next_attempt': None,
+            }
+        delay = int(CONFIG.options.get('nereid_email_retry_delay', 60))
+        return {
+            'attempts': attempts,
+            'last_error': error,
+            'next_attempt': datetime.utcnow() + timedelta(
+                seconds=delay * 2 ** (attempts - 1)
+            ),
+        }
+
+    @staticmethod
+    def get_metrics():
+        """
+        Returns the counters of the deliveries of this process and the
+        number of emails sent per second while sending
+        """
+        with _metrics_lock:
+            metrics = dict(_metrics)
+        metrics['throughput'] = metrics['seconds'] and \
+            metrics['sent'] / metrics['seconds']
+        return metrics
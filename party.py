@@ -1,14 +1,11 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-import random
-import string
+import time
 import urllib
-
-try:
-    import hashlib
-except ImportError:
-    hashlib = None
-    import sha
+import logging
+import hashlib
+from datetime import datetime
+from itertools import count
 
 import pytz
 from wtforms import Form, TextField, IntegerField, SelectField, validators, \
@@ -26,15 +23,28 @@ from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool, Not
 from trytond.transaction import Transaction
 from trytond.config import CONFIG
-from trytond.tools import get_smtp_server
+from trytond.cache import Cache
 from trytond import backend
 from sql import As, Literal, Column
+from sql.functions import Lower
+from sql.aggregate import Count
+from sql.conditionals import Case
 
 from .i18n import _, get_translations
+from .caching import request_records, request_user
+from . import hashers
 
 __all__ = ['Address', 'Party', 'NereidUser',
            'ContactMechanism', 'Permission', 'UserPermission']
 
+logger = logging.getLogger('nereid.user')
+
+#: Source of the versions of the permissions of this process
+_permissions_versions = count(1)
+
+#: Seconds during which logins with an unknown email are not looked up
+UNKNOWN_EMAIL_TTL = int(CONFIG.options.get('nereid_login_negative_ttl', 60))
+
 
 class RegistrationForm(Form):
     "Simple Registration form"
@@ -138,16 +148,22 @@ class Address:
         """
         pool = Pool()
         ContactMechanism = pool.get('party.contact_mechanism')
-        form = AddressForm(request.form, name=request.nereid_user.display_name)
+        records = request_records()
+        party = records.related(request.nereid_user, 'party')
+        form = AddressForm(
+            request.form,
+            name=records.related(request.nereid_user, 'display_name')
+        )
         countries = [
-            (c.id, c.name) for c in request.nereid_website.countries
+            (c.id, c.name)
+            for c in request.nereid_website.get_snapshot().countries
         ]
         form.country.choices = countries
-        if address not in (a.id for a in request.nereid_user.party.addresses):
+        if address not in (
+                a.id for a in records.related(party, 'addresses')):
             address = None
         if request.method == 'POST' and form.validate():
             mechanisms_create = []
-            party = request.nereid_user.party
             if address is not None:
                 address = cls(address)
                 cls.write([address], {
@@ -170,6 +186,7 @@ class Address:
                     'subdivision': form.subdivision.data,
                     'party': party.id,
                 }])
+                records.forget(party, 'addresses')
             if form.email.data:
                 contact_mechanisms = ContactMechanism.search([
                         ('address', '=', address.id),
@@ -181,7 +198,7 @@ class Address:
                         })
                 else:
                     mechanisms_create.append({
-                        'party': request.nereid_user.party.id,
+                        'party': party.id,
                         'address': address.id,
                         'type': 'email',
                         'value': form.email.data,
@@ -197,7 +214,7 @@ class Address:
                         })
                 else:
                     mechanisms_create.append({
-                        'party': request.nereid_user.party.id,
+                        'party': party.id,
                         'address': address.id,
                         'type': 'phone',
                         'value': form.phone.data,
@@ -235,6 +252,17 @@ class Party(ModelSQL, ModelView):
 
     nereid_users = fields.One2Many('nereid.user', 'party', 'Nereid Users')
 
+    @classmethod
+    def write(cls, parties, values):
+        rv = super(Party, cls).write(parties, values)
+        if 'name' in values:
+            # Only the name is kept in the guest user snapshot
+            WebSite = Pool().get('nereid.website')
+            guest_parties = set(WebSite.get_guest_users().values())
+            if guest_parties.intersection(p.id for p in parties):
+                WebSite.clear_website_cache()
+        return rv
+
 
 class ProfileForm(Form):
     """User Profile Form"""
@@ -270,17 +298,20 @@ class NereidUser(ModelSQL, ModelView):
     #: The email of the user is also the login name/username of the user
     email = fields.Char("e-Mail", select=1)
 
-    #: The password is the user password + the salt, which is
-    #: then hashed together
-    password = fields.Sha('Password')
+    #: The password hashed by the hasher of the configuration, see
+    #: :mod:`hashers`. Passwords set before hashers were introduced are the
+    #: SHA-1 of the password and the salt.
+    password = fields.Char('Password')
 
-    #: The salt which was used to make the hash is separately
-    #: stored. Needed for
+    #: The salt of the passwords hashed with SHA-1 before hashers were
+    #: introduced. Hashers keep their salt in the password.
     salt = fields.Char('Salt', size=8)
 
-    #: A unique activation code required to match the user's request
-    #: for activation of the account.
-    activation_code = fields.Char('Unique Activation Code')
+    #: The code of the latest valid token of the user, see
+    #: :class:`user_token.NereidUserToken`
+    activation_code = fields.Function(
+        fields.Char('Unique Activation Code'), 'get_activation_code'
+    )
 
     # The company of the website(s) to which the user is affiliated. This
     # allows websites of the same company to share authentication/users. It
@@ -300,13 +331,93 @@ class NereidUser(ModelSQL, ModelView):
         'nereid_user', 'permission', 'Permissions'
     )
 
+    #: (company, lower email) of the logins without user: expiry time
+    _unknown_emails_cache = Cache('nereid.user.unknown_emails', context=False)
+
+    #: Fields copied into the guest user snapshot of the websites
+    _guest_snapshot_fields = (
+        'display_name', 'email', 'party', 'company', 'timezone'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(NereidUser, cls).__register__(module_name)
+        cursor = Transaction().cursor
+
+        # Logins look the users up by company and case-insensitive email,
+        # which is unique in a company
+        index_name = cls._email_index_name()
+        old_index_name = '%s_company_lower_email_index' % cls._table
+        if backend.name() not in ('postgresql', 'sqlite'):
+            return
+        if backend.name() == 'postgresql':
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index_name,)
+            )
+            if cursor.fetchone():
+                return
+        table = cls.__table__()
+        cursor.execute(*table.select(
+            table.company, Lower(table.email),
+            group_by=[table.company, Lower(table.email)],
+            having=Count(Literal(1)) > 1,
+            limit=1
+        ))
+        if cursor.fetchone():
+            logger.warning(
+                'Emails of %s differ only by their case, their unique '
+                'index is not created' % cls._table
+            )
+            return
+        cursor.execute(
+            'CREATE UNIQUE INDEX %s "%s" ON "%s" (company, lower(email))' % (
+                'IF NOT EXISTS' if backend.name() == 'sqlite' else '',
+                index_name, cls._table
+            )
+        )
+        cursor.execute('DROP INDEX IF EXISTS "%s"' % old_index_name)
+
+    @classmethod
+    def _email_index_name(cls):
+        "Returns the name of the unique (company, lower(email)) index"
+        return '%s_company_lower_email_unique' % cls._table
+
+    def get_permissions_mask(self):
+        """
+        Returns the permissions of the user as an integer with the bit of
+        each permission set (see :meth:`Permission.get_bits`). The mask is
+        cached for each user until the permissions change.
+        """
+        Permission = Pool().get('nereid.permission')
+        UserPermission = Pool().get('nereid.permission-nereid.user')
+
+        key = ('mask', self.id, Permission.get_permissions_version())
+        mask = Permission._permissions_cache.get(key)
+        if mask is None:
+            cursor = Transaction().cursor
+            user_permission = UserPermission.__table__()
+            cursor.execute(*user_permission.select(
+                user_permission.permission,
+                where=user_permission.nereid_user == self.id
+            ))
+            mask = 0
+            for permission_id, in cursor.fetchall():
+                mask |= 1 << permission_id
+            Permission._permissions_cache.set(key, mask)
+        return mask
+
     def get_permissions(self):
         """
         Returns all the permissions as a list of names
         """
-        # TODO: Cache this value for each user to avoid hitting the database
-        # everytime.
-        return frozenset([p.value for p in self.permissions])
+        Permission = Pool().get('nereid.permission')
+
+        mask = self.get_permissions_mask()
+        return frozenset([
+            value for value, bit in Permission.get_bits().iteritems()
+            if mask & bit
+        ])
 
     def has_permissions(self, perm_all=None, perm_any=None):
         """Check if the user has all required permissions in perm_all and
@@ -320,18 +431,78 @@ class NereidUser(ModelSQL, ModelView):
         if not perm_all and not perm_any:
             # Access allowed if no permission is required
             return True
-        if not isinstance(perm_all, (set, frozenset)):
-            perm_all = frozenset(perm_all if perm_all else [])
-        if not isinstance(perm_any, (set, frozenset)):
-            perm_any = frozenset(perm_any if perm_any else [])
-        current_user_permissions = self.get_permissions()
-
-        if perm_all and not perm_all.issubset(current_user_permissions):
-            return False
-        if perm_any and not perm_any.intersection(current_user_permissions):
-            return False
+        return self._match_permissions(
+            self.get_permissions_mask(), perm_all, perm_any
+        )
+
+    @staticmethod
+    def _match_permissions(mask, perm_all=None, perm_any=None):
+        """
+        Check a permission mask against the required permission values
+        """
+        Permission = Pool().get('nereid.permission')
+
+        if perm_all:
+            mask_all = Permission.get_mask(perm_all)
+            if mask_all is None or mask & mask_all != mask_all:
+                return False
+        if perm_any:
+            mask_any = Permission.get_mask(perm_any, ignore_unknown=True)
+            if not mask & mask_any:
+                return False
         return True
 
+    @classmethod
+    def has_permissions_many(cls, users, perm_all=None, perm_any=None):
+        """Check :meth:`has_permissions` for many users at once. The
+        permissions of the users are loaded with a single grouped query
+        (one per chunk of users and of permissions when there are more
+        than the database accepts in a query).
+
+        :param users: A list of users or of their ids
+        :param perm_all: A set/frozenset of all permission values/keywords.
+        :param perm_any: A set/frozenset of any permission values/keywords.
+
+        :return: A dictionary of the user ids to True/False
+        """
+        Permission = Pool().get('nereid.permission')
+        UserPermission = Pool().get('nereid.permission-nereid.user')
+
+        user_ids = map(int, users)
+        if not perm_all and not perm_any:
+            return dict.fromkeys(user_ids, True)
+
+        # Only the required permissions need to be loaded
+        ids = Permission.get_ids()
+        permission_ids = [
+            ids[value] for value in set(perm_all or []) | set(perm_any or [])
+            if value in ids
+        ]
+
+        masks = dict.fromkeys(user_ids, 0)
+        if permission_ids:
+            cursor = Transaction().cursor
+            table = UserPermission.__table__()
+            # The permissions take at most half of the ids of a query
+            permissions_max = max(cursor.IN_MAX // 2, 1)
+            for j in range(0, len(permission_ids), permissions_max):
+                sub_permission_ids = permission_ids[j:j + permissions_max]
+                in_max = max(cursor.IN_MAX - len(sub_permission_ids), 1)
+                for i in range(0, len(user_ids), in_max):
+                    cursor.execute(*table.select(
+                        table.nereid_user, table.permission,
+                        where=table.nereid_user.in_(user_ids[i:i + in_max])
+                        & table.permission.in_(sub_permission_ids),
+                        group_by=[table.nereid_user, table.permission]
+                    ))
+                    for user_id, permission_id in cursor.fetchall():
+                        masks[user_id] |= 1 << permission_id
+
+        return dict(
+            (user_id, cls._match_permissions(mask, perm_all, perm_any))
+            for user_id, mask in masks.iteritems()
+        )
+
     @staticmethod
     def default_timezone():
         return "UTC"
@@ -347,6 +518,34 @@ class NereidUser(ModelSQL, ModelView):
             ('unique_email_company', 'UNIQUE(email, company)',
                 'Email must be unique in a company'),
         ]
+        # The violations of the index made by __register__ are user errors
+        cls._sql_error_messages.update({
+            cls._email_index_name(): 'Email must be unique in a company, '
+            'whatever its case',
+        })
+
+    @classmethod
+    def search_email(cls, email, company):
+        """
+        Returns the users of the company with the email, ignoring its case.
+        The lookup uses the (company, lower(email)) index.
+        """
+        if not email:
+            return []
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(
+            table.id,
+            where=(table.company == company)
+            & (Lower(table.email) == email.lower())
+        ))
+        return cls.browse([row[0] for row in cursor.fetchall()])
+
+    @classmethod
+    def get_activation_code(cls, users, name):
+        Token = Pool().get('nereid.user.token')
+
+        return Token.get_codes([u.id for u in users])
 
     def _activate(self, activation_code):
         """
@@ -357,11 +556,13 @@ class NereidUser(ModelSQL, ModelView):
             not valid.
 
         :param activation_code: The activation code used
-        :return: True if the activation code was correct
+        :return: The type of the token of the code, 'activation' or 'reset'
         """
-        assert self.activation_code == activation_code, \
-            'Invalid Activation Code'
-        return self.write([self], {'activation_code': None})
+        Token = Pool().get('nereid.user.token')
+
+        type_ = Token.consume(self.id, activation_code)
+        assert type_ is not None, 'Invalid Activation Code'
+        return type_
 
     @staticmethod
     def get_registration_form():
@@ -395,11 +596,8 @@ class NereidUser(ModelSQL, ModelView):
         registration_form = cls.get_registration_form()
 
         if request.method == 'POST' and registration_form.validate():
-            existing = cls.search([
-                ('email', '=', request.form['email']),
-                ('company', '=', request.nereid_website.company.id),
-            ]
-            )
+            company = request.nereid_website.get_snapshot().company
+            existing = cls.search_email(request.form['email'], company)
             if existing:
                 flash(_(
                     'A registration already exists with this email. '
@@ -414,7 +612,7 @@ class NereidUser(ModelSQL, ModelView):
                     'display_name': registration_form.name.data,
                     'email': registration_form.email.data,
                     'password': registration_form.password.data,
-                    'company': request.nereid_website.company.id,
+                    'company': company,
                 }
                 )
                 nereid_user.save()
@@ -432,7 +630,7 @@ class NereidUser(ModelSQL, ModelView):
 
     def send_activation_email(self):
         """
-        Send an activation email to the user
+        Queue an activation email to the user in the email outbox
 
         :param nereid_user: The browse record of the user
         """
@@ -442,11 +640,8 @@ class NereidUser(ModelSQL, ModelView):
             html_template='emails/activation-html.jinja',
             nereid_user=self
         )
-        server = get_smtp_server()
-        server.sendmail(
-            CONFIG['smtp_from'], [self.email], email_message.as_string()
-        )
-        server.quit()
+        EmailOutbox = Pool().get('nereid.email.outbox')
+        EmailOutbox.enqueue(CONFIG['smtp_from'], [self.email], email_message)
 
     @classmethod
     @login_required
@@ -519,23 +714,25 @@ class NereidUser(ModelSQL, ModelView):
     def activate(self, activation_code):
         """A web request handler for activation
 
-        :param activation_code: A 12 character activation code indicates reset
-            while 16 character activation code indicates a new registration
+        :param activation_code: The code of an activation or reset token
         """
         try:
-            self._activate(activation_code)
+            type_ = self._activate(activation_code)
         except AssertionError:
             flash(_('Invalid Activation Code'))
         else:
-            # Log the user in since the activation code is correct
+            # Log the user in since the activation code is correct. A reset
+            # code proves the email as well and activates the account.
+            Token = Pool().get('nereid.user.token')
+            Token.clear([self.id], 'activation')
             session['user'] = self.id
 
             # Redirect the user to the correct location according to the type
             # of activation code.
-            if len(activation_code) == 12:
+            if type_ == 'reset':
                 session['allow_new_password'] = True
                 return redirect(url_for('nereid.user.new_password'))
-            elif len(activation_code) == 16:
+            elif type_ == 'activation':
                 flash(_('Your account has been activated'))
                 return redirect(url_for('nereid.website.home'))
 
@@ -544,20 +741,19 @@ class NereidUser(ModelSQL, ModelView):
     def create_act_code(self, code_type="new"):
         """Create activation code
 
-        A 12 character activation code indicates reset while 16
-        character activation code indicates a new registration
+        The code is stored as a token of the user, which replaces the
+        previous token of the same type.
 
-        :param user_id: ID of the User
         :param code_type:   "new" for new activation code
                             "reset" for resetting existing account
+        :return: The code
         """
-        assert code_type in ("new", "reset")
-        length = 16 if code_type == "new" else 12
+        Token = Pool().get('nereid.user.token')
 
-        act_code = ''.join(
-            random.sample(string.letters + string.digits, length)
+        assert code_type in ("new", "reset")
+        return Token.issue(
+            self.id, code_type == "new" and 'activation' or 'reset'
         )
-        return self.write([self], {'activation_code': act_code})
 
     @classmethod
     def reset_account(cls):
@@ -570,12 +766,8 @@ class NereidUser(ModelSQL, ModelView):
             the link, he can change his password.
         """
         if request.method == 'POST':
-            user_ids = cls.search(
-                [
-                    ('email', '=', request.form['email']),
-                    ('company', '=', request.nereid_website.company.id),
-                ]
-            )
+            company = request.nereid_website.get_snapshot().company
+            user_ids = cls.search_email(request.form['email'], company)
 
             if not user_ids or not request.form['email']:
                 flash(_('Invalid email address'))
@@ -593,7 +785,7 @@ class NereidUser(ModelSQL, ModelView):
 
     def send_reset_email(self):
         """
-        Send an account reset email to the user
+        Queue an account reset email to the user in the email outbox
 
         :param nereid_user: The browse record of the user
         """
@@ -603,11 +795,8 @@ class NereidUser(ModelSQL, ModelView):
             html_template='emails/reset-html.jinja',
             nereid_user=self
         )
-        server = get_smtp_server()
-        server.sendmail(
-            CONFIG['smtp_from'], [self.email], email_message.as_string()
-        )
-        server.quit()
+        EmailOutbox = Pool().get('nereid.email.outbox')
+        EmailOutbox.enqueue(CONFIG['smtp_from'], [self.email], email_message)
 
     def match_password(self, password):
         """
@@ -616,14 +805,61 @@ class NereidUser(ModelSQL, ModelView):
         :param password: The password of the user (string or unicode)
         :return: True or False
         """
-        password += self.salt or ''
-        if isinstance(password, unicode):
-            password = password.encode('utf-8')
-        if hashlib:
-            digest = hashlib.sha1(password).hexdigest()
-        else:
-            digest = sha.new(password).hexdigest()
-        return (digest == self.password)
+        return self.check_password(password, self.password, self.salt)
+
+    @staticmethod
+    def check_password(password, hashed, salt):
+        """
+        Checks if 'password' matches the stored hash and salt of a user.
+
+        :param password: The password of the user (string or unicode)
+        :param hashed: The stored hash of the password
+        :param salt: The stored salt of the password
+        :return: True or False
+        """
+        return hashers.check_password(password, hashed, salt)
+
+    @classmethod
+    def get_login_row(cls, email, company):
+        """
+        Returns the id, password, salt, activation code and its expiry of
+        the users of the company with the email, ignoring its case. The
+        lookup is a single query on the (company, lower(email)) index,
+        joined to the activation tokens of the users, whose accounts are not
+        activated.
+
+        Emails without any user are remembered for a few seconds
+        (`nereid_login_negative_ttl` in the tryton configuration, 60 by
+        default), so that bursts of attempts with unknown emails do not
+        reach the database.
+        """
+        email = email.lower()
+        key = (company, email)
+        expiry = cls._unknown_emails_cache.get(key)
+        if expiry is not None and expiry > time.time():
+            return []
+
+        Token = Pool().get('nereid.user.token')
+
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        token = Token.__table__()
+        query = table.join(
+            token, 'LEFT',
+            condition=(token.nereid_user == table.id)
+            & (token.type == 'activation')
+        )
+        cursor.execute(*query.select(
+            table.id, table.password, table.salt, token.code, token.expires,
+            where=(table.company == company)
+            & (Lower(table.email) == email)
+        ))
+        rows = cursor.fetchall()
+        if not rows:
+            cls._unknown_emails_cache.set(
+                key, time.time() + UNKNOWN_EMAIL_TTL
+            )
+        return rows
 
     @classmethod
     def authenticate(cls, email, password):
@@ -637,48 +873,147 @@ class NereidUser(ModelSQL, ModelView):
             None: User cannot be found or wrong password
             False: Account is inactive
         """
+        rows = cls.get_login_row(
+            email, request.nereid_website.get_snapshot().company
+        )
 
-        users = cls.search([
-            ('email', '=', request.form['email']),
-            ('company', '=', request.nereid_website.company.id),
-        ])
-
-        if not users:
+        if not rows:
             current_app.logger.debug("No user with email %s" % email)
             return None
 
-        if len(users) > 1:
+        if len(rows) > 1:
             current_app.logger.debug('%s has too many accounts' % email)
             return None
 
-        user, = users
-        if user.activation_code and len(user.activation_code) == 16:
+        (user_id, hashed, salt, activation_code, expires), = rows
+        if activation_code:
             # A new account with activation pending
             current_app.logger.debug('%s not activated' % email)
-            flash(_("Your account has not been activated yet!"))
+            if expires is not None and expires < datetime.utcnow() and \
+                    cls.check_password(password, hashed, salt):
+                # The link sent at registration expired, which would lock
+                # the account for good: the owner gets a new one
+                user = cls(user_id)
+                user.create_act_code()
+                user.send_activation_email()
+                flash(_(
+                    "Your activation link expired. A new one has been sent "
+                    "to your email"
+                ))
+            else:
+                flash(_("Your account has not been activated yet!"))
             return False  # False so to avoid `invalid credentials` flash
 
-        if user.match_password(password):
+        if cls.check_password(password, hashed, salt):
+            Token = Pool().get('nereid.user.token')
+
+            user = cls(user_id)
             # Reset any reset activation code that might be there since its a
             # successful login with the old password
-            if user.activation_code:
-                cls.write([user], {'activation_code': None})
+            Token.clear([user_id], 'reset')
+            # Store the password again if the hasher or its cost changed
+            if hashers.needs_rehash(hashed):
+                cls.write([user], {'password': password})
             return user
 
         return None
 
+    @classmethod
+    def import_rows(cls, rows, company):
+        """
+        Create the users of the rows with their parties, using one create
+        for all the parties and one for all the users.
+
+        The rows are dictionaries with the `name` of the party, the `email`,
+        the `password`, and optionally the `display_name` (the name by
+        default) and the `timezone` of the user. The passwords must already
+        be hashed with :func:`hashers.make_password`.
+
+        Rows without an email or a name, or whose email is already used by
+        another user of the company (or an earlier row) are not created.
+
+        :param rows: A list of (line number, row) pairs
+        :param company: The id of the company of the users
+        :return: A tuple of the created users and the list of
+                 (line number, error) of the rows not created
+        """
+        Party = Pool().get('party.party')
+
+        failures = []
+        emails = [
+            (row.get('email') or '').lower() for line, row in rows
+        ]
+        existing = set()
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        for i in range(0, len(emails), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                Lower(table.email),
+                where=(table.company == company)
+                & Lower(table.email).in_(emails[i:i + cursor.IN_MAX])
+            ))
+            existing.update(email for email, in cursor.fetchall())
+
+        valid = []
+        for (line, row), email in zip(rows, emails):
+            if not email or not row.get('name') or not row.get('password'):
+                failures.append(
+                    (line, 'A name, an email and a password are required')
+                )
+            elif email in existing:
+                failures.append((line, 'The email %s is already used' % email))
+            else:
+                existing.add(email)
+                valid.append(row)
+        if not valid:
+            return [], failures
+
+        parties = Party.create([{
+            'name': row['name'],
+            'addresses': [],
+        } for row in valid])
+        users = cls.create([{
+            'party': party.id,
+            'display_name': row.get('display_name') or row['name'],
+            'email': row['email'],
+            'timezone': row.get('timezone') or cls.default_timezone(),
+            'company': company,
+        } for party, row in zip(parties, valid)])
+
+        # The hashes are stored as they are, which create and write never
+        # allow since they hash any password they are given. Each update
+        # sets the hashes of many users, with three parameters per user.
+        hashes = [
+            (user.id, row['password']) for user, row in zip(users, valid)
+        ]
+        in_max = max(cursor.IN_MAX // 3, 1)
+        for i in range(0, len(hashes), in_max):
+            sub_hashes = hashes[i:i + in_max]
+            cursor.execute(*table.update(
+                [table.password, table.salt], [
+                    Case(*[
+                        (table.id == user_id, password)
+                        for user_id, password in sub_hashes
+                    ]),
+                    None,
+                ],
+                where=table.id.in_([
+                    user_id for user_id, password in sub_hashes
+                ])
+            ))
+        return users, failures
+
     @staticmethod
     def _convert_values(values):
         """
         A helper method which looks if the password is specified in the values.
-        If it is, then the salt is also made and added
+        If it is, then it is hashed by the hasher of the configuration.
 
         :param values: A dictionary of field: value pairs
         """
         if 'password' in values and values['password']:
-            values['salt'] = ''.join(random.sample(
-                string.ascii_letters + string.digits, 8))
-            values['password'] += values['salt']
+            values['password'] = hashers.make_password(values['password'])
+            values['salt'] = None
 
         return values
 
@@ -690,16 +1025,40 @@ class NereidUser(ModelSQL, ModelView):
         :param vlist: List of dictionary of Values
         """
         vlist = [cls._convert_values(vals.copy()) for vals in vlist]
-        return super(NereidUser, cls).create(vlist)
+        users = super(NereidUser, cls).create(vlist)
+        cls._unknown_emails_cache.clear()
+        return users
 
     @classmethod
     def write(cls, nereid_users, values):
         """
         Update salt before saving
         """
-        return super(NereidUser, cls).write(
+        rv = super(NereidUser, cls).write(
             nereid_users, cls._convert_values(values)
         )
+        if 'email' in values or 'company' in values:
+            cls._unknown_emails_cache.clear()
+        if set(values).intersection(cls._guest_snapshot_fields):
+            WebSite = Pool().get('nereid.website')
+            if set(WebSite.get_guest_users()).intersection(
+                    u.id for u in nereid_users):
+                WebSite.clear_website_cache()
+        return rv
+
+    @classmethod
+    def context_processor(cls):
+        """
+        Register the user of the request as `current_user` in the templates.
+        It is `request.nereid_user` for logged in users and the read only
+        snapshot of the guest user for anonymous requests, see
+        :func:`caching.request_user`. The templates read the records they
+        share with the handlers through `request_records`.
+        """
+        return {
+            'current_user': request_user(),
+            'request_records': request_records(),
+        }
 
     @staticmethod
     def get_gravatar_url(email, **kwargs):
@@ -874,6 +1233,10 @@ class Permission(ModelSQL, ModelView):
         'permission', 'nereid_user', 'Nereid Users'
     )
 
+    #: The bits of the permissions and the permission masks of the users.
+    #: Cleared whenever a permission or the permissions of a user change.
+    _permissions_cache = Cache('nereid.permission', context=False)
+
     @classmethod
     def __setup__(cls):
         super(Permission, cls).__setup__()
@@ -882,6 +1245,91 @@ class Permission(ModelSQL, ModelView):
                 'Permissions must be unique by value'),
         ]
 
+    @classmethod
+    def clear_permissions_cache(cls):
+        "Invalidate the cached permissions and bump the version"
+        cls._permissions_cache.clear()
+
+    @classmethod
+    def get_permissions_version(cls):
+        """
+        Returns a token which changes every time the permissions are
+        invalidated.
+        """
+        version = cls._permissions_cache.get('version')
+        if version is None:
+            version = next(_permissions_versions)
+            cls._permissions_cache.set('version', version)
+        return version
+
+    @classmethod
+    def get_bits(cls):
+        """
+        Returns a dictionary of the value of each permission to its bit in
+        the permission masks of the users. The bit position is the id of
+        the permission, so it never changes.
+        """
+        bits = cls._permissions_cache.get('bits')
+        if bits is None:
+            bits = dict(
+                (value, 1 << permission_id)
+                for value, permission_id in cls.get_ids().iteritems()
+            )
+            cls._permissions_cache.set('bits', bits)
+        return bits
+
+    @classmethod
+    def get_ids(cls):
+        """
+        Returns a dictionary of the value of each permission to its id
+        """
+        ids = cls._permissions_cache.get('ids')
+        if ids is None:
+            cursor = Transaction().cursor
+            table = cls.__table__()
+            cursor.execute(*table.select(table.value, table.id))
+            ids = dict(cursor.fetchall())
+            cls._permissions_cache.set('ids', ids)
+        return ids
+
+    @classmethod
+    def get_mask(cls, values, ignore_unknown=False):
+        """
+        Returns the mask of the bits of the given permission values.
+
+        Permissions which do not exist cannot be held by any user, so None
+        is returned if one of the values is unknown, unless
+        `ignore_unknown` is True in which case they are left out.
+        """
+        bits = cls.get_bits()
+        mask = 0
+        for value in values:
+            bit = bits.get(value)
+            if bit is None:
+                if not ignore_unknown:
+                    return None
+                continue
+            mask |= bit
+        return mask
+
+    @classmethod
+    def create(cls, vlist):
+        permissions = super(Permission, cls).create(vlist)
+        cls.clear_permissions_cache()
+        return permissions
+
+    @classmethod
+    def write(cls, permissions, values):
+        rv = super(Permission, cls).write(permissions, values)
+        cls.clear_permissions_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, permissions):
+        rv = super(Permission, cls).delete(permissions)
+        cls.clear_permissions_cache()
+        return rv
+
 
 class UserPermission(ModelSQL):
     "Nereid User Permissions"
@@ -895,3 +1343,27 @@ class UserPermission(ModelSQL):
         'nereid.user', 'User',
         ondelete='CASCADE', select=True, required=True
     )
+
+    @classmethod
+    def create(cls, vlist):
+        Permission = Pool().get('nereid.permission')
+
+        records = super(UserPermission, cls).create(vlist)
+        Permission.clear_permissions_cache()
+        return records
+
+    @classmethod
+    def write(cls, records, values):
+        Permission = Pool().get('nereid.permission')
+
+        rv = super(UserPermission, cls).write(records, values)
+        Permission.clear_permissions_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, records):
+        Permission = Pool().get('nereid.permission')
+
+        rv = super(UserPermission, cls).delete(records)
+        Permission.clear_permissions_cache()
+        return rv
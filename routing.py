@@ -1,22 +1,159 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
+import json
+import urllib
+import hashlib
+import tempfile
+import types
+import weakref
+from itertools import count
+from threading import Lock
+from collections import namedtuple
 
 import pytz
 from werkzeug import abort, redirect
+from werkzeug.routing import Map, Rule
+from werkzeug.utils import cached_property
 from wtforms import Form, TextField, PasswordField, validators
 
 from nereid import jsonify, flash, render_template, url_for, cache
-from nereid.globals import session, request
-from nereid.helpers import login_required, key_from_list, get_flashed_messages
+from nereid.globals import session, request, current_app
+from nereid.helpers import login_required, key_from_list, \
+    get_flashed_messages, get_website_from_host
 from nereid.signals import login, failed_login, logout
+from nereid.wrappers import Request
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
 
 from .i18n import _
+from .trie import PrefixTrieMap
+from .caching import cache_response, request_records, request_user, \
+    WebsiteCacheMixin
 
 __all__ = ['URLMap', 'WebSite', 'WebSiteLocale', 'URLRule', 'URLRuleDefaults',
-           'WebsiteCountry', 'WebsiteCurrency', 'WebsiteWebsiteLocale']
+           'WebsiteCountry', 'WebsiteCurrency', 'WebsiteWebsiteLocale',
+           'use_compiled_url_maps', 'get_environ_website_name']
+
+#: The boolean fields of a URL rule and the HTTP method each of them enables
+HTTP_METHOD_FIELDS = [
+    ('http_method_get', 'GET'),
+    ('http_method_post', 'POST'),
+    ('http_method_put', 'PUT'),
+    ('http_method_delete', 'DELETE'),
+    ('http_method_patch', 'PATCH'),
+]
+
+#: Source of the version tokens handed out by
+#: :meth:`URLMap.get_rules_version`
+_rules_versions = count(1)
+
+#: Version of the format of the routing snapshot files. Snapshots written
+#: in another format are ignored.
+ROUTING_SNAPSHOT_FORMAT = 1
+
+#: Compiled werkzeug maps of this process, keyed by
+#: (database, website, url_map) and holding (version, map)
+_compiled_url_maps = {}
+_compiled_url_maps_lock = Lock()
+
+#: The environ key of the name of the website of the request, set by
+#: :class:`middleware.SiteDispatcher` for the hosts it resolves
+WEBSITE_ENVIRON_KEY = 'nereid.website'
+
+
+def get_environ_website_name(environ):
+    """
+    Returns the name of the website of the WSGI environ: the one resolved
+    by the site dispatcher, or else the one of the Host
+    """
+    return environ.get(WEBSITE_ENVIRON_KEY) or \
+        get_website_from_host(environ.get('HTTP_HOST', ''))
+
+
+class WebsiteRequest(Request):
+    """
+    The request class of the applications set up by
+    :func:`use_compiled_url_maps`, whose website is the one of
+    :func:`get_environ_website_name`
+    """
+
+    @cached_property
+    def nereid_website(self):
+        Website = current_app.pool.get('nereid.website')
+        return Website.search([
+            ('name', '=', get_environ_website_name(self.environ)),
+        ])[0]
+
+
+def use_compiled_url_maps(app):
+    """
+    Make the application match the requests with the compiled map of the
+    website returned by :meth:`WebSite.get_url_map`, instead of the maps
+    it builds when it is initialised::
+
+        app = use_compiled_url_maps(app)
+
+    Changes to the rules are then served without restarting the
+    application, and the prefix trie of the URL map is used if enabled.
+
+    :param app: The nereid application
+    :return: The application
+    """
+    #: The compiled maps whose view functions are registered
+    app.compiled_url_maps = weakref.WeakSet()
+    app.create_url_adapter = types.MethodType(_create_url_adapter, app)
+    app.request_class = WebsiteRequest
+    return app
+
+
+def get_app_url_map(app, website):
+    """
+    Returns the compiled map of the website for the application, with the
+    static files of the application and the rules prefixed by the
+    language. The view functions of the map are registered on the
+    application the first time it is returned.
+    """
+    url_map = website.get_url_map(
+        rule_class=app.url_rule_class, static_path=app.static_url_path
+    )
+    registered = getattr(app, 'compiled_url_maps', None)
+    if registered is None or url_map in registered:
+        return url_map
+
+    for rule in url_map.iter_rules():
+        rule.provide_automatic_options = True
+        if rule.endpoint == 'static' or rule.build_only or \
+                rule.redirect_to is not None:
+            continue
+        if rule.endpoint not in app.view_functions:
+            app.view_functions[rule.endpoint] = app.get_method(rule.endpoint)
+    registered.add(url_map)
+    return url_map
+
+
+def _create_url_adapter(app, request):
+    """
+    The `create_url_adapter` of the applications set up by
+    :func:`use_compiled_url_maps`. It is called within the transaction of
+    the request.
+    """
+    if request is None:
+        # When the application context is prepared the value of request is
+        # None
+        return None
+
+    Website = Pool().get('nereid.website')
+    website_name = get_environ_website_name(request.environ)
+    website = Website(app.websites[website_name]['id'])
+    return get_app_url_map(app, website).bind_to_environ(
+        request.environ, server_name=app.config['SERVER_NAME']
+    )
 
 
 class URLMap(ModelSQL, ModelView):
@@ -41,6 +178,10 @@ class URLMap(ModelSQL, ModelView):
     :param strict_slashes: Boolean field if / in url map is taken seriously
     :param unique_urls: Enable `redirect_defaults` in the URL Map and
                         redirects the defaults to the URL
+    :param prefix_trie: Match requests with a trie of the static prefixes
+                        of the rules instead of trying every rule. Only
+                        applications set up with
+                        :func:`use_compiled_url_maps` match with it.
     """
     __name__ = "nereid.url_map"
 
@@ -58,8 +199,20 @@ class URLMap(ModelSQL, ModelView):
     charset = fields.Char('Char Set')
     strict_slashes = fields.Boolean('Strict Slashes')
     unique_urls = fields.Boolean('Unique URLs')
+    prefix_trie = fields.Boolean(
+        'Prefix Trie Matching',
+        help="Index the rules by their static prefix, so that matching a "
+        "request depends on the depth of the path and not on the number of "
+        "rules. Useful for maps with thousands of rules. Applies to "
+        "applications set up with use_compiled_url_maps."
+    )
     active = fields.Boolean('Active')
 
+    #: The rule arguments of every URL map and the current version token.
+    #: The cache is cleared when a map, rule or rule default changes and
+    #: tryton propagates the reset to the other workers.
+    _rules_cache = Cache('nereid.url_map.get_rules_arguments', context=False)
+
     @staticmethod
     def default_active():
         "By default URL is active"
@@ -70,16 +223,210 @@ class URLMap(ModelSQL, ModelView):
         "By default characterset is utf-8"
         return 'utf-8'
 
+    @classmethod
+    def clear_rules_cache(cls):
+        """
+        Invalidate the cached rules of all URL maps and bump the version
+        returned by :meth:`get_rules_version`.
+        """
+        cls._rules_cache.clear()
+
+    @classmethod
+    def get_rules_version(cls):
+        """
+        Returns a token which changes every time the rules are invalidated.
+        Compiled maps remember the token they were built with and are
+        rebuilt on the next request once it differs.
+        """
+        version = cls._rules_cache.get('version')
+        if version is None:
+            version = next(_rules_versions)
+            cls._rules_cache.set('version', version)
+        return version
+
+    @classmethod
+    def create(cls, vlist):
+        url_maps = super(URLMap, cls).create(vlist)
+        cls.clear_rules_cache()
+        return url_maps
+
+    @classmethod
+    def write(cls, url_maps, values):
+        WebSite = Pool().get('nereid.website')
+
+        rv = super(URLMap, cls).write(url_maps, values)
+        cls.clear_rules_cache()
+        if 'default_subdomain' in values:
+            WebSite.clear_website_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, url_maps):
+        rv = super(URLMap, cls).delete(url_maps)
+        cls.clear_rules_cache()
+        return rv
+
+    def _get_rules_arguments(self):
+        """
+        Load the rule arguments of the map from the database
+        """
+        URLRule = Pool().get('nereid.url_rule')
+
+        return URLRule.get_rules_arguments_for_map(self.id)
+
     def get_rules_arguments(self):
         """
         Constructs a list of dictionary of arguments needed
         for URL Rule construction. A wrapper around the
             URL RULE get_rule_arguments
+
+        The arguments are cached until the map or its rules change. Since
+        the callers usually pop values out of the dictionaries, a copy is
+        returned every time.
+        """
+        rule_args = self._rules_cache.get(self.id)
+        if rule_args is None:
+            rule_args = self._get_rules_arguments()
+            self._rules_cache.set(self.id, rule_args)
+        return [
+            dict(
+                args, methods=list(args['methods']),
+                defaults=dict(args['defaults'])
+            ) for args in rule_args
+        ]
+
+    def get_rules_stamp(self):
+        """
+        Returns a string which changes whenever the map, one of its rules
+        or one of their defaults is created, written or deleted. It is
+        computed with aggregates and is much cheaper than loading the
+        rules.
+        """
+        pool = Pool()
+        URLRule = pool.get('nereid.url_rule')
+        URLRuleDefaults = pool.get('nereid.url_rule_defaults')
+        url_map = self.__table__()
+        rule = URLRule.__table__()
+        rule_default = URLRuleDefaults.__table__()
+        cursor = Transaction().cursor
+
+        stamp = []
+        for table, query in [
+                (url_map, url_map),
+                (rule, rule),
+                (rule_default, rule_default.join(
+                    rule, condition=rule_default.rule == rule.id
+                )),
+                ]:
+            where = (url_map.id == self.id) if table is url_map \
+                else (rule.url_map == self.id)
+            cursor.execute(*query.select(
+                Count(table.id),
+                Max(Coalesce(table.write_date, table.create_date)),
+                where=where
+            ))
+            stamp.extend(cursor.fetchone())
+        return ':'.join(map(unicode, stamp))
+
+    def get_redirect_table(self):
+        """
+        Returns a dictionary of the exact paths of the redirect rules of the
+        map to their redirect target and the HTTP methods of the rule.
+        Rules with converters in their path are left to the regular routing.
         """
-        rule_args = []
-        for rule in self.rules:
-            rule_args.append(rule.get_rule_arguments())
-        return rule_args
+        key = ('redirects', self.id)
+        table = self._rules_cache.get(key)
+        if table is None:
+            table = {}
+            for url in self.get_rules_arguments():
+                if not url['redirect_to'] or url['build_only'] or \
+                        '<' in url['rule']:
+                    continue
+                methods = set(url['methods'])
+                if 'GET' in methods:
+                    # Like werkzeug, rules answering GET also answer HEAD
+                    methods.add('HEAD')
+                table[url['rule']] = (url['redirect_to'], frozenset(methods))
+            self._rules_cache.set(key, table)
+        return table
+
+    def get_werkzeug_map(self, map_class=None, rule_class=Rule, rules=None):
+        """
+        Build a werkzeug map from the rules of this URL map
+
+        :param map_class: The class of the map to build. Defaults to a
+                          :class:`~trie.PrefixTrieMap` if :attr:`prefix_trie`
+                          is set, else a werkzeug Map.
+        :param rule_class: The class used for every rule
+        :param rules: The rule arguments to use instead of the ones
+                      returned by :meth:`get_rules_arguments`
+        """
+        if map_class is None:
+            map_class = PrefixTrieMap if self.prefix_trie else Map
+        url_map = map_class(
+            default_subdomain=self.default_subdomain or '',
+            charset=self.charset or 'utf-8',
+            strict_slashes=bool(self.strict_slashes),
+            redirect_defaults=bool(self.unique_urls),
+        )
+        if rules is None:
+            rules = self.get_rules_arguments()
+        for url in rules:
+            url_map.add(rule_class(url.pop('rule'), **url))
+        return url_map
+
+
+SnapshotCountry = namedtuple('SnapshotCountry', 'id name')
+SnapshotCurrency = namedtuple('SnapshotCurrency', 'id code name symbol')
+SnapshotLocale = namedtuple('SnapshotLocale', 'id code language currency')
+SnapshotParty = namedtuple('SnapshotParty', 'id name')
+SnapshotUser = namedtuple(
+    'SnapshotUser', 'id display_name email party company timezone'
+)
+
+
+class WebsiteSnapshot(object):
+    """
+    A compact and read only copy of the configuration of a website, built
+    by :meth:`WebSite.get_snapshot`. Related records are stored as named
+    tuples of their ids and display values, so that reading them does not
+    browse any record.
+
+    :param id: ID of the website
+    :param name: Name of the website
+    :param url_map: ID of the URL map
+    :param company: ID of the company
+    :param company_currency: SnapshotCurrency of the company currency
+    :param countries: Tuple of SnapshotCountry
+    :param currencies: Tuple of SnapshotCurrency
+    :param locales: Tuple of SnapshotLocale
+    :param default_locale: SnapshotLocale of the default locale
+    :param guest_user: ID of the guest nereid.user
+    :param application_user: ID of the application res.user
+    :param timezone: Name of the timezone
+    """
+    __slots__ = (
+        'id', 'name', 'url_map', 'company', 'company_currency', 'countries',
+        'currencies', 'locales', 'default_locale', 'guest_user',
+        'application_user', 'timezone',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Website snapshots are read only')
+
+    def __delattr__(self, name):
+        raise AttributeError('Website snapshots are read only')
+
+    def __repr__(self):
+        return '<WebsiteSnapshot %s (%s)>' % (self.id, self.name)
+
+    @property
+    def country_ids(self):
+        return frozenset(c.id for c in self.countries)
 
 
 class LoginForm(Form):
@@ -88,7 +435,7 @@ class LoginForm(Form):
     password = PasswordField(_('Password'), [validators.Required()])
 
 
-class WebSiteLocale(ModelSQL, ModelView):
+class WebSiteLocale(WebsiteCacheMixin, ModelSQL, ModelView):
     'Web Site Locale'
     __name__ = "nereid.website.locale"
     _rec_name = 'code'
@@ -193,47 +540,430 @@ class WebSite(ModelSQL, ModelView):
             ('name_uniq', 'UNIQUE(name)',
              'Another site with the same name already exists!')
         ]
+        cls._buttons.update({
+            'dump_routing_snapshots': {},
+        })
+
+    #: Data derived from the websites, like the table of hosts. Cleared
+    #: whenever a website is created, written or deleted.
+    _website_cache = Cache('nereid.website', context=False)
 
     @classmethod
-    def country_list(cls):
+    def clear_website_cache(cls):
+        "Invalidate the data cached from the websites"
+        cls._website_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        websites = super(WebSite, cls).create(vlist)
+        cls.clear_website_cache()
+        return websites
+
+    @classmethod
+    def write(cls, websites, values):
+        rv = super(WebSite, cls).write(websites, values)
+        cls.clear_website_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, websites):
+        rv = super(WebSite, cls).delete(websites)
+        cls.clear_website_cache()
+        return rv
+
+    def get_snapshot(self):
         """
-        Return the list of countries in JSON
+        Returns a :class:`WebsiteSnapshot` of the website in the language
+        of the transaction. The snapshot is cached until the website, its
+        relations or locales are changed.
         """
-        return jsonify(result=[
-            {'key': c.id, 'value': c.name}
-            for c in request.nereid_website.countries
+        key = ('snapshot', self.id, Transaction().language)
+        snapshot = self._website_cache.get(key)
+        if snapshot is None:
+            snapshot = self._get_snapshot()
+            self._website_cache.set(key, snapshot)
+        return snapshot
+
+    def _get_snapshot(self):
+        """
+        Load the snapshot of the website with a query per model
+        """
+        pool = Pool()
+        Company = pool.get('company.company')
+        Country = pool.get('country.country')
+        Currency = pool.get('currency.currency')
+        Language = pool.get('ir.lang')
+        Locale = pool.get('nereid.website.locale')
+
+        website, = self.read([self.id], [
+            'name', 'url_map', 'company', 'countries', 'currencies',
+            'locales', 'default_locale', 'guest_user', 'application_user',
+            'timezone',
         ])
+        company, = Company.read([website['company']], ['currency'])
+
+        locale_ids = list(website['locales'])
+        if website['default_locale'] not in locale_ids:
+            locale_ids.append(website['default_locale'])
+        locales = Locale.read(locale_ids, ['code', 'language', 'currency'])
+        languages = dict(
+            (l['id'], l['code']) for l in
+            Language.read(list(set(l['language'] for l in locales)), ['code'])
+        )
+        locales = dict(
+            (l['id'], SnapshotLocale(
+                l['id'], l['code'], languages[l['language']], l['currency']
+            )) for l in locales
+        )
+
+        currency_ids = list(website['currencies'])
+        if company['currency'] not in currency_ids:
+            currency_ids.append(company['currency'])
+        currencies = dict(
+            (c['id'], SnapshotCurrency(
+                c['id'], c['code'], c['name'], c['symbol']
+            )) for c in Currency.read(
+                currency_ids, ['code', 'name', 'symbol']
+            )
+        )
+        countries = dict(
+            (c['id'], SnapshotCountry(c['id'], c['name']))
+            for c in Country.read(list(website['countries']), ['name'])
+        )
+
+        return WebsiteSnapshot(
+            id=self.id,
+            name=website['name'],
+            url_map=website['url_map'],
+            company=website['company'],
+            company_currency=currencies[company['currency']],
+            countries=tuple(countries[i] for i in website['countries']),
+            currencies=tuple(currencies[i] for i in website['currencies']),
+            locales=tuple(locales[i] for i in website['locales']),
+            default_locale=locales[website['default_locale']],
+            guest_user=website['guest_user'],
+            application_user=website['application_user'],
+            timezone=website['timezone'],
+        )
+
+    def get_guest_user(self):
+        """
+        Returns a read only :class:`SnapshotUser` of the guest user of the
+        website, with its party as a :class:`SnapshotParty`. It is cached
+        until the website, the guest user or its party are changed, so that
+        anonymous requests do not load any nereid.user record.
+        """
+        key = ('guest_user', self.id)
+        guest_user = self._website_cache.get(key)
+        if guest_user is None:
+            guest_user = self._get_guest_user()
+            self._website_cache.set(key, guest_user)
+        return guest_user
+
+    def _get_guest_user(self):
+        pool = Pool()
+        NereidUser = pool.get('nereid.user')
+        Party = pool.get('party.party')
+
+        user, = NereidUser.read([self.get_snapshot().guest_user], [
+            'display_name', 'email', 'party', 'company', 'timezone',
+        ])
+        party, = Party.read([user['party']], ['name'])
+        return SnapshotUser(
+            id=user['id'],
+            display_name=user['display_name'],
+            email=user['email'],
+            party=SnapshotParty(party['id'], party['name']),
+            company=user['company'],
+            timezone=user['timezone'],
+        )
+
+    @classmethod
+    def get_guest_users(cls):
+        """
+        Returns a dictionary of the ids of the guest users of the websites
+        to the ids of their parties, to find the changes which invalidate
+        :meth:`get_guest_user`
+        """
+        guest_users = cls._website_cache.get('guest_users')
+        if guest_users is None:
+            NereidUser = Pool().get('nereid.user')
+            websites = cls.search([])
+            guest_users = dict(
+                (u['id'], u['party']) for u in NereidUser.read(
+                    list(set(w.guest_user.id for w in websites)), ['party']
+                )
+            )
+            cls._website_cache.set('guest_users', guest_users)
+        return guest_users
+
+    @classmethod
+    def get_host_table(cls):
+        """
+        Returns a dictionary of the host names served to the name of the
+        website serving them. A website serves the host of its name and,
+        if its URL map has a default subdomain, the same host prefixed by
+        that subdomain.
+        """
+        hosts = cls._website_cache.get('hosts')
+        if hosts is None:
+            hosts = {}
+            for website in cls.search([]):
+                name = website.name.lower()
+                hosts[name] = website.name
+                subdomain = website.url_map.default_subdomain
+                if subdomain:
+                    hosts['%s.%s' % (subdomain.lower(), name)] = website.name
+            cls._website_cache.set('hosts', hosts)
+        return hosts
+
+    def get_routing_snapshot_path(self):
+        """
+        Returns the path of the routing snapshot of the website
+
+        <Tryton Data Path>/<Database Name>/nereid/routing/<Website>.json
+        """
+        return os.path.join(
+            CONFIG['data_path'], Transaction().cursor.database_name,
+            'nereid', 'routing', '%s.json' % urllib.quote(self.name, safe='')
+        )
+
+    @classmethod
+    @ModelView.button
+    def dump_routing_snapshots(cls, websites):
+        """
+        Write the routing snapshots of the selected websites
+        """
+        cls.write_routing_snapshots(websites)
+
+    @classmethod
+    def write_routing_snapshots(cls, websites=None):
+        """
+        Serialise the URL rules of the websites (all of them by default)
+        into snapshot files, which workers read at boot instead of loading
+        the rules from the database.
+
+        :return: List of the paths written
+        """
+        if websites is None:
+            websites = cls.search([])
+
+        paths = []
+        for website in websites:
+            path = website.get_routing_snapshot_path()
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # The stamp is read before the rules, so that a change made in
+            # between makes the snapshot stale instead of wrong
+            snapshot = {
+                'format': ROUTING_SNAPSHOT_FORMAT,
+                'url_map': website.url_map.id,
+                'stamp': website.url_map.get_rules_stamp(),
+            }
+            snapshot['rules'] = website.url_map.get_rules_arguments()
+
+            # Write to a temporary file and rename it, so that a worker
+            # booting meanwhile never reads a partial snapshot
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.rename(temp_path, path)
+            paths.append(path)
+        return paths
+
+    def load_routing_snapshot(self):
+        """
+        Returns the rule arguments stored in the routing snapshot of the
+        website, or None if there is no snapshot or if it is older than the
+        last change to the URL map.
+        """
+        try:
+            with open(self.get_routing_snapshot_path(), 'rb') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            return None
+
+        if snapshot.get('format') != ROUTING_SNAPSHOT_FORMAT or \
+                snapshot.get('url_map') != self.url_map.id or \
+                snapshot.get('stamp') != self.url_map.get_rules_stamp():
+            return None
+        return snapshot['rules']
+
+    def get_rules_arguments(self):
+        """
+        Returns the rule arguments of the URL map of the website.
+
+        When the rules of the map are not cached yet, which is the case when
+        a worker boots, they are read from the routing snapshot of the
+        website if it is up to date, falling back to the database.
+        """
+        URLMap = Pool().get('nereid.url_map')
+
+        if URLMap._rules_cache.get(self.url_map.id) is None:
+            rules = self.load_routing_snapshot()
+            if rules is not None:
+                URLMap._rules_cache.set(self.url_map.id, rules)
+        return self.url_map.get_rules_arguments()
 
     @staticmethod
-    def subdivision_list():
+    def _json_response(data, etag):
+        """
+        Returns a JSON response of the serialised data with a strong ETag,
+        which becomes a 304 response if the client already has it.
+        """
+        response = current_app.response_class(
+            data, mimetype='application/json'
+        )
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    def _get_cached_json(self, key, get_result):
+        """
+        Returns the serialised JSON and the ETag of a result, cached in the
+        website cache with the website and the language in the key.
+
+        :param key: Key of the result in the cache
+        :param get_result: A callable returning the result to serialise
+        """
+        key = key + (self.id, Transaction().language)
+        cached = self._website_cache.get(key)
+        if cached is None:
+            data = json.dumps({'result': get_result()})
+            cached = (data, hashlib.md5(data).hexdigest())
+            self._website_cache.set(key, cached)
+        return cached
+
+    @classmethod
+    @cache_response
+    def country_list(cls):
+        """
+        Return the list of countries in JSON
+
+        The JSON is serialised once per website and language and is sent
+        with an ETag, so that clients polling it get a 304 response.
+        """
+        website = request.nereid_website
+
+        def get_countries():
+            return [
+                {'key': c.id, 'value': c.name}
+                for c in website.get_snapshot().countries
+            ]
+        return cls._json_response(
+            *website._get_cached_json(('countries',), get_countries)
+        )
+
+    @classmethod
+    @cache_response
+    def subdivision_list(cls):
         """
         Return the list of states for given country
+
+        The JSON is serialised once per website, country and language and
+        is sent with an ETag, so that clients polling it get a 304 response.
         """
+        website = request.nereid_website
         country = int(request.args.get('country', 0))
-        if country not in [c.id for c in request.nereid_website.countries]:
+        if country not in website.get_snapshot().country_ids:
             abort(404)
 
-        Subdivision = Pool().get('country.subdivision')
-        subdivisions = Subdivision.search([('country', '=', country)])
-        return jsonify(
-            result=[{
+        def get_subdivisions():
+            Subdivision = Pool().get('country.subdivision')
+            return [{
                 'id': s.id,
                 'name': s.name,
                 'code': s.code,
-            } for s in subdivisions
-            ]
+            } for s in Subdivision.search([('country', '=', country)])]
+        return cls._json_response(*website._get_cached_json(
+            ('subdivisions', country), get_subdivisions
+        ))
+
+    def get_url_map(self, map_class=None, rule_class=Rule, static_path=None):
+        """
+        Return the compiled werkzeug map of the website.
+
+        The map is compiled once per process and reused by every request
+        until the rules change, in which case it is compiled again on the
+        next call. Websites sharing a URL map still get their own entry
+        since the key is (database, website, url_map).
+
+        :param static_path: If given, the map is built to serve requests:
+                            a rule for the static files under this path is
+                            added, and every rule is also added prefixed
+                            by the language of each locale of the website,
+                            which `url_for` always passes as `language`.
+        """
+        URLMap = Pool().get('nereid.url_map')
+        snapshot = self.get_snapshot()
+        languages = tuple(sorted(set(l.language for l in snapshot.locales)))
+
+        key = (
+            Transaction().cursor.database_name, self.id, snapshot.url_map,
+            map_class, rule_class, static_path,
+            static_path is not None and languages or None,
         )
+        version = URLMap.get_rules_version()
+        cached = _compiled_url_maps.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        rules = self.get_rules_arguments()
+        if static_path is not None:
+            # The language is a default of the prefixed rules rather than a
+            # converter, so that the prefix trie can index them
+            prefixed = [
+                dict(
+                    url, rule=u'/%s%s' % (language, url['rule']),
+                    defaults=dict(url['defaults'] or {}, language=language)
+                ) for language in languages for url in rules
+            ]
+            rules = [{
+                'rule': static_path + '/<path:filename>',
+                'endpoint': 'static',
+            }] + rules + prefixed
+        url_map = self.url_map.get_werkzeug_map(map_class, rule_class, rules)
+        with _compiled_url_maps_lock:
+            _compiled_url_maps[key] = (version, url_map)
+        return url_map
+
+    def get_redirect_table(self):
+        """
+        Returns the redirect table of the URL map of the website, with the
+        paths also prefixed by the language of every locale of the website,
+        like the rules of :meth:`get_url_map`. Targets which are absolute
+        paths get the same prefix. The table is cached until the rules or
+        the website change.
+        """
+        URLMap = Pool().get('nereid.url_map')
+
+        key = ('redirects', self.id, URLMap.get_rules_version())
+        table = self._website_cache.get(key)
+        if table is not None:
+            return table
+
+        table = {}
+        url_map_table = self.url_map.get_redirect_table()
+        languages = set(l.language for l in self.get_snapshot().locales)
+        for language in languages:
+            for path, (target, methods) in url_map_table.iteritems():
+                if target.startswith('/'):
+                    target = u'/%s%s' % (language, target)
+                table[u'/%s%s' % (language, path)] = (target, methods)
+        table.update(url_map_table)
+        self._website_cache.set(key, table)
+        return table
 
     def get_urls(self, name):
         """
         Return complete list of URLs
         """
-        URLMap = Pool().get('nereid.url_map')
         websites = self.search([('name', '=', name)])
         if not websites:
             raise RuntimeError("Website with Name %s not found" % name)
 
-        return URLMap.get_rules_arguments(websites[0].url_map.id)
+        return websites[0].get_rules_arguments()
 
     def stats(self, **arguments):
         """
@@ -243,6 +973,7 @@ class WebSite(ModelSQL, ModelView):
             % (request, arguments, request.environ)
 
     @classmethod
+    @cache_response
     def home(cls):
         "A dummy home method which just renders home.jinja"
         return render_template('home.jinja')
@@ -311,9 +1042,10 @@ class WebSite(ModelSQL, ModelView):
         rendering my account. Additional modules might want to fill extra
         data into the context
         """
+        user = request_user()
         return dict(
-            user=request.nereid_user,
-            party=request.nereid_user.party,
+            user=user,
+            party=request_records().related(user, 'party'),
         )
 
     @classmethod
@@ -321,6 +1053,45 @@ class WebSite(ModelSQL, ModelView):
     def account(cls):
         return render_template('account.jinja', **cls.account_context())
 
+    @classmethod
+    def get_currencies_version(cls):
+        """
+        Returns the version of the currencies of the websites, which is the
+        number and the last change of the website currencies and of the
+        currencies.
+
+        It is read from the database instead of being incremented when the
+        currencies change, so that a worker reading before the change is
+        committed never caches former data under the new version.
+        """
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        WebsiteCurrency = pool.get('nereid.website-currency.currency')
+
+        version = cls._website_cache.get('currencies_version')
+        if version is not None:
+            return version
+
+        cursor = Transaction().cursor
+        stamp = []
+        for table in (Currency.__table__(), WebsiteCurrency.__table__()):
+            cursor.execute(*table.select(
+                Count(table.id),
+                Max(Coalesce(table.write_date, table.create_date)),
+            ))
+            stamp.extend(cursor.fetchone())
+        version = ':'.join(map(unicode, stamp))
+        cls._website_cache.set('currencies_version', version)
+        return version
+
+    @classmethod
+    def bump_currencies_version(cls):
+        """
+        Invalidate the currency lists of all the websites. The workers read
+        the version again once the change is committed.
+        """
+        cls.clear_website_cache()
+
     def get_currencies(self):
         """Returns available currencies for current site
 
@@ -328,13 +1099,23 @@ class WebSite(ModelSQL, ModelView):
             A special method is required so that the fetch can be speeded up,
             by pushing the categories to the central cache which cannot be
             done directly on a browse node.
+
+        The list is kept in two tiers: the website cache of the worker and
+        the shared cache, whose key has the version of the currencies (see
+        :meth:`get_currencies_version`).
         """
+        key = ('currencies', self.id, Transaction().language)
+        rv = self._website_cache.get(key)
+        if rv is not None:
+            return rv
+
         cache_key = key_from_list([
             Transaction().cursor.dbname,
-            Transaction().user,
             'nereid.website.get_currencies',
+            self.id,
+            Transaction().language,
+            self.get_currencies_version(),
         ])
-        # The website is automatically appended to the cache prefix
         rv = cache.get(cache_key)
         if rv is None:
             rv = [{
@@ -344,6 +1125,7 @@ class WebSite(ModelSQL, ModelView):
             } for c in self.currencies
             ]
             cache.set(cache_key, rv, 60 * 60)
+        self._website_cache.set(key, rv)
         return rv
 
     @staticmethod
@@ -362,7 +1144,9 @@ class WebSite(ModelSQL, ModelView):
         else:
             rv.update({
                 'logged_in': True,
-                'name': request.nereid_user.display_name
+                'name': request_records().related(
+                    request_user(), 'display_name'
+                ),
             })
         return rv
 
@@ -416,6 +1200,18 @@ class URLRule(ModelSQL, ModelView):
             be done
     :param sequence: Numeric sequence of the URL Map.
     :param url_map: Relation field for url_rule o2m
+
+    Caching
+    ~~~~~~~
+
+    :param cache_timeout: Seconds for which GET responses of the rule are
+            served from the cache. Caching is disabled when not set. The
+            handler must be decorated with :func:`caching.cache_response`
+    :param cache_vary_website: Cache the response separately per website
+    :param cache_vary_locale: Cache the response separately per language
+    :param cache_vary_currency: Cache the response separately per currency
+    :param cache_vary_user: Cache responses separately for each logged in
+            user. Guests share the same responses.
     """
     __name__ = "nereid.url_rule"
     _rec_name = 'rule'
@@ -437,6 +1233,20 @@ class URLRule(ModelSQL, ModelView):
     sequence = fields.Integer('Sequence', required=True,)
     url_map = fields.Many2One('nereid.url_map', 'URL Map')
 
+    cache_timeout = fields.Integer(
+        'Cache Timeout',
+        help="Seconds for which GET responses are served from the cache "
+        "without calling the handler. Leave empty to disable caching."
+    )
+    cache_vary_website = fields.Boolean('Vary by Website')
+    cache_vary_locale = fields.Boolean('Vary by Locale')
+    cache_vary_currency = fields.Boolean('Vary by Currency')
+    cache_vary_user = fields.Boolean(
+        'Vary by User',
+        help="Cache the responses separately for each logged in user. "
+        "Without it, logged in users get the responses cached for guests."
+    )
+
     @classmethod
     def __setup__(cls):
         super(URLRule, cls).__setup__()
@@ -450,24 +1260,52 @@ class URLRule(ModelSQL, ModelView):
     def default_http_method_get():
         return True
 
+    @staticmethod
+    def default_cache_vary_website():
+        return True
+
+    @staticmethod
+    def default_cache_vary_locale():
+        return True
+
+    @staticmethod
+    def default_cache_vary_user():
+        return True
+
+    @classmethod
+    def create(cls, vlist):
+        URLMap = Pool().get('nereid.url_map')
+
+        rules = super(URLRule, cls).create(vlist)
+        URLMap.clear_rules_cache()
+        return rules
+
+    @classmethod
+    def write(cls, rules, values):
+        URLMap = Pool().get('nereid.url_map')
+
+        rv = super(URLRule, cls).write(rules, values)
+        URLMap.clear_rules_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, rules):
+        URLMap = Pool().get('nereid.url_map')
+
+        rv = super(URLRule, cls).delete(rules)
+        URLMap.clear_rules_cache()
+        return rv
+
     def get_http_methods(self):
         """
         Returns an iterable of HTTP methods that the URL has to support.
 
         .. versionadded: 2.4.0.6
         """
-        methods = []
-        if self.http_method_get:
-            methods.append('GET')
-        if self.http_method_post:
-            methods.append('POST')
-        if self.http_method_put:
-            methods.append('PUT')
-        if self.http_method_delete:
-            methods.append('DELETE')
-        if self.http_method_patch:
-            methods.append('PATCH')
-        return methods
+        return [
+            method for field, method in HTTP_METHOD_FIELDS
+            if getattr(self, field)
+        ]
 
     def get_rule_arguments(self):
         """
@@ -485,6 +1323,92 @@ class URLRule(ModelSQL, ModelView):
             'redirect_to': self.redirect_to or None,
         }
 
+    @classmethod
+    def get_response_cache_settings(cls, url_map_id, endpoint):
+        """
+        Returns the response cache settings of an endpoint in a URL map or
+        None if its responses are not cached. The settings of all the
+        endpoints of the map are cached along with the rules.
+
+        :param url_map_id: ID of the URL map
+        :param endpoint: The endpoint of the request
+        """
+        URLMap = Pool().get('nereid.url_map')
+
+        key = ('response_cache', url_map_id)
+        settings = URLMap._rules_cache.get(key)
+        if settings is None:
+            settings = {}
+            for rule in cls.search([
+                    ('url_map', '=', url_map_id),
+                    ('cache_timeout', '>', 0),
+                    ]):
+                settings.setdefault(rule.endpoint, {
+                    'timeout': rule.cache_timeout,
+                    'vary_website': rule.cache_vary_website,
+                    'vary_locale': rule.cache_vary_locale,
+                    'vary_currency': rule.cache_vary_currency,
+                    'vary_user': rule.cache_vary_user,
+                })
+            URLMap._rules_cache.set(key, settings)
+        return settings.get(endpoint)
+
+    @classmethod
+    def get_rules_arguments_for_map(cls, url_map_id):
+        """
+        Return the arguments of all the active rules of a URL map in the
+        same format as :meth:`get_rule_arguments`, in the order of the
+        model (sequence first).
+
+        The rules and their defaults are read with two queries instead of
+        browsing every rule and its defaults one by one.
+
+        :param url_map_id: ID of the URL map
+        """
+        URLRuleDefaults = Pool().get('nereid.url_rule_defaults')
+        rule = cls.__table__()
+        rule_default = URLRuleDefaults.__table__()
+        cursor = Transaction().cursor
+
+        where = (rule.url_map == url_map_id) & (rule.active == True)
+
+        cursor.execute(*rule_default.join(
+            rule, condition=rule_default.rule == rule.id
+        ).select(
+            rule_default.rule, rule_default.key, rule_default.value,
+            where=where, order_by=rule_default.id.asc
+        ))
+        defaults = {}
+        for rule_id, key, value in cursor.fetchall():
+            defaults.setdefault(rule_id, {})[key] = value
+
+        method_columns = [
+            getattr(rule, field) for field, method in HTTP_METHOD_FIELDS
+        ]
+        cursor.execute(*rule.select(
+            rule.id, rule.rule, rule.endpoint, rule.only_for_genaration,
+            rule.redirect_to, *method_columns,
+            where=where, order_by=[
+                getattr(getattr(rule, field), direction.lower())
+                for field, direction in cls._order
+            ]
+        ))
+        rules = []
+        for row in cursor.fetchall():
+            rule_id, path, endpoint, build_only, redirect_to = row[:5]
+            rules.append({
+                'rule': path,
+                'endpoint': endpoint,
+                'methods': [
+                    method for (field, method), enabled
+                    in zip(HTTP_METHOD_FIELDS, row[5:]) if enabled
+                ],
+                'build_only': bool(build_only),
+                'defaults': defaults.get(rule_id, {}),
+                'redirect_to': redirect_to or None,
+            })
+        return rules
+
 
 class URLRuleDefaults(ModelSQL, ModelView):
     """
@@ -504,8 +1428,32 @@ class URLRuleDefaults(ModelSQL, ModelView):
         select=True
     )
 
+    @classmethod
+    def create(cls, vlist):
+        URLMap = Pool().get('nereid.url_map')
+
+        defaults = super(URLRuleDefaults, cls).create(vlist)
+        URLMap.clear_rules_cache()
+        return defaults
+
+    @classmethod
+    def write(cls, defaults, values):
+        URLMap = Pool().get('nereid.url_map')
+
+        rv = super(URLRuleDefaults, cls).write(defaults, values)
+        URLMap.clear_rules_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, defaults):
+        URLMap = Pool().get('nereid.url_map')
+
+        rv = super(URLRuleDefaults, cls).delete(defaults)
+        URLMap.clear_rules_cache()
+        return rv
+
 
-class WebsiteCountry(ModelSQL):
+class WebsiteCountry(WebsiteCacheMixin, ModelSQL):
     "Website Country Relations"
     __name__ = 'nereid.website-country.country'
 
@@ -513,10 +1461,11 @@ class WebsiteCountry(ModelSQL):
     country = fields.Many2One('country.country', 'Country')
 
 
-class WebsiteCurrency(ModelSQL):
+class WebsiteCurrency(WebsiteCacheMixin, ModelSQL):
     "Currencies to be made available on website"
     __name__ = 'nereid.website-currency.currency'
     _table = 'website_currency_rel'
+    _website_cache_invalidator = 'bump_currencies_version'
 
     website = fields.Many2One(
         'nereid.website', 'Website',
@@ -526,7 +1475,7 @@ class WebsiteCurrency(ModelSQL):
         ondelete='CASCADE', select=1, required=True)
 
 
-class WebsiteWebsiteLocale(ModelSQL):
+class WebsiteWebsiteLocale(WebsiteCacheMixin, ModelSQL):
     "Languages to be made available on website"
     __name__ = 'nereid.website-nereid.website.locale'
     _table = 'website_locale_rel'
@@ -76,6 +76,61 @@ class RunAudit(Command):
             print "No problems found in sourcecode."
 
 
+class BenchmarkHashers(Command):
+    """Reports the logins per second the password hasher allows at each
+    cost, with as many concurrent logins as hashes computed at the same
+    time (`nereid_password_threads`)::
+
+        python setup.py bench_hashers --costs=1000,12000,50000
+    """
+    description = "Benchmark the password hasher at different costs"
+
+    user_options = [
+        ('hasher=', None, 'algorithm of the hasher (pbkdf2_sha256)'),
+        ('costs=', None, 'comma separated costs (1000,12000,50000,100000)'),
+        ('logins=', None, 'number of logins at each cost (100)'),
+    ]
+
+    def initialize_options(self):
+        self.hasher = 'pbkdf2_sha256'
+        self.costs = '1000,12000,50000,100000'
+        self.logins = 100
+
+    def finalize_options(self):
+        self.costs = [int(cost) for cost in self.costs.split(',')]
+        self.logins = int(self.logins)
+
+    def run(self):
+        import time
+        from threading import Thread
+        import hashers
+
+        threads = hashers.get_concurrency()
+        for cost in self.costs:
+            hasher = hashers.get_hasher(self.hasher, cost)
+            encoded = hashers.make_password('password', hasher)
+
+            def login(count):
+                for i in xrange(count):
+                    assert hashers.check_password('password', encoded)
+
+            # Split the logins between concurrent workers, like the worker
+            # threads of a server would
+            workers = [
+                Thread(target=login, args=(self.logins // threads,))
+                for i in xrange(threads)
+            ]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+            print "%s cost %d: %.1f logins/s" % (
+                self.hasher, cost, (self.logins // threads) * threads / elapsed
+            )
+
+
 def read(fname):
     return open(os.path.join(os.path.dirname(__file__), fname)).read()
 
@@ -157,5 +212,6 @@ setup(
     cmdclass={
         'xmltests': XMLTests,
         'audit': RunAudit,
+        'bench_hashers': BenchmarkHashers,
     },
 )
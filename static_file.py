@@ -1,19 +1,271 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import os
+import re
+import gzip
 import urllib
+import hashlib
+import tempfile
+import time
+import fcntl
+import logging
+import mimetypes
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from optparse import OptionParser
+from threading import Lock
+from io import BytesIO
 
-from nereid.helpers import slugify, send_file, url_for
-from nereid.globals import _request_ctx_stack
-from werkzeug import abort
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from nereid.helpers import slugify, send_file, url_for, login_required, \
+    permissions_required, jsonify
+from nereid.globals import _request_ctx_stack, request, current_app
+from werkzeug import abort, redirect
+from werkzeug.http import parse_range_header, parse_if_range_header, \
+    parse_content_range_header
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.config import CONFIG
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Not, Equal
+from trytond.pool import Pool
+from trytond.cache import Cache
+
+from .caching import url_for_cached, url_for_many
 
 __all__ = ['NereidStaticFolder', 'NereidStaticFile']
 
+logger = logging.getLogger('nereid.static_file')
+
+#: The number of hexadecimal digits of the checksum in hashed URLs
+DIGEST_LENGTH = 16
+
+#: The Cache-Control of the files served by hashed URLs, whose content
+#: never changes
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+#: The extensions of the precompressed variants by content encoding, in
+#: order of preference
+VARIANT_EXTENSIONS = [('br', '.br'), ('gzip', '.gz')]
+
+#: The directory, in the nereid base path, of the precompressed variants.
+#: Folder names cannot have a '.', so it cannot be the path of a folder.
+VARIANTS_DIRECTORY = '.compressed'
+
+#: The mimetypes compressed, besides text/*
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript', 'application/x-javascript', 'application/json',
+    'application/xml', 'image/svg+xml',
+])
+
+#: Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+
+#: The directory, in the nereid base path, of the partial uploads of
+#: :meth:`NereidStaticFile.upload_static_file`
+UPLOADS_DIRECTORY = '.uploads'
+
+#: The permission value of the users allowed to upload static files
+UPLOAD_PERMISSION = 'static_file.upload'
+
+#: The size of the chunks in which files are copied
+CHUNK_SIZE = 64 * 1024
+
+_compress_pool = None
+_compress_pool_lock = Lock()
+
+
+def is_compressible(mimetype):
+    "Returns True if files of the mimetype are served precompressed"
+    return bool(mimetype) and (
+        mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES
+    )
+
+
+def get_encodings():
+    """
+    Returns the content encodings of the precompressed variants, in order of
+    preference. Brotli variants are made only if the brotli module is
+    installed.
+    """
+    return [
+        encoding for encoding, extension in VARIANT_EXTENSIONS
+        if encoding != 'br' or brotli is not None
+    ]
+
+
+class BrotliFile(object):
+    "A write only file-like object compressing into a file with brotli"
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.compressor = brotli.Compressor()
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.process(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.finish())
+
+
+def open_compressor(fileobj, encoding):
+    """
+    Returns a write only file-like object compressing the data written into
+    fileobj for the content encoding. Closing it does not close fileobj.
+    """
+    if encoding == 'br':
+        return BrotliFile(fileobj)
+    return gzip.GzipFile(
+        fileobj=fileobj, mode='wb', compresslevel=9, mtime=0
+    )
+
+
+def write_file_variants(paths, path, checksum):
+    """
+    Write the precompressed variants of the file at path, unless its content
+    is no longer the one of the checksum: the file was replaced meanwhile
+    and the variants of the new content are made by its own job. The file
+    is compressed by chunks into temporary files, which are renamed once
+    written so that variants are never served partially. Variants which
+    are not smaller than the file are dropped.
+
+    :param paths: A dictionary of the content encodings to the paths of
+                  their variants
+    :return: True if the variants are written
+    """
+    variants = []
+    try:
+        for encoding, variant_path in paths.iteritems():
+            directory = os.path.dirname(variant_path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Made meanwhile by another thread
+                    if not os.path.isdir(directory):
+                        raise
+            fd, temp_path = tempfile.mkstemp(
+                prefix='.%s.' % os.path.basename(variant_path),
+                suffix='.tmp', dir=directory
+            )
+            temp_file = os.fdopen(fd, 'wb')
+            variants.append((
+                variant_path, temp_path, temp_file,
+                open_compressor(temp_file, encoding)
+            ))
+
+        digest = hashlib.sha1()
+        size = 0
+        with open(path, 'rb') as source:
+            for data in iter(lambda: source.read(CHUNK_SIZE), ''):
+                digest.update(data)
+                size += len(data)
+                for variant in variants:
+                    variant[3].write(data)
+        for variant_path, temp_path, temp_file, compressor in variants:
+            compressor.close()
+            temp_file.close()
+        if digest.hexdigest() != checksum:
+            return False
+
+        for variant_path, temp_path, temp_file, compressor in variants:
+            if os.path.getsize(temp_path) < size:
+                # mkstemp makes files only readable by their owner
+                os.chmod(temp_path, 0644)
+                os.rename(temp_path, variant_path)
+        return True
+    finally:
+        for variant_path, temp_path, temp_file, compressor in variants:
+            temp_file.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def write_file_variants_logged(paths, path, checksum):
+    """
+    Call :func:`write_file_variants` and log its errors, which are lost
+    otherwise when it runs in the background
+    """
+    try:
+        return write_file_variants(paths, path, checksum)
+    except Exception:
+        logger.exception('Precompressed variants of %s failed' % path)
+
+
+def copy_stream(source, destination, length=None, digest=None):
+    """
+    Copy a file-like object into another one by chunks
+
+    :param length: The number of bytes to copy. Defaults to all of them.
+    :param digest: A hashlib object updated with the bytes copied
+    :return: The number of bytes copied
+    """
+    copied = 0
+    while length is None or copied < length:
+        size = CHUNK_SIZE if length is None else \
+            min(CHUNK_SIZE, length - copied)
+        data = source.read(size)
+        if not data:
+            break
+        destination.write(data)
+        if digest is not None:
+            digest.update(data)
+        copied += len(data)
+    return copied
+
+
+def file_checksum(path):
+    "Returns the SHA-1 of the content of the file at path"
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(CHUNK_SIZE), ''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def remove_variants(directory, name, keep=()):
+    """
+    Remove the precompressed variants of all the contents of the file name
+    in the directory
+
+    :param keep: The paths of the variants to keep
+    """
+    pattern = re.compile(
+        r'%s\.[0-9a-f]{%d}\.' % (re.escape(name), DIGEST_LENGTH)
+    )
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(directory, entry)
+        if pattern.match(entry) and path not in keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def get_compress_pool():
+    """
+    Returns the pool of threads compressing the large files in the
+    background. Its size is `nereid_static_compress_threads` in the
+    configuration (2 by default).
+    """
+    global _compress_pool
+    if _compress_pool is None:
+        with _compress_pool_lock:
+            if _compress_pool is None:
+                _compress_pool = ThreadPool(int(
+                    CONFIG.options.get('nereid_static_compress_threads', 2)
+                ))
+    return _compress_pool
+
 
 class NereidStaticFolder(ModelSQL, ModelView):
     "Static folder for Nereid"
@@ -27,6 +279,14 @@ class NereidStaticFolder(ModelSQL, ModelView):
     description = fields.Char('Description', select=1)
     files = fields.One2Many('nereid.static.file', 'folder', 'Files')
 
+    #: Serve the local files of the folder from URLs with a digest of their
+    #: content, which can be cached forever
+    hashed_urls = fields.Boolean(
+        'Content-Hashed URLs',
+        help="The URLs of the files change with their content, so that "
+        "browsers can cache them forever"
+    )
+
     @classmethod
     def __setup__(cls):
         super(NereidStaticFolder, cls).__setup__()
@@ -74,7 +334,21 @@ class NereidStaticFolder(ModelSQL, ModelView):
         if vals.get('folder_name'):
             # TODO: Support this feature in future versions
             cls.raise_user_error('folder_cannot_change')
-        return super(NereidStaticFolder, cls).write(folders, vals)
+        rv = super(NereidStaticFolder, cls).write(folders, vals)
+        Pool().get('nereid.static.file').clear_index_cache()
+        return rv
+
+    @classmethod
+    def create(cls, vlist):
+        folders = super(NereidStaticFolder, cls).create(vlist)
+        Pool().get('nereid.static.file').clear_index_cache()
+        return folders
+
+    @classmethod
+    def delete(cls, folders):
+        rv = super(NereidStaticFolder, cls).delete(folders)
+        Pool().get('nereid.static.file').clear_index_cache()
+        return rv
 
 
 class NereidStaticFile(ModelSQL, ModelView):
@@ -114,6 +388,21 @@ class NereidStaticFile(ModelSQL, ModelView):
     #: In other words the URL is valid only when called in a nereid request.
     url = fields.Function(fields.Char('URL'), 'get_url')
 
+    #: The size, modification time and SHA-1 of the content of local files,
+    #: stored when the content is set. They are the validators of the
+    #: responses of :meth:`send_static_file`.
+    file_size = fields.Integer('File Size', readonly=True)
+    file_mtime = fields.DateTime('File Modified', readonly=True)
+    checksum = fields.Char('Checksum', readonly=True, select=True)
+
+    #: Index of the files served by :meth:`send_static_file`, from the
+    #: folder name and file name to :meth:`get_index_entry`
+    _index_cache = Cache(
+        'nereid.static.file.index',
+        size_limit=int(CONFIG.options.get('nereid_static_index_size', 10000)),
+        context=False
+    )
+
     @classmethod
     def __setup__(cls):
         super(NereidStaticFile, cls).__setup__()
@@ -134,6 +423,29 @@ class NereidStaticFile(ModelSQL, ModelView):
     def default_type():
         return 'local'
 
+    @classmethod
+    def create(cls, vlist):
+        files = super(NereidStaticFile, cls).create(vlist)
+        cls.clear_index_cache()
+        return files
+
+    @classmethod
+    def write(cls, files, values):
+        rv = super(NereidStaticFile, cls).write(files, values)
+        cls.clear_index_cache()
+        return rv
+
+    @classmethod
+    def delete(cls, files):
+        rv = super(NereidStaticFile, cls).delete(files)
+        cls.clear_index_cache()
+        return rv
+
+    @classmethod
+    def clear_index_cache(cls):
+        "Invalidate the index of the files served by send_static_file"
+        cls._index_cache.clear()
+
     def get_url(self, name):
         """Return the url if within an active request context or return
         False values
@@ -142,13 +454,48 @@ class NereidStaticFile(ModelSQL, ModelView):
             return None
 
         if self.type == 'local':
-            return url_for(
-                'nereid.static.file.send_static_file',
-                folder=self.folder.folder_name, name=self.name
-            )
+            endpoint, values = self._get_url_arguments()
+            return url_for_cached(endpoint, **values)
         elif self.type == 'remote':
             return self.remote_path
 
+    def _get_url_arguments(self):
+        """
+        Returns the endpoint and the arguments of the URL of a local file,
+        which has the digest of its content if the folder has hashed URLs
+        """
+        if self.folder.hashed_urls and self.checksum:
+            return 'nereid.static.file.send_hashed_static_file', {
+                'folder': self.folder.folder_name,
+                'digest': self.checksum[:DIGEST_LENGTH],
+                'name': self.name,
+            }
+        return 'nereid.static.file.send_static_file', {
+            'folder': self.folder.folder_name, 'name': self.name,
+        }
+
+    @classmethod
+    def get_urls(cls, files):
+        """
+        Returns the URLs of many files at once, in the same order. Useful for
+        templates that list many files, like product grids.
+
+        :param files: Records of static files
+        """
+        if _request_ctx_stack.top is None:
+            return [None] * len(files)
+
+        local_files = [f for f in files if f.type == 'local']
+        local_urls = dict(zip(
+            [f.id for f in local_files],
+            url_for_many([f._get_url_arguments() for f in local_files])
+        ))
+        return [
+            local_urls[f.id] if f.type == 'local' else
+            f.remote_path if f.type == 'remote' else None
+            for f in files
+        ]
+
     @staticmethod
     def get_nereid_base_path():
         """
@@ -171,13 +518,147 @@ class NereidStaticFile(ModelSQL, ModelView):
         :param value: The value to set
         """
         if self.type == 'local':
-            file_binary = buffer(value)
-            # If the folder does not exist, create it recursively
-            directory = os.path.dirname(self.file_path)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
-            with open(self.file_path, 'wb') as file_writer:
-                file_writer.write(file_binary)
+            return self.save_stream(BytesIO(value))
+
+    def save_stream(self, fileobj):
+        """
+        Store the content of a file-like object as the content of the local
+        file. It is copied by chunks to a temporary file in the folder of
+        the file, which is synced and renamed over the file, so that readers
+        see either the previous or the new content, never a part of it.
+
+        :param fileobj: The file-like object to read
+        :return: The values of the metadata fields of the file
+        """
+        # If the folder does not exist, create it recursively
+        directory = os.path.dirname(self.file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        checksum = hashlib.sha1()
+        fd, temp_path = tempfile.mkstemp(
+            prefix='.%s.' % self.name, suffix='.tmp', dir=directory
+        )
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                copy_stream(fileobj, temp_file, digest=checksum)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            # mkstemp makes files only readable by their owner
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, self.file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        checksum = checksum.hexdigest()
+        self.make_variants(checksum)
+        return self.get_file_metadata(self.file_path, checksum)
+
+    @classmethod
+    def get_variants_directory(cls, folder):
+        "Returns the directory of the precompressed variants of the folder"
+        return os.path.join(
+            cls.get_nereid_base_path(), VARIANTS_DIRECTORY, folder
+        )
+
+    @classmethod
+    def get_variant_paths(cls, folder, name, checksum, encodings=None):
+        """
+        Returns a dictionary of the content encodings to the paths of the
+        precompressed variants of the file. Their names have the digest of
+        the content they were made from, so that the variants of a previous
+        content are never sent.
+
+        :param checksum: The checksum of the content of the file
+        :param encodings: The content encodings. Defaults to all of them.
+        """
+        if encodings is None:
+            encodings = [encoding for encoding, ext in VARIANT_EXTENSIONS]
+        extensions = dict(VARIANT_EXTENSIONS)
+        directory = cls.get_variants_directory(folder)
+        return dict(
+            (encoding, os.path.join(directory, '%s.%s%s' % (
+                name, checksum[:DIGEST_LENGTH], extensions[encoding]
+            ))) for encoding in encodings
+        )
+
+    def make_variants(self, checksum=None, background=True):
+        """
+        Replace the precompressed variants of the local file, if it is
+        compressible. Files larger than `nereid_static_compress_async_size`
+        in the configuration (1 MB by default) are compressed in the
+        background, and their variants are discarded if the file is
+        replaced before they are written.
+
+        :param checksum: The checksum of the content of the file. Defaults
+                         to the stored checksum.
+        :param background: False to compress large files before returning
+        :return: True if variants of the file are made
+        """
+        checksum = checksum or self.checksum
+        folder = self.folder.folder_name
+        paths = {}
+        if checksum and is_compressible(mimetypes.guess_type(self.name)[0]):
+            paths = self.get_variant_paths(
+                folder, self.name, checksum, get_encodings()
+            )
+        remove_variants(
+            self.get_variants_directory(folder), self.name, paths.values()
+        )
+        if not paths:
+            return False
+        size = os.path.getsize(self.file_path)
+        if size < MIN_COMPRESS_SIZE:
+            return False
+        async_size = int(CONFIG.options.get(
+            'nereid_static_compress_async_size', 1024 * 1024
+        ))
+        if background and size > async_size:
+            get_compress_pool().apply_async(
+                write_file_variants_logged, (paths, self.file_path, checksum)
+            )
+            return True
+        return write_file_variants(paths, self.file_path, checksum)
+
+    @classmethod
+    def backfill_variants(cls, folders=None):
+        """
+        Make the precompressed variants of the local files stored before
+        they were made
+
+        :param folders: The folder names of the files. Defaults to all the
+                        folders.
+        :return: The number of files whose variants were made
+        """
+        domain = [('type', '=', 'local')]
+        if folders:
+            domain.append(('folder.folder_name', 'in', folders))
+        count = 0
+        for static_file in cls.search(domain):
+            if not os.path.isfile(static_file.file_path):
+                continue
+            checksum = static_file.checksum
+            if not checksum:
+                # Files stored before their checksum was
+                checksum = file_checksum(static_file.file_path)
+                cls.write([static_file], cls.get_file_metadata(
+                    static_file.file_path, checksum
+                ))
+            if static_file.make_variants(checksum, background=False):
+                count += 1
+        return count
+
+    @staticmethod
+    def get_file_metadata(path, checksum=None):
+        """
+        Returns the values of the metadata fields of the file at path
+        """
+        stat = os.stat(path)
+        return {
+            'file_size': stat.st_size,
+            'file_mtime': datetime.utcfromtimestamp(int(stat.st_mtime)),
+            'checksum': checksum,
+        }
 
     @classmethod
     def set_file_binary(cls, files, name, value):
@@ -189,7 +670,9 @@ class NereidStaticFile(ModelSQL, ModelView):
         :param value: The file buffer
         """
         for static_file in files:
-            static_file._set_file_binary(value)
+            metadata = static_file._set_file_binary(value)
+            if metadata:
+                cls.write([static_file], metadata)
 
     def get_file_binary(self, name):
         '''
@@ -239,12 +722,467 @@ class NereidStaticFile(ModelSQL, ModelView):
         :param folder: folder_name of the folder
         :param name: name of the file
         """
-        #TODO: Separate this search and find into separate cached method
+        entry = cls.get_index_entry(folder, name)
+        if entry is None:
+            abort(404)
+        return cls._send_entry(entry)
+
+    @classmethod
+    def send_hashed_static_file(cls, folder, digest, name):
+        """
+        Send a file of a folder with hashed URLs. Its content never changes
+        for a digest, so it can be cached forever. The URLs of the previous
+        contents of the file redirect to its current URL.
+
+        :param folder: folder_name of the folder
+        :param digest: The beginning of the checksum of the file
+        :param name: name of the file
+        """
+        entry = cls.get_index_entry(folder, name)
+        if entry is None or entry['type'] != 'local':
+            abort(404)
+        if entry['digest'] != digest:
+            if entry['digest'] is None:
+                return redirect(url_for(
+                    'nereid.static.file.send_static_file',
+                    folder=folder, name=name
+                ))
+            return redirect(url_for(
+                'nereid.static.file.send_hashed_static_file',
+                folder=folder, digest=entry['digest'], name=name
+            ))
+        response = cls._send_entry(entry)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.expires = None
+        return response
+
+    @classmethod
+    def _send_entry(cls, entry):
+        "Returns the response sending the file of the index entry"
+        if entry['type'] != 'local':
+            return send_file(entry['path'], mimetype=entry['mimetype'])
+
+        encoding, variant_path = cls.get_variant(entry)
+        etag = entry['etag']
+        if encoding:
+            etag = '%s-%s' % (etag, encoding)
+
+        if cls.is_not_modified(entry, etag):
+            response = current_app.response_class(status=304)
+        elif encoding:
+            response = send_file(
+                variant_path, mimetype=entry['mimetype'], add_etags=False
+            )
+            response.headers['Content-Encoding'] = encoding
+        else:
+            byte_range = cls.get_byte_range(entry)
+            if byte_range is None:
+                response = send_file(
+                    entry['path'], mimetype=entry['mimetype'],
+                    add_etags=False
+                )
+            else:
+                response = cls._send_byte_range(entry, byte_range)
+        response.set_etag(etag)
+        response.last_modified = entry['mtime']
+        response.headers['Accept-Ranges'] = 'bytes'
+        if entry['variants']:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    @staticmethod
+    def get_variant(entry):
+        """
+        Returns the content encoding and the path of the precompressed
+        variant of the file to send, or (None, None) to send the file itself.
+        Range requests are answered from the file itself.
+        """
+        if entry['variants'] and 'Range' not in request.headers:
+            for encoding in get_encodings():
+                if request.accept_encodings[encoding] and \
+                        os.path.isfile(entry['variants'][encoding]):
+                    return encoding, entry['variants'][encoding]
+        return None, None
+
+    @staticmethod
+    def is_not_modified(entry, etag=None):
+        """
+        Returns True if the client has the current version of the file, as
+        told by If-None-Match or, without it, If-Modified-Since
+
+        :param etag: The ETag of the representation sent. Defaults to the
+                     ETag of the file.
+        """
+        if request.if_none_match:
+            return request.if_none_match.contains(etag or entry['etag'])
+        if request.if_modified_since:
+            return entry['mtime'] <= request.if_modified_since
+        return False
+
+    @staticmethod
+    def get_byte_range(entry):
+        """
+        Returns the (start, stop) of the single byte range requested for the
+        file, or None to send the whole file: when there is no Range, when
+        it has many ranges or when If-Range does not match the file.
+        Raises 416 if the range cannot be satisfied.
+        """
+        byte_range = parse_range_header(request.headers.get('Range'))
+        if byte_range is None or byte_range.units != 'bytes' or \
+                len(byte_range.ranges) != 1:
+            return None
+        if 'If-Range' in request.headers:
+            if_range = parse_if_range_header(request.headers['If-Range'])
+            if if_range.etag != entry['etag'] and \
+                    if_range.date != entry['mtime']:
+                return None
+
+        size = entry['size']
+        start, stop = byte_range.ranges[0]
+        if start < 0:
+            # The last bytes of the file
+            start = max(size + start, 0)
+        stop = size if stop is None else min(stop, size)
+        if start >= stop:
+            abort(current_app.response_class(
+                status=416,
+                headers={'Content-Range': 'bytes */%d' % size},
+            ))
+        return start, stop
 
-        files = cls.search([
-            ('folder.folder_name', '=', folder),
-            ('name', '=', name)
-        ])
+    @classmethod
+    def _send_byte_range(cls, entry, byte_range):
+        start, stop = byte_range
+        response = current_app.response_class(
+            cls._read_range(entry['path'], start, stop - start),
+            status=206, mimetype=entry['mimetype'], direct_passthrough=True,
+        )
+        response.content_length = stop - start
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, entry['size']
+        )
+        return response
+
+    @staticmethod
+    def _read_range(path, start, length, chunk_size=64 * 1024):
+        "Yields the length bytes of the file from start, by chunks"
+        with open(path, 'rb') as file_reader:
+            file_reader.seek(start)
+            while length > 0:
+                data = file_reader.read(min(chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    @classmethod
+    def get_uploads_directory(cls):
+        "Returns the directory of the partial uploads"
+        return os.path.join(cls.get_nereid_base_path(), UPLOADS_DIRECTORY)
+
+    def get_upload_path(self, length):
+        """
+        Returns the path of the partial upload of the file, whose name has
+        the length of the content uploaded
+
+        :param length: The length of the whole content
+        """
+        return os.path.join(
+            self.get_uploads_directory(), '%d-%d' % (self.id, length)
+        )
+
+    def get_partial_upload(self):
+        """
+        Returns the path of the partial upload of the file and the length
+        of the content uploaded, or (None, None) if there is none
+        """
+        prefix = '%d-' % self.id
+        try:
+            entries = os.listdir(self.get_uploads_directory())
+        except OSError:
+            return None, None
+        for entry in entries:
+            if entry.startswith(prefix) and entry[len(prefix):].isdigit():
+                return (
+                    os.path.join(self.get_uploads_directory(), entry),
+                    int(entry[len(prefix):])
+                )
+        return None, None
+
+    @contextmanager
+    def lock_upload(self, blocking=True):
+        """
+        Hold an exclusive lock on the uploads of the file, shared by all the
+        processes, so that the chunks are appended one at a time
+
+        :param blocking: False to raise an IOError if the lock is held
+        """
+        directory = self.get_uploads_directory()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made meanwhile by another request
+                if not os.path.isdir(directory):
+                    raise
+        with open(os.path.join(directory, '%d.lock' % self.id), 'a') \
+                as lock_file:
+            fcntl.flock(
+                lock_file.fileno(),
+                fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @classmethod
+    @login_required
+    @permissions_required([UPLOAD_PERMISSION])
+    def upload_static_file(cls, file):
+        """
+        Upload the content of a local file in the body of PUT requests, for
+        users with the `static_file.upload` permission.
+
+        Without a Content-Range header the body is the whole content, and a
+        Content-Range which cannot be parsed is refused with a 400.
+        Otherwise the content is uploaded in chunks, each request sending
+        the bytes of its `Content-Range: bytes <first>-<last>/<length>`.
+        A chunk starting at 0 starts the upload again with the length of
+        its range. Any other chunk which does not start where the upload
+        stopped, or whose length is not the one of the upload, is refused
+        with a 409, and `Content-Range: bytes */<length>` asks where it
+        stopped. Both answer the bytes received so far in a Range header
+        and in the `offset` of the JSON response, so that an interrupted
+        upload is resumed from there. The file is replaced once all the
+        bytes are received.
+
+        :param file: ID of the static file
+        """
+        files = cls.search([('id', '=', file), ('type', '=', 'local')])
         if not files:
             abort(404)
-        return send_file(files[0].file_path)
+        static_file, = files
+
+        if 'Content-Range' not in request.headers:
+            cls.write([static_file], static_file.save_stream(request.stream))
+            return static_file._upload_response(static_file.file_size)
+        content_range = parse_content_range_header(
+            request.headers['Content-Range']
+        )
+        if content_range is None or content_range.units != 'bytes' or \
+                content_range.length is None:
+            abort(400)
+        if content_range.start is not None and \
+                content_range.stop > content_range.length:
+            abort(400)
+
+        with static_file.lock_upload():
+            upload_path, length = static_file.get_partial_upload()
+            if content_range.start == 0:
+                # The upload is started again
+                if upload_path is not None:
+                    os.remove(upload_path)
+                length = content_range.length
+                upload_path = static_file.get_upload_path(length)
+                open(upload_path, 'wb').close()
+            offset = os.path.getsize(upload_path) \
+                if upload_path is not None else 0
+
+            if upload_path is not None and length != content_range.length:
+                # A chunk of another content
+                return static_file._upload_response(offset, 409)
+            if content_range.start is None:
+                # Only asks where the upload stopped
+                return static_file._upload_response(offset, 202)
+            if content_range.start != offset:
+                return static_file._upload_response(offset, 409)
+            offset += static_file._append_upload(
+                upload_path, request.stream,
+                content_range.stop - content_range.start
+            )
+            if offset < length:
+                return static_file._upload_response(offset, 202)
+
+            with open(upload_path, 'rb') as upload:
+                cls.write([static_file], static_file.save_stream(upload))
+            os.remove(upload_path)
+        return static_file._upload_response(offset)
+
+    @staticmethod
+    def _append_upload(upload_path, stream, length):
+        """
+        Append a chunk to a partial upload. The caller holds the lock of
+        :meth:`lock_upload`.
+
+        :return: The number of bytes appended
+        """
+        with open(upload_path, 'ab') as upload:
+            appended = copy_stream(stream, upload, length)
+            upload.flush()
+            os.fsync(upload.fileno())
+        return appended
+
+    @classmethod
+    def purge_uploads(cls):
+        """
+        Remove the partial uploads not resumed for more than
+        `nereid_static_upload_max_age` seconds in the configuration (one
+        day by default), and the locks of the files deleted. This is the
+        method called by the cron job.
+
+        :return: The number of partial uploads removed
+        """
+        directory = cls.get_uploads_directory()
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return 0
+        max_age = int(CONFIG.options.get(
+            'nereid_static_upload_max_age', 24 * 60 * 60
+        ))
+        expired = time.time() - max_age
+        upload_ids = set(
+            int(entry.split('-')[0]) for entry in entries
+            if re.match(r'\d+-\d+$', entry)
+        )
+        lock_ids = set(
+            int(entry.split('.')[0]) for entry in entries
+            if re.match(r'\d+\.lock$', entry)
+        )
+        existing_ids = set(f.id for f in cls.search([
+            ('id', 'in', list(upload_ids | lock_ids)),
+        ]))
+
+        removed = 0
+        for file_id in upload_ids:
+            static_file = cls(file_id)
+            try:
+                with static_file.lock_upload(blocking=False):
+                    upload_path, length = static_file.get_partial_upload()
+                    if upload_path is not None and \
+                            os.path.getmtime(upload_path) < expired:
+                        os.remove(upload_path)
+                        removed += 1
+            except IOError:
+                # Being resumed
+                continue
+        # The uploads of deleted files are refused before taking the lock
+        for file_id in lock_ids - existing_ids:
+            try:
+                os.remove(os.path.join(directory, '%d.lock' % file_id))
+            except OSError:
+                pass
+        return removed
+
+    def _upload_response(self, offset, status=200):
+        response = jsonify(id=self.id, offset=offset)
+        response.status_code = status
+        if status != 200 and offset:
+            response.headers['Range'] = 'bytes=0-%d' % (offset - 1)
+        return response
+
+    @classmethod
+    def get_index_entry(cls, folder, name):
+        """
+        Returns a dictionary with the `id`, `type`, resolved `path` and
+        `mimetype` of the file, and for local files its `size`, `mtime`,
+        `etag`, `digest` and the paths of its precompressed `variants`, or
+        None if there is no such file. Files which
+        do not exist are cached too, so that serving a file or a 404 from
+        the index does not run any query.
+
+        :param folder: folder_name of the folder
+        :param name: name of the file
+        """
+        key = (folder, name)
+        entry = cls._index_cache.get(key)
+        if entry is None:
+            # Unknown files are stored as False
+            entry = cls._get_index_entry(folder, name) or False
+            cls._index_cache.set(key, entry)
+        return entry or None
+
+    @classmethod
+    def _get_index_entry(cls, folder, name):
+        Folder = Pool().get('nereid.static.folder')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        folder_table = Folder.__table__()
+
+        cursor.execute(*table.join(
+            folder_table, condition=(table.folder == folder_table.id)
+        ).select(
+            table.id, table.type, table.remote_path, table.file_size,
+            table.file_mtime, table.checksum,
+            where=(folder_table.folder_name == folder) & (table.name == name),
+            limit=1
+        ))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        file_id, type_, remote_path, size, mtime, checksum = row
+        entry = {
+            'id': file_id,
+            'type': type_,
+            'mimetype': mimetypes.guess_type(name)[0] or
+            'application/octet-stream',
+        }
+        if type_ == 'remote':
+            entry['path'] = remote_path
+            return entry
+
+        entry['path'] = os.path.abspath(
+            os.path.join(cls.get_nereid_base_path(), folder, name)
+        )
+        if size is None or mtime is None:
+            # Files stored before their metadata was
+            try:
+                metadata = cls.get_file_metadata(entry['path'], checksum)
+            except OSError:
+                return None
+            size, mtime = metadata['file_size'], metadata['file_mtime']
+        if isinstance(mtime, basestring):
+            # SQLite returns the timestamps as strings
+            mtime = datetime.strptime(mtime[:19], '%Y-%m-%d %H:%M:%S')
+        entry.update({
+            'size': size,
+            'mtime': mtime,
+            'digest': checksum and checksum[:DIGEST_LENGTH],
+            'etag': checksum or '%x-%x' % (
+                int((mtime - datetime(1970, 1, 1)).total_seconds()), size
+            ),
+            'variants': cls.get_variant_paths(folder, name, checksum) if
+            checksum and is_compressible(entry['mimetype']) else {},
+        })
+        return entry
+
+
+def main(argv=None):
+    """
+    Make the precompressed variants of the static files stored before they
+    were made::
+
+        python -m trytond.modules.nereid.static_file -c trytond.conf \\
+            -d database [FOLDER ...]
+    """
+    parser = OptionParser(usage='%prog -c config -d database [FOLDER ...]')
+    parser.add_option('-c', '--config', dest='config')
+    parser.add_option('-d', '--database', dest='database')
+    options, folders = parser.parse_args(argv)
+    if not options.database:
+        parser.error('A database is required')
+
+    if options.config:
+        CONFIG.update_etc(options.config)
+    Pool.start()
+    Pool(options.database).init()
+
+    with Transaction().start(options.database, 0):
+        StaticFile = Pool().get('nereid.static.file')
+        count = StaticFile.backfill_variants(folders)
+    print '%d files compressed' % count
+
+
+if __name__ == '__main__':
+    main()
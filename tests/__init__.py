@@ -16,6 +16,9 @@ from test_address import TestAddress
 from test_i18n import TestI18N
 from test_static_file import TestStaticFile
 from test_currency import TestCurrency
+from test_routing import TestRouting
+from test_caching import TestCaching
+from test_middleware import TestMiddleware
 
 
 class TestNereid(unittest.TestCase):
@@ -56,6 +59,15 @@ def suite():
     test_suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(TestCurrency)
     )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRouting)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCaching)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMiddleware)
+    )
     return test_suite
 
 if __name__ == '__main__':
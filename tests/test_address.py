@@ -337,6 +337,40 @@ class TestAddress(NereidTestCase):
                     len(json.loads(response.data)['result']), 0
                 )
 
+    def test_0060_country_list_conditional(self):
+        """
+        The country list is sent with an ETag and answered with a 304
+        while the countries do not change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_client() as c:
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+
+                response = c.get(
+                    '/en_US/countries', headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(response.status_code, 304)
+
+            self.country_obj.write(
+                [self.available_countries[0]], {'name': 'Renamed'}
+            )
+            with app.test_client() as c:
+                response = c.get(
+                    '/en_US/countries', headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(
+                    'Renamed' in [
+                        country['value']
+                        for country in json.loads(response.data)['result']
+                    ]
+                )
+
 
 def suite():
     "Nereid test suite"
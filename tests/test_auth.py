@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import hashlib
+import smtplib
 import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
 
 from mock import patch
 import trytond.tests.test_tryton
@@ -9,8 +13,11 @@ from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 from trytond.tools import get_smtp_server
 from trytond.config import CONFIG
+from trytond.exceptions import UserError
 from nereid.testing import NereidTestCase
 from nereid import permissions_required
+from trytond.modules.nereid.hashers import make_password
+from trytond.modules.nereid.user_import import read_rows, UserImport
 from werkzeug.exceptions import Forbidden
 
 CONFIG['smtp_from'] = 'from@xyz.com'
@@ -33,6 +40,7 @@ class TestAuth(NereidTestCase):
         self.currency_obj = POOL.get('currency.currency')
         self.language_obj = POOL.get('ir.lang')
         self.party_obj = POOL.get('party.party')
+        self.email_outbox_obj = POOL.get('nereid.email.outbox')
 
         # Patch SMTP Lib
         self.smtplib_patcher = patch('smtplib.SMTP', autospec=True)
@@ -142,6 +150,11 @@ class TestAuth(NereidTestCase):
                 response = c.post('/en_US/registration', data=data)
                 self.assertEqual(response.status_code, 302)
 
+                # The email is sent from the outbox
+                self.assertEqual(
+                    self.mocked_smtp_instance.sendmail.call_count, 0
+                )
+                self.email_outbox_obj.send_pending(commit=False)
                 self.assertEqual(
                     self.mocked_smtp_instance.sendmail.call_count, 1
                 )
@@ -165,6 +178,111 @@ class TestAuth(NereidTestCase):
                 ), 1
             )
 
+    def test_0011_register_email_case(self):
+        """
+        Emails differing only by their case belong to the same user
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Mixed Case'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Mixed Case',
+                'email': 'Mixed.Case@openlabs.co.in',
+                'password': 'password',
+                'company': self.company.id,
+            }])
+            self.assertRaises(
+                UserError, self.nereid_user_obj.create, [{
+                    'party': party,
+                    'display_name': 'Mixed Case',
+                    'email': 'mixed.case@openlabs.co.in',
+                    'password': 'password',
+                    'company': self.company.id,
+                }]
+            )
+
+            with app.test_client() as c:
+                response = c.post('/en_US/registration', data={
+                    'name': 'Mixed Case',
+                    'email': 'mixed.case@openlabs.co.in',
+                    'password': 'password',
+                    'confirm': 'password',
+                })
+                self.assertEqual(response.status_code, 200)
+
+                response = c.post('/en_US/reset-account', data={
+                    'email': 'MIXED.CASE@openlabs.co.in',
+                })
+                self.assertEqual(response.status_code, 302)
+
+            self.assertEqual(
+                self.nereid_user_obj.search_email(
+                    'mixed.CASE@openlabs.co.in', self.company.id
+                ), [user]
+            )
+            self.assertTrue(user.activation_code)
+
+    def test_0012_email_outbox(self):
+        """
+        Emails which cannot be sent are tried again later
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            email = self.email_outbox_obj.enqueue(
+                'from@xyz.com', ['to@xyz.com'], 'message'
+            )
+            self.mocked_smtp_instance.sendmail.side_effect = \
+                smtplib.SMTPException('Temporary failure')
+            self.email_outbox_obj.send_pending(commit=False)
+
+            email = self.email_outbox_obj(email.id)
+            self.assertEqual(email.state, 'pending')
+            self.assertEqual(email.attempts, 1)
+            self.assertTrue(email.next_attempt)
+            self.assertEqual(email.last_error, 'Temporary failure')
+
+            # Not due yet
+            self.mocked_smtp_instance.sendmail.side_effect = None
+            self.email_outbox_obj.send_pending(commit=False)
+            self.assertEqual(
+                self.mocked_smtp_instance.sendmail.call_count, 1
+            )
+
+            self.email_outbox_obj.write([email], {'next_attempt': None})
+            self.email_outbox_obj.send_pending(commit=False)
+            email = self.email_outbox_obj(email.id)
+            self.assertEqual(email.state, 'sent')
+            self.assertEqual(
+                self.mocked_smtp_instance.sendmail.call_args[0],
+                ('from@xyz.com', ['to@xyz.com'], 'message')
+            )
+
+    def test_0013_email_outbox_batches(self):
+        """
+        Each batch sent is committed, even if a later batch fails
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            first, second = [
+                self.email_outbox_obj.enqueue(
+                    'from@xyz.com', ['to@xyz.com'], 'message %d' % i
+                ) for i in range(2)
+            ]
+            self.mocked_smtp_instance.sendmail.side_effect = [
+                None, RuntimeError('Broken')
+            ]
+            with patch.dict(CONFIG.options, {'nereid_email_batch_size': 1}):
+                with patch.object(Transaction().cursor, 'commit') as commit:
+                    self.assertRaises(
+                        RuntimeError, self.email_outbox_obj.send_pending
+                    )
+            self.assertEqual(commit.call_count, 1)
+            self.assertEqual(self.email_outbox_obj(first.id).state, 'sent')
+            self.assertEqual(
+                self.email_outbox_obj(second.id).state, 'pending'
+            )
+
     def test_0015_match_password(self):
         """
         Assert that matching of password works
@@ -193,6 +311,151 @@ class TestAuth(NereidTestCase):
             }])
             self.assertTrue(registered_user.match_password('password'))
 
+    def test_0016_password_rehash(self):
+        """
+        Passwords stored with SHA-1 are hashed again on login
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            party, = self.party_obj.create([{'name': 'Legacy User'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Legacy User',
+                'email': 'legacy@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+
+            table = self.nereid_user_obj.__table__()
+            Transaction().cursor.execute(*table.update(
+                [table.password, table.salt],
+                [hashlib.sha1('password' + 'abcd1234').hexdigest(),
+                    'abcd1234'],
+                where=table.id == user.id
+            ))
+            user = self.nereid_user_obj(user.id)
+            self.assertTrue(user.match_password('password'))
+
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'legacy@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(response.status_code, 302)
+
+            user = self.nereid_user_obj(user.id)
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+            self.assertEqual(user.salt, None)
+            self.assertTrue(user.match_password('password'))
+
+    def test_0017_login_lookup(self):
+        """
+        Logins are looked up by company and email ignoring its case, and
+        unknown emails are remembered until a user gets the email
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            company = self.company.id
+
+            self.assertEqual(
+                self.nereid_user_obj.get_login_row('new@example.com', company),
+                []
+            )
+            self.assertTrue(
+                self.nereid_user_obj._unknown_emails_cache.get(
+                    (company, 'new@example.com')
+                )
+            )
+
+            party, = self.party_obj.create([{'name': 'New User'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'New User',
+                'email': 'new@example.com',
+                'password': 'password',
+                'company': self.company,
+            }])
+            (user_id, hashed, salt, activation_code, expires), = \
+                self.nereid_user_obj.get_login_row('NEW@example.com', company)
+            self.assertEqual(user_id, user.id)
+            self.assertTrue(
+                self.nereid_user_obj.check_password('password', hashed, salt)
+            )
+
+    def test_0018_import_rows(self):
+        """
+        Users are created in bulk with their parties
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            password = make_password('password')
+
+            users, failures = self.nereid_user_obj.import_rows([
+                (1, {
+                    'name': 'Imported User',
+                    'email': 'imported@example.com',
+                    'password': password,
+                }),
+                (2, {
+                    'name': 'Duplicate User',
+                    'email': 'GUEST@openlabs.co.in',
+                    'password': password,
+                }),
+                (3, {'email': 'nameless@example.com', 'password': password}),
+                (4, {
+                    'name': 'Imported User',
+                    'email': 'imported@example.com',
+                    'password': password,
+                }),
+                (5, {
+                    'name': 'Other User',
+                    'email': 'other@example.com',
+                    'password': make_password('other'),
+                }),
+            ], self.company.id)
+
+            self.assertEqual([line for line, error in failures], [2, 3, 4])
+            user, other = users
+            self.assertTrue(other.match_password('other'))
+            self.assertFalse(other.match_password('password'))
+            self.assertEqual(user.party.name, 'Imported User')
+            self.assertEqual(user.display_name, 'Imported User')
+            self.assertEqual(len(user.party.addresses), 0)
+            self.assertEqual(user.password, password)
+            self.assertTrue(user.match_password('password'))
+
+            # Writes always hash the password, whatever the context
+            with Transaction().set_context(nereid_password_hashed=True):
+                self.nereid_user_obj.write([user], {'password': password})
+            user = self.nereid_user_obj(user.id)
+            self.assertNotEqual(user.password, password)
+            self.assertTrue(user.match_password(password))
+
+    def test_0019_import_file(self):
+        """
+        The rows of a file which cannot be read are reported as failures
+        """
+        rows = read_rows(StringIO(
+            'name,email,password\n'
+            'One,one@example.com,password\n'
+            'Two,two@example.com,password,extra\n'
+            'Three,three@example.com\n'
+        ), 'csv')
+        user_import = UserImport(DB_NAME, None, chunk_size=2)
+        chunks = list(user_import.chunks(rows))
+        self.assertEqual(
+            [[line for line, row in chunk] for chunk in chunks], [[1, 3]]
+        )
+        self.assertEqual(chunks[0][1][1], {
+            'name': u'Three', 'email': u'three@example.com',
+        })
+        line, error = user_import.failures[0]
+        self.assertEqual(line, 2)
+        self.assertEqual(user_import.rows, 1)
+
     def test_0020_activation(self):
         """
         Activation must happen before login is possible
@@ -252,6 +515,104 @@ class TestAuth(NereidTestCase):
                 registered_user = self.nereid_user_obj(registered_user.id)
                 self.assertEqual(response.status_code, 302)
 
+    def test_0021_expired_activation(self):
+        """
+        An expired activation link is replaced on login with the right
+        password, and a reset link activates the account as well
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            token_obj = POOL.get('nereid.user.token')
+
+            party, = self.party_obj.create([{'name': 'Late User'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Late User',
+                'email': 'late@example.com',
+                'password': 'password',
+                'company': self.company.id,
+            }])
+            code = user.create_act_code()
+            token, = token_obj.search([('code', '=', code)])
+            token_obj.write([token], {
+                'expires': datetime.utcnow() - timedelta(hours=1),
+            })
+
+            with app.test_client() as c:
+                response = c.post('/en_US/login', data={
+                    'email': 'late@example.com',
+                    'password': 'wrong',
+                })
+                self.assertTrue(
+                    "Your account has not been activated yet" in response.data
+                )
+                self.assertEqual(self.email_outbox_obj.search([]), [])
+
+                response = c.post('/en_US/login', data={
+                    'email': 'late@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(
+                    "Your activation link expired" in response.data
+                )
+                self.assertEqual(len(self.email_outbox_obj.search([])), 1)
+                new_code = self.nereid_user_obj(user.id).activation_code
+                self.assertTrue(new_code)
+                self.assertNotEqual(new_code, code)
+
+                response = c.get(
+                    '/en_US/activate-account/%s/%s' % (user.id, new_code)
+                )
+                self.assertEqual(response.status_code, 302)
+
+            # A reset code also activates the account
+            user.create_act_code()
+            reset_code = user.create_act_code('reset')
+            with app.test_client() as c:
+                c.get(
+                    '/en_US/activate-account/%s/%s' % (user.id, reset_code)
+                )
+                response = c.post('/en_US/login', data={
+                    'email': 'late@example.com',
+                    'password': 'password',
+                })
+                self.assertEqual(response.status_code, 302)
+
+    def test_0025_user_tokens(self):
+        """
+        Tokens are consumed once, expire and are purged
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            token_obj = POOL.get('nereid.user.token')
+            user_id = self.guest_user.id
+
+            code = self.guest_user.create_act_code('reset')
+            self.assertEqual(len(code), 12)
+            self.assertEqual(
+                self.nereid_user_obj(user_id).activation_code, code
+            )
+            # A new token replaces the previous one
+            new_code = self.guest_user.create_act_code('reset')
+            self.assertEqual(token_obj.consume(user_id, code), None)
+            self.assertEqual(token_obj.consume(user_id, new_code), 'reset')
+            self.assertEqual(token_obj.consume(user_id, new_code), None)
+            self.assertFalse(self.nereid_user_obj(user_id).activation_code)
+
+            code = self.guest_user.create_act_code('reset')
+            token, = token_obj.search([('code', '=', code)])
+            token_obj.write([token], {
+                'expires': datetime.utcnow() - timedelta(hours=1),
+            })
+            self.assertEqual(token_obj.consume(user_id, code), None)
+            self.guest_user.create_act_code('new')
+            self.assertEqual(token_obj.purge_expired(commit=False), 1)
+            token, = token_obj.search([('nereid_user', '=', user_id)])
+            self.assertEqual(token.type, 'activation')
+            self.assertEqual(token.expires, None)
+
     def test_0030_change_password(self):
         """
         Check password changing functionality
@@ -669,6 +1030,95 @@ class TestAuth(NereidTestCase):
                 perm_any=[p3.value, p4.value]
             ))
 
+    def test_0105_permissions_cache(self):
+        '''
+        The cached permissions follow the changes of the permissions
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            p1, p2 = self.nereid_permission_obj.create([
+                {'name': 'p1', 'value': 'nereid.perm1'},
+                {'name': 'p2', 'value': 'nereid.perm2'},
+            ])
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p1])]}
+            )
+            self.assertEqual(
+                self.guest_user.get_permissions(),
+                frozenset(['nereid.perm1'])
+            )
+            self.assertEqual(
+                self.guest_user.get_permissions_mask(),
+                self.nereid_permission_obj.get_mask(['nereid.perm1'])
+            )
+
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p2])]}
+            )
+            self.assertTrue(self.guest_user.has_permissions(
+                perm_all=['nereid.perm1', 'nereid.perm2']
+            ))
+
+            self.nereid_permission_obj.write([p2], {'value': 'nereid.perm3'})
+            self.assertFalse(self.guest_user.has_permissions(
+                perm_all=['nereid.perm2']
+            ))
+            self.assertTrue(self.guest_user.has_permissions(
+                perm_any=['nereid.perm2', 'nereid.perm3']
+            ))
+
+    def test_0107_has_permissions_many(self):
+        '''
+        Permissions of many users are checked at once
+        '''
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            p1, p2, p3 = self.nereid_permission_obj.create([
+                {'name': 'p1', 'value': 'nereid.perm1'},
+                {'name': 'p2', 'value': 'nereid.perm2'},
+                {'name': 'p3', 'value': 'nereid.perm3'},
+            ])
+            party, = self.party_obj.create([{'name': 'Registered user'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Registered User',
+                'email': 'email@example.com',
+                'password': 'password',
+                'company': self.company,
+                'permissions': [('add', [p1, p2])],
+            }])
+            self.nereid_user_obj.write(
+                [self.guest_user], {'permissions': [('add', [p1])]}
+            )
+            users = [self.guest_user, user]
+
+            for perm_all, perm_any in [
+                    ([], []),
+                    (['nereid.perm1'], []),
+                    (['nereid.perm1', 'nereid.perm2'], []),
+                    ([], ['nereid.perm2', 'nereid.perm3']),
+                    (['nereid.perm1'], ['nereid.perm3']),
+                    (['nereid.unknown'], []),
+                    ]:
+                self.assertEqual(
+                    self.nereid_user_obj.has_permissions_many(
+                        users, perm_all, perm_any
+                    ),
+                    dict(
+                        (u.id, u.has_permissions(perm_all, perm_any))
+                        for u in users
+                    )
+                )
+
+            # More permissions than the database accepts in a query
+            with patch.object(Transaction().cursor, 'IN_MAX', 2):
+                self.assertEqual(
+                    self.nereid_user_obj.has_permissions_many(
+                        users, [], ['nereid.perm2', 'nereid.perm3']
+                    ),
+                    {self.guest_user.id: False, user.id: True}
+                )
+
     def test_0110_user_management(self):
         """
         ensure that the cookie gets cleared if the user in session
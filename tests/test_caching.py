@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+
+
+class TestCaching(NereidTestCase):
+    """
+    Test the response cache
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_website_locale_obj = POOL.get('nereid.website.locale')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.url_rule_obj = POOL.get('nereid.url_rule')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+
+        self.templates = {
+            'home.jinja': '{{ calls.append(1) or calls|length }}',
+        }
+
+    def setup_defaults(self):
+        """
+        Setup the defaults
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        eur, = self.currency_obj.create([{
+            'name': 'Euro',
+            'code': 'EUR',
+            'symbol': 'E',
+        }])
+        self.party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        self.company, = self.company_obj.create([{
+            'party': self.party,
+            'currency': usd,
+        }])
+        self.guest_party, = self.party_obj.create([{
+            'name': 'Guest User',
+        }])
+        self.guest_user, = self.nereid_user_obj.create([{
+            'party': self.guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': self.company.id,
+        }])
+        self.registered_users = []
+        for name in ('One', 'Two'):
+            party, = self.party_obj.create([{'name': name}])
+            self.registered_users.extend(self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': name,
+                'email': '%s@openlabs.co.in' % name.lower(),
+                'password': 'password',
+                'company': self.company.id,
+            }]))
+
+        url_map, = self.url_map_obj.search([], limit=1)
+        self.home_rule, = self.url_rule_obj.search([
+            ('url_map', '=', url_map.id),
+            ('endpoint', '=', 'nereid.website.home'),
+        ], limit=1)
+        self.url_rule_obj.write([self.home_rule], {'cache_timeout': 300})
+
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        es_es, = self.language_obj.search([('code', '=', 'es_ES')])
+        locale_en_us, locale_es_es = self.nereid_website_locale_obj.create([{
+            'code': 'en_US',
+            'language': en_us,
+            'currency': usd,
+        }, {
+            'code': 'es_ES',
+            'language': es_es,
+            'currency': eur,
+        }])
+        self.website, = self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': url_map,
+            'company': self.company,
+            'application_user': USER,
+            'default_locale': locale_en_us,
+            'locales': [('add', [locale_en_us.id, locale_es_es.id])],
+            'guest_user': self.guest_user,
+        }])
+
+    def get_template_source(self, name):
+        """
+        Return templates
+        """
+        return self.templates.get(name)
+
+    def get_caching_app(self):
+        """
+        Returns an application with a shared cache, whose home page shows
+        the number of times it was rendered
+        """
+        app = self.get_app(CACHE_TYPE='werkzeug.contrib.cache.SimpleCache')
+        app.jinja_env.globals['calls'] = []
+        return app
+
+    def login(self, client, user):
+        response = client.post('/en_US/login', data={
+            'email': user.email,
+            'password': 'password',
+        })
+        self.assertEqual(response.status_code, 302)
+
+    def test_0010_cache_hit(self):
+        """
+        The second request is served from the cache
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_caching_app()
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+                self.assertEqual(c.get('/en_US/').data, '1')
+
+                # Other methods are never cached
+                self.assertEqual(c.head('/en_US/').status_code, 200)
+                self.assertEqual(
+                    len(app.jinja_env.globals['calls']), 2
+                )
+
+    def test_0020_cache_vary_locale(self):
+        """
+        Each language gets its own response
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_caching_app()
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+                self.assertEqual(c.get('/es_ES/').data, '2')
+                self.assertEqual(c.get('/en_US/').data, '1')
+
+    def test_0030_cache_vary_currency(self):
+        """
+        Each currency gets its own response, the locale set apart
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.url_rule_obj.write([self.home_rule], {
+                'cache_vary_locale': False,
+                'cache_vary_currency': True,
+            })
+            app = self.get_caching_app()
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+                self.assertEqual(c.get('/es_ES/').data, '2')
+                self.assertEqual(c.get('/es_ES/').data, '2')
+
+    def test_0040_cache_vary_user(self):
+        """
+        Guests share a response and each logged in user gets their own
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_caching_app()
+            one, two = self.registered_users
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+
+                self.login(c, one)
+                self.assertEqual(c.get('/en_US/').data, '2')
+                self.assertEqual(c.get('/en_US/').data, '2')
+
+            with app.test_client() as c:
+                self.login(c, two)
+                self.assertEqual(c.get('/en_US/').data, '3')
+
+    def test_0050_cache_invalidation(self):
+        """
+        Changing the rules stops serving the responses cached before
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_caching_app()
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/').data, '1')
+                self.assertEqual(c.get('/en_US/').data, '1')
+
+                self.url_rule_obj.write([self.home_rule], {
+                    'cache_timeout': 600,
+                })
+                self.assertEqual(c.get('/en_US/').data, '2')
+                self.assertEqual(c.get('/en_US/').data, '2')
+
+                self.url_rule_obj.write([self.home_rule], {
+                    'cache_timeout': None,
+                })
+                self.assertEqual(c.get('/en_US/').data, '3')
+                self.assertEqual(c.get('/en_US/').data, '4')
+
+    def test_0060_cache_conditional(self):
+        """
+        Cached responses answer conditional requests with a 304
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            rule, = self.url_rule_obj.search([
+                ('url_map', '=', self.home_rule.url_map.id),
+                ('endpoint', '=', 'nereid.website.country_list'),
+            ], limit=1)
+            self.url_rule_obj.write([rule], {'cache_timeout': 300})
+            app = self.get_caching_app()
+
+            with app.test_client() as c:
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                etag = response.headers['ETag']
+
+                response = c.get('/en_US/countries')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.headers['ETag'], etag)
+
+                response = c.get(
+                    '/en_US/countries', headers=[('If-None-Match', etag)]
+                )
+                self.assertEqual(response.status_code, 304)
+
+
+def suite():
+    "Caching test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCaching)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from nereid.testing import NereidTestCase
+from trytond.modules.nereid.middleware import RedirectMiddleware, \
+    SiteDispatcher
+
+
+class TestMiddleware(NereidTestCase):
+    """
+    Test the WSGI middlewares
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_website_locale_obj = POOL.get('nereid.website.locale')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.url_rule_obj = POOL.get('nereid.url_rule')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+
+        self.templates = {
+            'home.jinja': 'home',
+        }
+
+    def setup_defaults(self):
+        """
+        Setup the defaults
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        self.party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        self.company, = self.company_obj.create([{
+            'party': self.party,
+            'currency': usd,
+        }])
+        self.guest_party, = self.party_obj.create([{
+            'name': 'Guest User',
+        }])
+        self.guest_user, = self.nereid_user_obj.create([{
+            'party': self.guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': self.company.id,
+        }])
+
+        self.url_map, = self.url_map_obj.search([], limit=1)
+        self.url_rule_obj.create([{
+            'rule': '/old-page',
+            'endpoint': 'nereid.website.home',
+            'redirect_to': '/login',
+            'sequence': 500,
+            'url_map': self.url_map,
+        }, {
+            'rule': '/old-account',
+            'endpoint': 'nereid.website.home',
+            'redirect_to': '/account',
+            'sequence': 500,
+            'url_map': self.url_map,
+        }])
+
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        locale, = self.nereid_website_locale_obj.create([{
+            'code': 'en_US',
+            'language': en_us,
+            'currency': usd,
+        }])
+        self.website, = self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': self.url_map,
+            'company': self.company,
+            'application_user': USER,
+            'default_locale': locale,
+            'locales': [('add', [locale.id])],
+            'guest_user': self.guest_user,
+        }])
+
+    def get_template_source(self, name):
+        """
+        Return templates
+        """
+        return self.templates.get(name)
+
+    def test_0010_redirect_hits(self):
+        """
+        Redirects are answered from the table and counted
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            middleware = app.wsgi_app = RedirectMiddleware(app)
+
+            with app.test_client() as c:
+                response = c.get('/old-page')
+                self.assertEqual(response.status_code, 301)
+                self.assertEqual(
+                    response.location, 'http://localhost/login'
+                )
+                c.get('/old-page')
+                self.assertEqual(
+                    c.get('/en_US/').status_code, 200
+                )
+
+            self.assertEqual(middleware.hits, {('localhost', '/old-page'): 2})
+
+    def test_0020_redirect_locale(self):
+        """
+        The paths prefixed by a locale redirect to the prefixed target
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            app.wsgi_app = RedirectMiddleware(app)
+
+            with app.test_client() as c:
+                response = c.get('/en_US/old-page')
+                self.assertEqual(response.status_code, 301)
+                self.assertEqual(
+                    response.location, 'http://localhost/en_US/login'
+                )
+
+    def test_0030_redirect_methods(self):
+        """
+        Only the HTTP methods of the rule are redirected
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            middleware = app.wsgi_app = RedirectMiddleware(app)
+
+            with app.test_client() as c:
+                self.assertEqual(c.head('/old-page').status_code, 301)
+                self.assertNotEqual(c.post('/old-page').status_code, 301)
+                self.assertNotEqual(
+                    c.post('/en_US/old-page').status_code, 301
+                )
+
+            self.assertEqual(middleware.hits, {('localhost', '/old-page'): 1})
+
+    def test_0040_unused_redirects(self):
+        """
+        The redirects never requested are reported
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            middleware = app.wsgi_app = RedirectMiddleware(app)
+
+            self.assertEqual(
+                middleware.get_unused_redirects('localhost'), [
+                    '/en_US/old-account', '/en_US/old-page',
+                    '/old-account', '/old-page',
+                ]
+            )
+            with app.test_client() as c:
+                c.get('/old-page')
+                c.get('/en_US/old-account')
+            self.assertEqual(
+                middleware.get_unused_redirects('localhost'),
+                ['/en_US/old-page', '/old-account']
+            )
+
+    def test_0045_redirect_changes(self):
+        """
+        Changes of the rules are redirected at once, and unknown hosts have
+        no redirects
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            middleware = app.wsgi_app = RedirectMiddleware(app)
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/old-page').status_code, 301)
+                self.url_rule_obj.create([{
+                    'rule': '/older-page',
+                    'endpoint': 'nereid.website.home',
+                    'redirect_to': '/login',
+                    'sequence': 500,
+                    'url_map': self.url_map,
+                }])
+                self.assertEqual(c.get('/older-page').status_code, 301)
+
+            self.assertEqual(middleware.get_table('example.com'), {})
+
+    def test_0050_site_dispatcher(self):
+        """
+        Subdomains are served by their website with the current rules
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.url_map_obj.write(
+                [self.url_map], {'default_subdomain': 'www'}
+            )
+            app = self.get_app()
+            dispatcher = app.wsgi_app = SiteDispatcher(app)
+
+            self.assertEqual(
+                dispatcher.get_website_name('www.localhost:5000'),
+                'localhost'
+            )
+            self.assertEqual(dispatcher.get_website_name('example.com'), None)
+            self.assertEqual(
+                dispatcher.get_website_name('shop.localhost'), None
+            )
+            self.assertEqual(
+                SiteDispatcher(app, match_subdomains=True).get_website_name(
+                    'shop.localhost'
+                ), 'localhost'
+            )
+
+            with app.test_client() as c:
+                response = c.get('/en_US/', base_url='http://www.localhost/')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, 'home')
+                self.assertEqual(
+                    c.get('/', base_url='http://example.com/').status_code,
+                    404
+                )
+
+                # Redirects keep the host of the request
+                response = c.get(
+                    '/en_US/account', base_url='http://www.localhost/'
+                )
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response.location.startswith(
+                    'http://www.localhost/en_US/login'
+                ))
+
+                self.url_rule_obj.create([{
+                    'rule': '/dispatched-home',
+                    'endpoint': 'nereid.website.home',
+                    'sequence': 500,
+                    'url_map': self.url_map,
+                }])
+                response = c.get(
+                    '/en_US/dispatched-home',
+                    base_url='http://www.localhost/'
+                )
+                self.assertEqual(response.data, 'home')
+
+
+def suite():
+    "Middleware test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestMiddleware)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from nereid import url_for
+from nereid.testing import NereidTestCase
+from nereid.globals import _request_ctx_stack, request, session
+from werkzeug.exceptions import MethodNotAllowed
+from trytond.modules.nereid.caching import request_records, request_user
+from trytond.modules.nereid.routing import use_compiled_url_maps
+from trytond.modules.nereid.trie import PrefixTrieMapAdapter
+
+CONFIG.options['data_path'] = '/tmp/temp_tryton_data/'
+
+
+class TestRouting(NereidTestCase):
+    """
+    Test the loading and caching of URL rules
+    """
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('nereid')
+
+        self.nereid_website_obj = POOL.get('nereid.website')
+        self.nereid_website_locale_obj = POOL.get('nereid.website.locale')
+        self.nereid_user_obj = POOL.get('nereid.user')
+        self.url_map_obj = POOL.get('nereid.url_map')
+        self.url_rule_obj = POOL.get('nereid.url_rule')
+        self.url_rule_defaults_obj = POOL.get('nereid.url_rule_defaults')
+        self.company_obj = POOL.get('company.company')
+        self.currency_obj = POOL.get('currency.currency')
+        self.language_obj = POOL.get('ir.lang')
+        self.party_obj = POOL.get('party.party')
+        self.country_obj = POOL.get('country.country')
+
+    def setup_defaults(self):
+        """
+        Setup the defaults
+        """
+        usd, = self.currency_obj.create([{
+            'name': 'US Dollar',
+            'code': 'USD',
+            'symbol': '$',
+        }])
+        self.party, = self.party_obj.create([{
+            'name': 'Openlabs',
+        }])
+        self.company, = self.company_obj.create([{
+            'party': self.party,
+            'currency': usd,
+        }])
+        self.guest_party, = self.party_obj.create([{
+            'name': 'Guest User',
+        }])
+        self.guest_user, = self.nereid_user_obj.create([{
+            'party': self.guest_party,
+            'display_name': 'Guest User',
+            'email': 'guest@openlabs.co.in',
+            'password': 'password',
+            'company': self.company.id,
+        }])
+
+        self.url_map, = self.url_map_obj.search([], limit=1)
+        en_us, = self.language_obj.search([('code', '=', 'en_US')])
+        locale, = self.nereid_website_locale_obj.create([{
+            'code': 'en_US',
+            'language': en_us,
+            'currency': usd,
+        }])
+        self.website, = self.nereid_website_obj.create([{
+            'name': 'localhost',
+            'url_map': self.url_map,
+            'company': self.company,
+            'application_user': USER,
+            'default_locale': locale,
+            'locales': [('add', [locale.id])],
+            'guest_user': self.guest_user,
+        }])
+
+    def test_0010_rules_cache(self):
+        """
+        Changing a rule must invalidate the cached rules and the version
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            version = self.url_map_obj.get_rules_version()
+            rules = self.url_map.get_rules_arguments()
+            self.assertEqual(self.url_map_obj.get_rules_version(), version)
+
+            # Callers pop values, which must not leak into the cache
+            rules[0].pop('rule')
+            self.assertTrue(
+                'rule' in self.url_map.get_rules_arguments()[0]
+            )
+
+            rule, = self.url_rule_obj.create([{
+                'rule': '/cached-rule',
+                'endpoint': 'nereid.website.home',
+                'sequence': 500,
+                'url_map': self.url_map,
+            }])
+            self.assertNotEqual(
+                self.url_map_obj.get_rules_version(), version
+            )
+            self.assertEqual(
+                len(self.url_map.get_rules_arguments()), len(rules) + 1
+            )
+
+            version = self.url_map_obj.get_rules_version()
+            self.url_rule_defaults_obj.create([{
+                'key': 'page',
+                'value': '1',
+                'rule': rule,
+            }])
+            self.assertNotEqual(
+                self.url_map_obj.get_rules_version(), version
+            )
+            args, = [
+                r for r in self.url_map.get_rules_arguments()
+                if r['rule'] == '/cached-rule'
+            ]
+            self.assertEqual(args['defaults'], {'page': '1'})
+
+    def test_0015_bulk_loader(self):
+        """
+        The bulk loader must return the same arguments as the rules
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            rule, = self.url_rule_obj.create([{
+                'rule': '/bulk-rule',
+                'endpoint': 'nereid.website.home',
+                'sequence': 1,
+                'http_method_post': True,
+                'url_map': self.url_map,
+                'defaults': [('create', [{'key': 'page', 'value': '1'}])],
+            }])
+            self.url_rule_obj.create([{
+                'rule': '/inactive-rule',
+                'endpoint': 'nereid.website.home',
+                'sequence': 1,
+                'active': False,
+                'url_map': self.url_map,
+            }])
+            rules = self.url_rule_obj.search([
+                ('url_map', '=', self.url_map.id),
+            ])
+            self.assertEqual(
+                self.url_rule_obj.get_rules_arguments_for_map(
+                    self.url_map.id
+                ),
+                [r.get_rule_arguments() for r in rules]
+            )
+            self.assertEqual(
+                self.url_rule_obj.get_rules_arguments_for_map(
+                    self.url_map.id
+                )[0], {
+                    'rule': '/bulk-rule',
+                    'endpoint': 'nereid.website.home',
+                    'methods': ['GET', 'POST'],
+                    'build_only': False,
+                    'defaults': {'page': '1'},
+                    'redirect_to': None,
+                }
+            )
+
+    def test_0020_compiled_url_map(self):
+        """
+        The compiled map is reused until the rules change
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            url_map = self.website.get_url_map()
+            self.assertTrue(self.website.get_url_map() is url_map)
+
+            adapter = url_map.bind('localhost')
+            self.assertEqual(
+                adapter.match('/login')[0], 'nereid.website.login'
+            )
+
+            self.url_rule_obj.create([{
+                'rule': '/compiled-rule',
+                'endpoint': 'nereid.website.home',
+                'sequence': 500,
+                'url_map': self.url_map,
+            }])
+            new_url_map = self.website.get_url_map()
+            self.assertFalse(new_url_map is url_map)
+            self.assertEqual(
+                new_url_map.bind('localhost').match('/compiled-rule')[0],
+                'nereid.website.home'
+            )
+
+    def test_0025_live_rule_change(self):
+        """
+        Requests are matched with the current rules of the website
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = use_compiled_url_maps(self.get_app())
+
+            with app.test_client() as c:
+                self.assertEqual(c.get('/en_US/live-status').status_code, 404)
+
+                self.url_rule_obj.create([{
+                    'rule': '/live-status',
+                    'endpoint': 'nereid.website.user_status',
+                    'sequence': 500,
+                    'url_map': self.url_map,
+                }])
+                self.assertEqual(c.get('/en_US/live-status').status_code, 200)
+                self.assertEqual(c.get('/live-status').status_code, 200)
+
+                # The language prefix is added when URLs are built
+                with app.test_request_context('/en_US/'):
+                    self.assertEqual(
+                        url_for('nereid.website.user_status'),
+                        '/en_US/live-status'
+                    )
+
+    def test_0030_routing_snapshot(self):
+        """
+        Snapshots are used until the URL map changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.nereid_website_obj.write_routing_snapshots(
+                    [self.website]
+                ),
+                [self.website.get_routing_snapshot_path()]
+            )
+            self.assertEqual(
+                self.website.load_routing_snapshot(),
+                self.url_map.get_rules_arguments()
+            )
+
+            # The button returns no action to the client
+            self.assertEqual(
+                self.nereid_website_obj.dump_routing_snapshots(
+                    [self.website]
+                ), None
+            )
+
+            self.url_rule_obj.create([{
+                'rule': '/snapshot-rule',
+                'endpoint': 'nereid.website.home',
+                'sequence': 500,
+                'url_map': self.url_map,
+            }])
+            self.assertEqual(self.website.load_routing_snapshot(), None)
+            self.assertTrue(
+                '/snapshot-rule' in [
+                    r['rule'] for r in self.website.get_rules_arguments()
+                ]
+            )
+
+    def test_0040_prefix_trie(self):
+        """
+        The prefix trie matcher must match like the linear matcher
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            linear = self.website.get_url_map().bind('localhost')
+
+            self.url_map_obj.write([self.url_map], {'prefix_trie': True})
+            self.website = self.nereid_website_obj(self.website.id)
+            indexed = self.website.get_url_map().bind('localhost')
+            self.assertTrue(hasattr(indexed.map, 'trie'))
+
+            for path, method in [
+                    ('/', 'GET'),
+                    ('/login', 'POST'),
+                    ('/static-file/test/test.png', 'GET'),
+                    ('/activate-account/1/code', 'GET'),
+                    ]:
+                self.assertEqual(
+                    indexed.match(path, method), linear.match(path, method)
+                )
+            self.assertRaises(
+                MethodNotAllowed, indexed.match, '/countries', 'POST'
+            )
+
+            # Requests are matched by the trie as well
+            app = use_compiled_url_maps(self.get_app())
+            with app.test_request_context('/en_US/login'):
+                adapter = _request_ctx_stack.top.url_adapter
+                self.assertTrue(isinstance(adapter, PrefixTrieMapAdapter))
+                self.assertEqual(
+                    adapter.match()[0], 'nereid.website.login'
+                )
+
+    def test_0050_redirect_table(self):
+        """
+        Redirect rules with an exact path are compiled into a table
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.url_rule_obj.create([{
+                'rule': '/old-page',
+                'endpoint': 'nereid.website.home',
+                'redirect_to': '/login',
+                'sequence': 500,
+                'url_map': self.url_map,
+            }, {
+                'rule': '/old-page/<int:page>',
+                'endpoint': 'nereid.website.home',
+                'redirect_to': '/login',
+                'sequence': 500,
+                'url_map': self.url_map,
+            }])
+            methods = frozenset(['GET', 'HEAD'])
+            self.assertEqual(
+                self.url_map.get_redirect_table(),
+                {'/old-page': ('/login', methods)}
+            )
+            self.assertEqual(
+                self.website.get_redirect_table(), {
+                    '/old-page': ('/login', methods),
+                    '/en_US/old-page': ('/en_US/login', methods),
+                }
+            )
+
+            # The paths are prefixed by the language, like the rules
+            self.nereid_website_locale_obj.write(
+                list(self.website.locales), {'code': 'en'}
+            )
+            self.assertTrue(
+                '/en_US/old-page' in self.website.get_redirect_table()
+            )
+
+    def test_0060_host_table(self):
+        """
+        Websites are found by their name and default subdomain
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.assertEqual(
+                self.nereid_website_obj.get_host_table(),
+                {'localhost': 'localhost'}
+            )
+            self.url_map_obj.write(
+                [self.url_map], {'default_subdomain': 'www'}
+            )
+            self.assertEqual(
+                self.nereid_website_obj.get_host_table(), {
+                    'localhost': 'localhost',
+                    'www.localhost': 'localhost',
+                }
+            )
+
+    def test_0070_website_snapshot(self):
+        """
+        The snapshot holds the configuration and follows its changes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            snapshot = self.website.get_snapshot()
+            self.assertTrue(self.website.get_snapshot() is snapshot)
+            self.assertEqual(snapshot.company, self.company.id)
+            self.assertEqual(snapshot.company_currency.code, 'USD')
+            self.assertEqual(snapshot.default_locale.code, 'en_US')
+            self.assertEqual(snapshot.default_locale.language, 'en_US')
+            self.assertEqual(snapshot.guest_user, self.guest_user.id)
+            self.assertEqual(snapshot.countries, ())
+            self.assertRaises(
+                AttributeError, setattr, snapshot, 'company', None
+            )
+
+            country, = self.country_obj.create([{
+                'name': 'India',
+                'code': 'IN',
+            }])
+            self.nereid_website_obj.write([self.website], {
+                'countries': [('add', [country.id])],
+            })
+            snapshot = self.website.get_snapshot()
+            self.assertEqual(
+                [(c.id, c.name) for c in snapshot.countries],
+                [(country.id, 'India')]
+            )
+            self.assertEqual(snapshot.country_ids, frozenset([country.id]))
+
+            # Related records invalidate the snapshot as well
+            self.country_obj.write([country], {'name': 'Bharat'})
+            self.assertEqual(
+                self.website.get_snapshot().countries[0].name, 'Bharat'
+            )
+            eur, = self.currency_obj.create([{
+                'name': 'Euro',
+                'code': 'EUR',
+                'symbol': 'E',
+            }])
+            self.company_obj.write([self.company], {'currency': eur.id})
+            self.assertEqual(
+                self.website.get_snapshot().company_currency.code, 'EUR'
+            )
+
+    def test_0080_currencies_cache(self):
+        """
+        The cached currencies follow the changes of the website currencies
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                self.assertEqual(self.website.get_currencies(), [])
+                version = self.nereid_website_obj.get_currencies_version()
+
+                self.nereid_website_obj.write([self.website], {
+                    'currencies': [('add', [self.company.currency.id])],
+                })
+                self.assertNotEqual(
+                    self.nereid_website_obj.get_currencies_version(), version
+                )
+                self.assertEqual(self.website.get_currencies(), [{
+                    'id': self.company.currency.id,
+                    'name': 'US Dollar',
+                    'symbol': '$',
+                }])
+
+    def test_0090_request_records(self):
+        """
+        Records and values are loaded once per request
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            with app.test_request_context('/'):
+                records = request_records()
+                self.assertTrue(request_records() is records)
+
+                user = records.record('nereid.user', self.guest_user.id)
+                self.assertTrue(
+                    records.record('nereid.user', self.guest_user.id) is user
+                )
+                party = records.related(user, 'party')
+                self.assertEqual(party, self.guest_party)
+                self.assertTrue(records.related(user, 'party') is party)
+                self.assertEqual(records.stats, {'hits': 2, 'misses': 2})
+
+                records.forget(user, 'party')
+                records.related(user, 'party')
+                self.assertEqual(records.misses, 3)
+                records.forget(user)
+                self.assertEqual(records.values, {})
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    request_records().stats, {'hits': 0, 'misses': 0}
+                )
+
+            # The handlers of a logged in request share its user and party
+            with app.test_request_context('/'):
+                session['user'] = self.guest_user.id
+                self.assertTrue(request_user() is request.nereid_user)
+                context = self.nereid_website_obj.account_context()
+                self.assertTrue(context['user'] is request.nereid_user)
+                self.assertTrue(
+                    self.nereid_website_obj.account_context()['party']
+                    is context['party']
+                )
+                self.nereid_website_obj._user_status()
+                self.assertEqual(
+                    request_records().stats, {'hits': 4, 'misses': 3}
+                )
+
+    def test_0100_guest_user(self):
+        """
+        Guests get the cached snapshot of the guest user of the website
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            guest_user = self.website.get_guest_user()
+            self.assertTrue(self.website.get_guest_user() is guest_user)
+            self.assertEqual(guest_user.id, self.guest_user.id)
+            self.assertEqual(guest_user.display_name, 'Guest User')
+            self.assertEqual(guest_user.party.name, 'Guest User')
+            self.assertRaises(
+                AttributeError, setattr, guest_user, 'display_name', None
+            )
+
+            with app.test_request_context('/'):
+                self.assertEqual(request_user(), guest_user)
+                self.assertEqual(request_records().stats['misses'], 0)
+
+            self.nereid_user_obj.write([self.guest_user], {
+                'display_name': 'Visitor',
+            })
+            self.assertEqual(
+                self.website.get_guest_user().display_name, 'Visitor'
+            )
+            # Fields outside the snapshot keep it cached
+            guest_user = self.website.get_guest_user()
+            self.party_obj.write([self.guest_party], {'active': True})
+            self.assertTrue(self.website.get_guest_user() is guest_user)
+
+            self.party_obj.write([self.guest_party], {'name': 'Visitors'})
+            self.assertEqual(
+                self.website.get_guest_user().party.name, 'Visitors'
+            )
+
+
+def suite():
+    "Nereid test suite"
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestRouting)
+    )
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -8,9 +8,14 @@
     :copyright: (c) 2012-2013 by Openlabs Technologies & Consulting (P) LTD
     :license: GPLv3, see LICENSE for more details.
 """
+import os
 import new
+import gzip
+import json
+import hashlib
 import unittest
 import functools
+from StringIO import StringIO
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
@@ -18,6 +23,7 @@ from trytond.transaction import Transaction
 from trytond.config import CONFIG
 from nereid.testing import NereidTestCase
 from nereid import render_template
+from trytond.modules.nereid import static_file as static_file_module
 
 CONFIG['smtp_server'] = 'smtpserver'
 CONFIG['smtp_user'] = 'test@xyz.com'
@@ -209,6 +215,369 @@ class TestStaticFile(NereidTestCase):
                 )
                 self.assertEqual(rv.status_code, 200)
 
+    def test_0040_static_file_urls(self):
+        """
+        Build the URLs of many files at once
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            local_file = self.create_static_file(buffer('test-content'))
+            remote_file, = self.static_file_obj.create([{
+                'name': 'remote.png',
+                'folder': local_file.folder,
+                'type': 'remote',
+                'remote_path': 'http://openlabs.co.in/logo.png',
+            }])
+            self.assertEqual(
+                self.static_file_obj.get_urls([local_file, remote_file]),
+                [None, None]
+            )
+
+            app = self.get_app()
+            with app.test_request_context('/en_US/'):
+                local_url, remote_url = self.static_file_obj.get_urls(
+                    [local_file, remote_file]
+                )
+                self.assertTrue(
+                    local_url.endswith('/static-file/test/test.png')
+                )
+                self.assertEqual(remote_url, 'http://openlabs.co.in/logo.png')
+
+                # The memoized URL is the same as the one built
+                self.assertEqual(local_file.url, local_url)
+
+    def test_0050_static_file_index(self):
+        """
+        Files and unknown files are served from the index, which follows
+        the changes of the files
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            entry = self.static_file_obj.get_index_entry('test', 'test.png')
+            self.assertEqual(entry['id'], static_file.id)
+            self.assertEqual(entry['path'], static_file.file_path)
+            self.assertEqual(entry['mimetype'], 'image/png')
+
+            self.assertEqual(
+                self.static_file_obj.get_index_entry('test', 'new.png'), None
+            )
+            self.assertEqual(
+                self.static_file_obj._index_cache.get(('test', 'new.png')),
+                False
+            )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                self.assertEqual(
+                    c.get('/en_US/static-file/test/new.png').status_code, 404
+                )
+                self.static_file_obj.create([{
+                    'name': 'new.png',
+                    'folder': static_file.folder,
+                    'file_binary': buffer('new-content'),
+                }])
+                rv = c.get('/en_US/static-file/test/new.png')
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'new-content')
+
+                self.static_file_obj.delete([static_file])
+                self.assertEqual(
+                    c.get('/en_US/static-file/test/test.png').status_code, 404
+                )
+
+    def test_0060_static_file_validators(self):
+        """
+        Conditional and range requests of static files
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            self.assertEqual(static_file.file_size, 12)
+            self.assertEqual(
+                static_file.checksum, hashlib.sha1('test-content').hexdigest()
+            )
+
+            app = self.get_app()
+            with app.test_client() as c:
+                url = '/en_US/static-file/test/test.png'
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.headers['Accept-Ranges'], 'bytes')
+                etag = rv.headers['ETag']
+                self.assertEqual(etag, '"%s"' % static_file.checksum)
+                last_modified = rv.headers['Last-Modified']
+
+                rv = c.get(url, headers=[('If-None-Match', etag)])
+                self.assertEqual(rv.status_code, 304)
+                self.assertEqual(rv.data, '')
+                rv = c.get(url, headers=[('If-None-Match', '"other"')])
+                self.assertEqual(rv.status_code, 200)
+                rv = c.get(
+                    url, headers=[('If-Modified-Since', last_modified)]
+                )
+                self.assertEqual(rv.status_code, 304)
+
+                rv = c.get(url, headers=[('Range', 'bytes=5-')])
+                self.assertEqual(rv.status_code, 206)
+                self.assertEqual(rv.data, 'content')
+                self.assertEqual(rv.headers['Content-Range'], 'bytes 5-11/12')
+                rv = c.get(url, headers=[('Range', 'bytes=-4')])
+                self.assertEqual(rv.data, 'tent')
+                rv = c.get(url, headers=[
+                    ('Range', 'bytes=0-3'), ('If-Range', etag),
+                ])
+                self.assertEqual(rv.status_code, 206)
+                self.assertEqual(rv.data, 'test')
+                rv = c.get(url, headers=[
+                    ('Range', 'bytes=0-3'), ('If-Range', '"other"'),
+                ])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'test-content')
+                rv = c.get(url, headers=[('Range', 'bytes=20-')])
+                self.assertEqual(rv.status_code, 416)
+                self.assertEqual(rv.headers['Content-Range'], 'bytes */12')
+
+    def test_0070_hashed_urls(self):
+        """
+        Files of folders with hashed URLs are served forever from URLs with
+        the digest of their content
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            self.static_folder_obj.write(
+                [static_file.folder], {'hashed_urls': True}
+            )
+            static_file = self.static_file_obj(static_file.id)
+            digest = static_file.checksum[:16]
+
+            app = self.get_app()
+            with app.test_request_context('/en_US/'):
+                url = static_file.url
+                self.assertTrue(
+                    url.endswith('/static-file/test/%s/test.png' % digest)
+                )
+                self.assertEqual(
+                    self.static_file_obj.get_urls([static_file]), [url]
+                )
+
+            with app.test_client() as c:
+                rv = c.get('/en_US/static-file/test/%s/test.png' % digest)
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.data, 'test-content')
+                self.assertEqual(
+                    rv.headers['Cache-Control'],
+                    'public, max-age=31536000, immutable'
+                )
+
+                self.static_file_obj.write([static_file], {
+                    'file_binary': buffer('new-content'),
+                })
+                new_digest = self.static_file_obj(
+                    static_file.id
+                ).checksum[:16]
+                rv = c.get('/en_US/static-file/test/%s/test.png' % digest)
+                self.assertEqual(rv.status_code, 302)
+                self.assertTrue(rv.location.endswith(
+                    '/static-file/test/%s/test.png' % new_digest
+                ))
+
+                # The URL without digest is still served
+                rv = c.get('/en_US/static-file/test/test.png')
+                self.assertEqual(rv.data, 'new-content')
+
+    def test_0080_precompressed_variants(self):
+        """
+        Compressible files are sent precompressed to the clients accepting
+        it
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            content = 'body { color: red; }\n' * 100
+            folder, = self.static_folder_obj.create([{
+                'folder_name': 'test',
+                'description': 'Test Folder'
+            }])
+            static_file, = self.static_file_obj.create([{
+                'name': 'style.css',
+                'folder': folder,
+                'file_binary': buffer(content),
+            }])
+            gzip_path = self.static_file_obj.get_variant_paths(
+                'test', 'style.css', static_file.checksum
+            )['gzip']
+            self.assertTrue(os.path.isfile(gzip_path))
+
+            app = self.get_app()
+            with app.test_client() as c:
+                url = '/en_US/static-file/test/style.css'
+                rv = c.get(url, headers=[('Accept-Encoding', 'gzip')])
+                self.assertEqual(rv.status_code, 200)
+                self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(rv.headers['Content-Type'].split(';')[0],
+                                 'text/css')
+                self.assertEqual(
+                    gzip.GzipFile(fileobj=StringIO(rv.data)).read(), content
+                )
+                etag = rv.headers['ETag']
+                rv = c.get(url, headers=[
+                    ('Accept-Encoding', 'gzip'), ('If-None-Match', etag),
+                ])
+                self.assertEqual(rv.status_code, 304)
+
+                rv = c.get(url)
+                self.assertFalse('Content-Encoding' in rv.headers)
+                self.assertEqual(rv.data, content)
+                self.assertNotEqual(rv.headers['ETag'], etag)
+
+            # Variants of the files stored before are made by the backfill
+            os.remove(gzip_path)
+            self.assertEqual(self.static_file_obj.backfill_variants(), 1)
+            self.assertTrue(os.path.isfile(gzip_path))
+
+            # A job of a previous content writes no variant, and the
+            # variants of the previous content are removed
+            paths = self.static_file_obj.get_variant_paths(
+                'test', 'style.css', static_file.checksum
+            )
+            self.static_file_obj.write([static_file], {
+                'file_binary': buffer(content.upper()),
+            })
+            static_file = self.static_file_obj(static_file.id)
+            self.assertFalse(os.path.isfile(gzip_path))
+            self.assertFalse(static_file_module.write_file_variants(
+                paths, static_file.file_path, hashlib.sha1(content).hexdigest()
+            ))
+            self.assertFalse(os.path.isfile(gzip_path))
+            self.assertTrue(os.path.isfile(
+                self.static_file_obj.get_variant_paths(
+                    'test', 'style.css', static_file.checksum
+                )['gzip']
+            ))
+
+    def test_0090_upload(self):
+        """
+        Upload the content of a file in one request and in chunks
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            party, = self.party_obj.create([{'name': 'Uploader'}])
+            user, = self.nereid_user_obj.create([{
+                'party': party,
+                'display_name': 'Uploader',
+                'email': 'uploader@openlabs.co.in',
+                'password': 'password',
+                'company': self.company.id,
+            }])
+            url = '/en_US/static-file-upload/%d' % static_file.id
+
+            app = self.get_app()
+            with app.test_client() as c:
+                c.post('/en_US/login', data={
+                    'email': 'uploader@openlabs.co.in',
+                    'password': 'password',
+                })
+                self.assertEqual(c.put(url, data='new').status_code, 403)
+
+                permission, = POOL.get('nereid.permission').search([
+                    ('value', '=', 'static_file.upload'),
+                ])
+                self.nereid_user_obj.write([user], {
+                    'permissions': [('add', [permission.id])],
+                })
+
+                rv = c.put(url, data='new-content')
+                self.assertEqual(rv.status_code, 200)
+                static_file = self.static_file_obj(static_file.id)
+                self.assertEqual(static_file.file_binary, 'new-content')
+                self.assertEqual(static_file.file_size, 11)
+
+                rv = c.put(url, data='chunk', headers=[
+                    ('Content-Range', 'bytes 0-4/10'),
+                ])
+                self.assertEqual(rv.status_code, 202)
+                self.assertEqual(rv.headers['Range'], 'bytes=0-4')
+
+                # The interrupted upload is resumed where it stopped
+                rv = c.put(url, headers=[('Content-Range', 'bytes */10')])
+                self.assertEqual(rv.status_code, 202)
+                self.assertEqual(json.loads(rv.data)['offset'], 5)
+                rv = c.put(url, data='othe', headers=[
+                    ('Content-Range', 'bytes 6-9/10'),
+                ])
+                self.assertEqual(rv.status_code, 409)
+
+                # Probes never replace the file, and the chunks of another
+                # length are refused
+                rv = c.put(url, headers=[('Content-Range', 'bytes */5')])
+                self.assertEqual(rv.status_code, 409)
+                self.assertEqual(json.loads(rv.data)['offset'], 5)
+                rv = c.put(url, data='s-end', headers=[
+                    ('Content-Range', 'bytes 5-9/12'),
+                ])
+                self.assertEqual(rv.status_code, 409)
+
+                # A malformed range is refused, and keeps the upload
+                for content_range in ['bytes 9-5/10', 'bytes 0-11/10']:
+                    rv = c.put(url, data='fragment', headers=[
+                        ('Content-Range', content_range),
+                    ])
+                    self.assertEqual(rv.status_code, 400)
+                rv = c.put(url, headers=[('Content-Range', 'bytes */10')])
+                self.assertEqual(json.loads(rv.data)['offset'], 5)
+                self.assertEqual(
+                    self.static_file_obj(static_file.id).file_binary,
+                    'new-content'
+                )
+
+                rv = c.put(url, data='s-end', headers=[
+                    ('Content-Range', 'bytes 5-9/10'),
+                ])
+                self.assertEqual(rv.status_code, 200)
+                static_file = self.static_file_obj(static_file.id)
+                self.assertEqual(static_file.file_binary, 'chunks-end')
+                self.assertEqual(
+                    static_file.get_partial_upload(), (None, None)
+                )
+
+                rv = c.put(url, headers=[('Content-Range', 'bytes */0')])
+                self.assertEqual(rv.status_code, 202)
+                self.assertEqual(json.loads(rv.data)['offset'], 0)
+
+    def test_0100_purge_uploads(self):
+        """
+        The partial uploads not resumed are purged
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            static_file = self.create_static_file(buffer('test-content'))
+            with static_file.lock_upload():
+                upload_path = static_file.get_upload_path(10)
+                with open(upload_path, 'wb') as upload:
+                    upload.write('chunk')
+            self.assertEqual(self.static_file_obj.purge_uploads(), 0)
+            self.assertEqual(
+                static_file.get_partial_upload(), (upload_path, 10)
+            )
+
+            # Not resumed for two days
+            expired = os.path.getmtime(upload_path) - 2 * 24 * 60 * 60
+            os.utime(upload_path, (expired, expired))
+            self.assertEqual(self.static_file_obj.purge_uploads(), 1)
+            self.assertEqual(
+                static_file.get_partial_upload(), (None, None)
+            )
+
 
 def suite():
     "Nereid test suite"
@@ -0,0 +1,158 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+    Prefix trie based URL matching
+
+    werkzeug matches a path by trying every rule of the map in turn. For
+    maps with thousands of rules the rules are indexed here by the static
+    segments at the start of their path, so that only the rules whose
+    prefix fits the requested path are tried.
+"""
+from heapq import merge
+
+from werkzeug.routing import Map, MapAdapter, RequestSlash
+
+__all__ = ['RuleTrie', 'PrefixTrieMap', 'PrefixTrieMapAdapter']
+
+
+def static_segments(rule):
+    """
+    Returns the complete path segments of a rule before its first
+    converter.
+
+    >>> static_segments('/static-file/<folder>/<name>')
+    ['static-file']
+    >>> static_segments('/page-<int:id>')
+    []
+    >>> static_segments('/account/')
+    ['account']
+    """
+    parts = rule.split('<', 1)
+    segments = parts[0].split('/')[1:]
+    if len(parts) > 1:
+        # The last segment is cut by a converter and cannot be indexed
+        segments = segments[:-1]
+    return [s for s in segments if s]
+
+
+class RuleTrie(object):
+    """
+    A trie of the rules of a map, keyed by the static segments of the rules
+
+    :param rules: The rules in the order in which they must be tried.
+                  Build only rules are left out since they never match.
+    """
+    __slots__ = ('children', 'rules')
+
+    def __init__(self, rules=None):
+        self.children = {}
+        #: (position, rule) of the rules ending at this node
+        self.rules = []
+        for position, rule in enumerate(rules or []):
+            if not rule.build_only:
+                self.add(position, rule)
+
+    def add(self, position, rule):
+        "Index a rule at the given position of the map"
+        node = self
+        for segment in static_segments(rule.rule):
+            node = node.children.setdefault(segment, RuleTrie())
+        node.rules.append((position, rule))
+
+    def candidates(self, path_info):
+        """
+        Returns the rules that could match the path, in the order of the
+        map. Rules with a prefix that does not fit the path are never
+        returned.
+        """
+        node = self
+        found = [node.rules]
+        for segment in path_info.strip('/').split('/'):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            found.append(node.rules)
+        return [rule for position, rule in merge(*found)]
+
+
+class PrefixTrieMapAdapter(MapAdapter):
+    """
+    A map adapter which only tries the rules returned by the trie of the
+    map. Whenever the outcome needs more than a plain match (redirects,
+    missing slashes, 404 and 405 errors) the full werkzeug match is run
+    so that the behaviour is the same.
+    """
+
+    def match(self, path_info=None, method=None, return_rule=False,
+              query_args=None):
+        if self.map.redirect_defaults:
+            # Redirecting to the canonical URL requires the other rules
+            return super(PrefixTrieMapAdapter, self).match(
+                path_info, method, return_rule, query_args
+            )
+
+        self.map.update()
+        if path_info is None:
+            path_info = self.path_info
+        elif not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'replace')
+        match_method = (method or self.default_method).upper()
+
+        path = u'%s|%s' % (
+            self.map.host_matching and self.server_name or self.subdomain,
+            path_info and '/%s' % path_info.lstrip('/')
+        )
+        for rule in self.map.trie.candidates(path_info):
+            try:
+                rv = rule.match(path)
+            except RequestSlash:
+                break
+            if rv is None:
+                continue
+            if rule.methods is not None and match_method not in rule.methods:
+                continue
+            if rule.redirect_to is not None:
+                break
+            if return_rule:
+                return rule, rv
+            return rule.endpoint, rv
+
+        return super(PrefixTrieMapAdapter, self).match(
+            path_info, method, return_rule, query_args
+        )
+
+
+class PrefixTrieMap(Map):
+    """
+    A werkzeug map which matches with :class:`PrefixTrieMapAdapter`. The
+    trie is rebuilt whenever werkzeug sorts the rules again, so rules are
+    tried in the same order as a regular map: werkzeug's ordering first,
+    then the sequence of the rules.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.trie = RuleTrie()
+        super(PrefixTrieMap, self).__init__(*args, **kwargs)
+
+    def update(self):
+        remap = self._remap
+        super(PrefixTrieMap, self).update()
+        if remap:
+            self.trie = RuleTrie(self._rules)
+
+    def _wrap_adapter(self, adapter):
+        return PrefixTrieMapAdapter(
+            self, adapter.server_name, adapter.script_name, adapter.subdomain,
+            adapter.url_scheme, adapter.path_info, adapter.default_method,
+            adapter.query_args
+        )
+
+    def bind(self, *args, **kwargs):
+        return self._wrap_adapter(
+            super(PrefixTrieMap, self).bind(*args, **kwargs)
+        )
+
+    def bind_to_environ(self, *args, **kwargs):
+        return self._wrap_adapter(
+            super(PrefixTrieMap, self).bind_to_environ(*args, **kwargs)
+        )
@@ -0,0 +1,263 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+    Bulk import of nereid users
+
+    Users and their parties are read from a CSV file (with a header line)
+    or a JSON lines file and created in chunks, each chunk in its own
+    transaction. The passwords of a chunk are hashed in a pool of processes
+    while the previous chunk is written.
+
+    The rows have the `name` of the party, the `email` and `password`, and
+    optionally the `display_name` and `timezone` of the user::
+
+        python -m trytond.modules.nereid.user_import -c trytond.conf \\
+            -d database --company 1 users.csv
+"""
+import csv
+import sys
+import json
+import time
+import logging
+from multiprocessing import Pool as ProcessPool
+from optparse import OptionParser
+
+from trytond.config import CONFIG
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import hashers
+
+__all__ = ['read_rows', 'RowError', 'UserImport']
+
+logger = logging.getLogger('nereid.user_import')
+
+
+class RowError(object):
+    """
+    A row which could not be read, yielded by :func:`read_rows` in its place
+    so that it is reported as a failure of its line
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def read_rows(fileobj, format=None):
+    """
+    Yields the rows of a CSV or JSON lines file as dictionaries, or a
+    :class:`RowError` for the rows which cannot be read
+
+    :param format: 'csv' or 'jsonl'. Guessed from the name of the file by
+                   default.
+    """
+    if format is None:
+        name = getattr(fileobj, 'name', '')
+        format = name.endswith(('.jsonl', '.json')) and 'jsonl' or 'csv'
+    if format == 'jsonl':
+        for line in fileobj:
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError, exception:
+                    row = RowError(str(exception))
+                yield row
+    else:
+        for row in csv.DictReader(fileobj):
+            if None in row:
+                # DictReader puts the values without a column under None
+                yield RowError('The row has more values than columns')
+                continue
+            yield dict(
+                (key, value.decode('utf-8'))
+                for key, value in row.iteritems() if value is not None
+            )
+
+
+def _hash_password(args):
+    "Hash a password in a process of the pool"
+    algorithm, cost, password = args
+    return hashers.get_hasher(algorithm, cost).hash(password)
+
+
+class UserImport(object):
+    """
+    Import users in chunks of `chunk_size` rows, each in its own
+    transaction. A chunk whose creation fails is imported again row by row
+    so that only the failing rows are left out.
+
+    :param database_name: The database to import into
+    :param company: The id of the company of the users
+    :param user: The id of the tryton user creating the records
+    :param chunk_size: The number of rows per transaction
+    :param processes: The number of processes hashing the passwords.
+                      Defaults to the number of CPUs.
+    """
+
+    def __init__(self, database_name, company, user=0, chunk_size=500,
+                 processes=None):
+        self.database_name = database_name
+        self.company = company
+        self.user = user
+        self.chunk_size = chunk_size
+        self.processes = processes
+
+        self.hasher = hashers.get_hasher()
+
+        #: The number of rows read and of users created
+        self.rows = 0
+        self.created = 0
+
+        #: (line number, error) of the rows not imported
+        self.failures = []
+        self.start = None
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.time() - (self.start or time.time())
+        return elapsed and self.rows / elapsed or 0.0
+
+    def chunks(self, rows):
+        """
+        Yields lists of (line number, row) of the chunk size. The rows which
+        could not be read are counted as failures instead.
+        """
+        chunk = []
+        for line, row in enumerate(rows, 1):
+            if isinstance(row, RowError):
+                self.rows += 1
+                self.failures.append((line, row.message))
+                continue
+            chunk.append((line, row))
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def hash_passwords(self, pool, chunk):
+        """
+        Start hashing the passwords of the chunk in the pool
+
+        :return: The result of the hashing, to pass to :meth:`set_passwords`
+        """
+        return pool.map_async(_hash_password, [
+            (self.hasher.algorithm, self.hasher.cost, row.get('password'))
+            for line, row in chunk if row.get('password')
+        ])
+
+    def set_passwords(self, chunk, hashing):
+        "Replace the passwords of the chunk by their hashes"
+        passwords = iter(hashing.get())
+        for line, row in chunk:
+            if row.get('password'):
+                row['password'] = next(passwords)
+        return chunk
+
+    def create(self, chunk):
+        """
+        Create the users of the chunk in a new transaction, which is
+        committed
+
+        :return: The number of users created and the failures
+        """
+        with Transaction().start(self.database_name, self.user) as transaction:
+            NereidUser = Pool().get('nereid.user')
+            try:
+                users, failures = NereidUser.import_rows(chunk, self.company)
+            except Exception:
+                transaction.cursor.rollback()
+                raise
+            transaction.cursor.commit()
+        return len(users), failures
+
+    def import_chunk(self, chunk):
+        "Import a chunk whose passwords are hashed"
+        try:
+            created, failures = self.create(chunk)
+        except Exception:
+            if len(chunk) == 1:
+                line, row = chunk[0]
+                created, failures = 0, [(line, str(sys.exc_info()[1]))]
+            else:
+                created, failures = 0, []
+                for row in chunk:
+                    row_created, row_failures = self.import_chunk([row])
+                    created += row_created
+                    failures.extend(row_failures)
+        return created, failures
+
+    def run(self, rows):
+        """
+        Import the rows, an iterable of dictionaries
+
+        :return: self, with the counters and failures of the import
+        """
+        self.start = time.time()
+        pool = ProcessPool(self.processes)
+        try:
+            # The passwords of a chunk are hashed while the previous chunk
+            # is written
+            previous = None
+            for chunk in self.chunks(rows):
+                hashing = self.hash_passwords(pool, chunk)
+                if previous is not None:
+                    self._import_hashed(*previous)
+                previous = (chunk, hashing)
+            if previous is not None:
+                self._import_hashed(*previous)
+        finally:
+            pool.terminate()
+        return self
+
+    def _import_hashed(self, chunk, hashing):
+        created, failures = self.import_chunk(
+            self.set_passwords(chunk, hashing)
+        )
+        self.rows += len(chunk)
+        self.created += created
+        self.failures.extend(failures)
+        logger.info(
+            '%d rows imported, %d failed, %.1f rows/s',
+            self.rows, len(self.failures), self.rows_per_second
+        )
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog -c config -d database --company id FILE'
+    )
+    parser.add_option('-c', '--config', dest='config')
+    parser.add_option('-d', '--database', dest='database')
+    parser.add_option('--company', dest='company', type='int')
+    parser.add_option('--format', dest='format', choices=['csv', 'jsonl'])
+    parser.add_option(
+        '--chunk-size', dest='chunk_size', type='int', default=500
+    )
+    parser.add_option('--processes', dest='processes', type='int')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1 or not options.database or not options.company:
+        parser.error('A database, a company and a file are required')
+
+    logging.basicConfig(level=logging.INFO)
+    if options.config:
+        CONFIG.update_etc(options.config)
+    Pool.start()
+    Pool(options.database).init()
+
+    with open(args[0], 'rb') as fileobj:
+        result = UserImport(
+            options.database, options.company,
+            chunk_size=options.chunk_size, processes=options.processes,
+        ).run(read_rows(fileobj, options.format))
+
+    for line, error in result.failures:
+        print 'Line %d: %s' % (line, error)
+    print '%d rows, %d users created, %d failures, %.1f rows/s' % (
+        result.rows, result.created, len(result.failures),
+        result.rows_per_second
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import random
+import string
+from datetime import datetime, timedelta
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond import backend
+from sql.conditionals import Coalesce
+
+__all__ = ['NereidUserToken']
+
+_random = random.SystemRandom()
+
+#: The length of the codes of each type of token. The lengths are those of
+#: the activation codes stored on the users before tokens were introduced.
+CODE_LENGTHS = {
+    'activation': 16,
+    'reset': 12,
+}
+
+
+class NereidUserToken(ModelSQL, ModelView):
+    """
+    Tokens sent to the users by email to activate their account or reset
+    their password.
+
+    The lifetime of the tokens is set in hours in the tryton configuration
+    with `nereid_activation_token_lifetime` (tokens never expire by
+    default) and `nereid_reset_token_lifetime` (24 hours by default).
+
+    A user with an activation token has not activated the account yet and
+    cannot login, even once the token expired. So only the expired reset
+    tokens are purged. Logging in with the right password after the
+    activation token expired issues a new one, and a reset token activates
+    the account too.
+    """
+    __name__ = 'nereid.user.token'
+    _rec_name = 'code'
+
+    nereid_user = fields.Many2One(
+        'nereid.user', 'User', required=True, readonly=True,
+        ondelete='CASCADE', select=True
+    )
+    code = fields.Char('Code', required=True, readonly=True, select=True)
+    type = fields.Selection([
+        ('activation', 'Activation'),
+        ('reset', 'Reset'),
+    ], 'Type', required=True, readonly=True)
+    expires = fields.DateTime('Expires', readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        NereidUser = Pool().get('nereid.user')
+        cursor = Transaction().cursor
+
+        super(NereidUserToken, cls).__register__(module_name)
+
+        # Migration from 3.0.0: activation codes are stored as tokens
+        user_handler = TableHandler(cursor, NereidUser, module_name)
+        if user_handler.column_exist('activation_code'):
+            table = cls.__table__()
+            user = NereidUser.__table__()
+            cursor.execute(*user.select(
+                user.id, user.activation_code,
+                where=Coalesce(user.activation_code, '') != ''
+            ))
+            now = datetime.utcnow()
+            for user_id, code in cursor.fetchall():
+                type_ = len(code) == CODE_LENGTHS['reset'] and 'reset' \
+                    or 'activation'
+                cursor.execute(*table.insert([
+                    table.create_uid, table.create_date,
+                    table.nereid_user, table.code, table.type, table.expires,
+                ], [[
+                    0, now, user_id, code, type_, cls.get_expiry(type_),
+                ]]))
+            user_handler.drop_column('activation_code')
+
+    @staticmethod
+    def get_lifetime(type_):
+        "Returns the lifetime of the tokens of the type or None"
+        hours = CONFIG.options.get(
+            'nereid_%s_token_lifetime' % type_,
+            type_ == 'reset' and 24 or 0
+        )
+        return int(hours) and timedelta(hours=int(hours)) or None
+
+    @classmethod
+    def get_expiry(cls, type_):
+        "Returns when a token of the type issued now expires"
+        lifetime = cls.get_lifetime(type_)
+        return lifetime and datetime.utcnow() + lifetime or None
+
+    @classmethod
+    def issue(cls, user_id, type_):
+        """
+        Returns a new code of the type for the user, which replaces the
+        previous token of the same type
+        """
+        cls.clear([user_id], type_)
+        code = ''.join(
+            _random.choice(string.ascii_letters + string.digits)
+            for i in xrange(CODE_LENGTHS[type_])
+        )
+        cls.create([{
+            'nereid_user': user_id,
+            'code': code,
+            'type': type_,
+            'expires': cls.get_expiry(type_),
+        }])
+        return code
+
+    @classmethod
+    def consume(cls, user_id, code):
+        """
+        Delete the token of the user with the code if it is not expired
+
+        :return: The type of the token or None if there is no such token
+        """
+        if not code:
+            return None
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(
+            table.id, table.type,
+            where=(table.code == code) & (table.nereid_user == user_id)
+            & (Coalesce(table.expires, datetime.max) > datetime.utcnow())
+        ))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        token_id, type_ = row
+        cursor.execute(*table.delete(where=table.id == token_id))
+        return type_
+
+    @classmethod
+    def clear(cls, user_ids, type_=None):
+        "Delete the tokens of the users, optionally only of one type"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        for i in range(0, len(user_ids), cursor.IN_MAX):
+            where = table.nereid_user.in_(user_ids[i:i + cursor.IN_MAX])
+            if type_ is not None:
+                where &= table.type == type_
+            cursor.execute(*table.delete(where=where))
+
+    @classmethod
+    def get_codes(cls, user_ids):
+        """
+        Returns a dictionary of the user ids to the code of their latest
+        valid token
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        codes = dict.fromkeys(user_ids)
+        for i in range(0, len(user_ids), cursor.IN_MAX):
+            cursor.execute(*table.select(
+                table.nereid_user, table.code,
+                where=table.nereid_user.in_(user_ids[i:i + cursor.IN_MAX])
+                & (Coalesce(table.expires, datetime.max)
+                    > datetime.utcnow()),
+                order_by=table.id.asc
+            ))
+            codes.update(cursor.fetchall())
+        return codes
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000, commit=True):
+        """
+        Delete the expired reset tokens in batches. The transaction is
+        committed after each batch, so that the rows deleted are not
+        locked for long. This is the method called by the cron job.
+
+        :param commit: False to leave the transaction to the caller
+        :return: The number of tokens deleted
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        deleted = 0
+        while True:
+            cursor.execute(*table.delete(where=table.id.in_(table.select(
+                table.id,
+                where=(table.type == 'reset')
+                & (table.expires < datetime.utcnow()),
+                limit=batch_size
+            ))))
+            rowcount = cursor.rowcount
+            deleted += rowcount
+            if commit:
+                cursor.commit()
+            if rowcount < batch_size:
+                break
+        return deleted